@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from functools import wraps
+from flask import request, Response
+import threading
+import hashlib
+import json
+
+
+class LRUBackend:
+    """\
+    In-process backend for ResponseCache, keeps the size most recently used entries
+
+    Any object with the same get and set methods can be used as a backend instead,
+    for example to share the cache between processes.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ResponseCache:
+    """\
+    Caches response bodies of read only endpoints
+
+    A response only depends on the endpoint, its parsed arguments and the state of the index.
+    The state is summed up by a generation counter every writer bumps (see bump_generation
+    in api/models.py), it is part of every key so a bump invalidates all entries at once.
+    The key also serves as ETag, a client sending it in If-None-Match gets a 304.
+    """
+
+    def __init__(self, backend, get_generation):
+        self.backend = backend
+        self.get_generation = get_generation
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def key(self, parser=None, **view_args):
+        args = parser.parse_args() if parser else {}
+        normalized = json.dumps([request.endpoint, self.get_generation(),
+                                 sorted(view_args.items()), sorted(args.items())])
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+    def cached(self, parser=None):
+        """\
+        decorator for views returning a JSON response
+        parser is the RequestParser of the view, only its parsed arguments make up the key
+        so differently ordered or ignored query parameters hit the same entry
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**view_args):
+                etag = self.key(parser, **view_args)
+
+                if request.if_none_match.contains(etag):
+                    self.not_modified += 1
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+
+                body = self.backend.get(etag)
+                if body is not None:
+                    self.hits += 1
+                else:
+                    result = view(**view_args)
+                    # errors are not cached
+                    if not isinstance(result, Response) or result.status_code != 200:
+                        return result
+
+                    self.misses += 1
+                    body = result.get_data()
+                    self.backend.set(etag, body)
+
+                response = Response(body, mimetype="application/json")
+                response.set_etag(etag)
+                return response
+
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "entries": len(self.backend) if hasattr(self.backend, "__len__") else None,
+            "generation": self.get_generation()
+        }
@@ -1,11 +1,14 @@
 from api import db
 from sqlalchemy.dialects import postgresql
-from sqlalchemy import ForeignKey, Column, text
-from sqlalchemy.orm import relationship
-from sqlalchemy.sql.expression import bindparam
+from sqlalchemy import ForeignKey, Column, DDL, and_, or_, func, event, tuple_, inspect, select, any_
+from sqlalchemy.orm import relationship, validates, joinedload, selectinload, defer, undefer
+from sqlalchemy.sql.expression import Executable, ClauseElement, bindparam
+from sqlalchemy.ext.compiler import compiles
 import urllib
 from config import URL_TO_MOUNT, THUMBNAIL_ROOT_URL
 import binascii
+import json
+import time
 import videoinfo
 import logging
 import os
@@ -22,43 +25,18 @@ tag_media_association_table = db.Table('tag_media',
                                               db.ForeignKey('media.media_id',
                                                             ondelete="cascade")))
 
-# These queries search in the mediainfo JSON which looks like this
-# {"streams" : [{"codec_name" : ".." , "width": ".." , "height": ".."}]}
-# jsonb_array_elemnts is used to convert the array to a set which can
-# be queried using a SELECT
-#
-# Beware: Super duper hack!
-#
-# TODO/FIXME: There is some way to construct these queries using the
-# sqlalchemy query builder
-# There just seems no good documentation (besides this -
-# https://bitbucket.org/zzzeek/sqlalchemy/issues/3566/figure-out-how-to-support-all-of-pgs#comment-22842678)
-
-
-def filter_multiple_codecs_and(codecs, i=0):
-    parameters = []
-    queries = []
-    for codec in codecs:
-        param_name = "codec_name_" + str(i)
-        i = i + 1
-
-        # No, there is no obvious SQL injection possible here
-        # The format is just to include a parameter for sqlalchemy with
-        # variable name
-        # ...
-        queries.append("""\
-            (SELECT COUNT(1)
-                FROM jsonb_array_elements(mediainfo -> 'streams') AS stream
-                WHERE  stream ->> 'codec_name' = :{}
-            ) > 0
-        """.format(param_name))
-
-        # ...
-        # The user supplied parameters are bind to the query here
-        # and inserted by sqlalchemy later
-        parameters.append(bindparam(param_name, codec))
-
-    return (" AND ".join(queries), parameters)
+# The codec, width and height filters used to search in the mediainfo JSON
+# with a correlated jsonb_array_elements subquery on every row
+# They now use the typed and indexed columns of media_stream which holds
+# one row per stream of the mediainfo JSON
+
+
+def filter_multiple_codecs_and(codecs):
+    """\
+    matches media having a stream for every codec in codecs
+    """
+    return and_(*[Media.streams.any(MediaStream.codec_name == codec)
+                  for codec in codecs])
 
 
 # Takes a lists of lists, applies filter_multiple_codecs_and
@@ -66,45 +44,151 @@ def filter_multiple_codecs_and(codecs, i=0):
 # example [["h264", "aac"], ["vp8"]] ==> (*codec_is* h264 AND *codec_is* aac)
 # OR (*codec_is* vp8)
 def filter_multiple_codecs_or(codecs):
-    # filter_multiple_codecs_and doesn't return the sqlalchemy.text(string,
-    #                                                               parameters)
-    # version but the string and parameters seperately so they can be joined
-    # by OR's here easily
-    # thats why filter_multiple_codecs_and needs an optional argument,
-    # the index from where to start naming parameters from to prevent
-    # collisions
-    i = 0
-    and_queries = []
-
-    # the text function from sqlalchemy expects bindparams to be
-    # a list of objects returned by the bindparam function
-    # filter_multiple_codecs_and returns such a list so we just need to join
-    # the lists here
-    parameters = []
-    for and_codecs in codecs:
-        (query, params) = filter_multiple_codecs_and(and_codecs, i=i)
-        and_queries.append("(" + query + ")")
-        parameters.extend(params)
-
-        # filter_multiple_codecs_and used len(params) parameters
-        i = i + len(params)
-
-    return text(" OR ".join(and_queries), bindparams=parameters)
-
-
-filter_width_greater_equals = """\
-    (SELECT COUNT(1)
-        FROM jsonb_array_elements(mediainfo -> 'streams') AS stream
-        WHERE  (stream ->> 'width') >= ':width'
-    ) > 0
- """
-
-filter_height_greater_equals = """\
-    (SELECT COUNT(1)
-        FROM jsonb_array_elements(mediainfo -> 'streams') AS stream
-        WHERE  (stream ->> 'height') >= ':height'
-    ) > 0
-"""
+    return or_(*[filter_multiple_codecs_and(and_codecs)
+                 for and_codecs in codecs])
+
+
+def filter_width_greater_equals(width):
+    return Media.streams.any(MediaStream.width >= width)
+
+
+def filter_height_greater_equals(height):
+    return Media.streams.any(MediaStream.height >= height)
+
+
+def media_url(path):
+    return urllib.parse.urljoin(URL_TO_MOUNT, urllib.parse.quote(path))
+
+
+def thumbnail_url(hex_sha):
+    return urllib.parse.urljoin(THUMBNAIL_ROOT_URL, hex_sha + ".jpg")
+
+
+def build_api_fields(path, mediainfo, category, tags, mimetype,
+                     lastModified, timeLastIndexed, sha):
+    """\
+    returns the representation of a medium in the api, without media_id
+    and raw_mediainfo which are filled in by Media.api_fields
+    """
+    hex_sha = binascii.hexlify(sha).decode("ascii")
+    mediainfo_for_api = {
+        "title": None,
+        "media_id": None,
+        "path": path,
+        "url": media_url(path),
+        "duration": None,
+        "streams": [],
+        "category": category,
+        "tags": tags,
+        "mimetype": mimetype,
+        "last_modified": lastModified,
+        "last_indexed": timeLastIndexed,
+        "sha": hex_sha,
+        "raw_mediainfo": None,
+        "thumbnail": "",
+        "size": None
+    }
+
+    mediainfo_for_api["thumbnail"] = thumbnail_url(hex_sha)
+
+    if "format" in mediainfo and "duration" in \
+       mediainfo["format"]:
+        mediainfo_for_api["duration"] = \
+          float(mediainfo["format"]["duration"])
+
+    if "format" in mediainfo and "size" in \
+       mediainfo["format"]:
+        mediainfo_for_api["size"] = \
+          float(mediainfo["format"]["size"])
+
+    if "format" in mediainfo and "tags" in \
+       mediainfo["format"] and "title" in \
+       mediainfo["format"]["tags"]:
+        mediainfo_for_api["title"] = \
+          mediainfo["format"]["tags"]["title"]
+    else:
+        mediainfo_for_api["title"] = \
+          os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+    if "streams" in mediainfo:
+        for stream in mediainfo["streams"]:
+            # TODO: add audio stream language
+            s = {
+                "index": stream.get("index"),
+                "codec": stream.get("codec_name"),
+                "width": stream.get("width"),
+                "height": stream.get("height"),
+                "duration": stream.get("duration"),
+                "type": stream.get("codec_type")
+            }
+
+            if not s["duration"] and "duration" in mediainfo_for_api:
+                s["duration"] = mediainfo_for_api["duration"]
+
+            mediainfo_for_api["streams"].append(s)
+
+    return mediainfo_for_api
+
+
+def build_api_document(*args):
+    """\
+    takes the same arguments as build_api_fields and returns its output
+    serialized to JSON, this is what is stored in Media.api_document
+    url and thumbnail are left null, they depend on URL_TO_MOUNT and
+    THUMBNAIL_ROOT_URL which may change after indexing
+    """
+    fields = build_api_fields(*args)
+    fields["url"] = None
+    fields["thumbnail"] = None
+    return json.dumps(fields, sort_keys=True)
+
+
+def splice_document(api_document, media_id, path, sha):
+    """\
+    sets media_id, url and thumbnail in a document from build_api_document without parsing it
+    the keys can't occur anywhere else unescaped, so a plain replace is enough
+    """
+    hex_sha = binascii.hexlify(sha).decode("ascii")
+    return api_document \
+        .replace('"media_id": null', '"media_id": {}'.format(int(media_id)), 1) \
+        .replace('"thumbnail": null', '"thumbnail": {}'.format(json.dumps(thumbnail_url(hex_sha))), 1) \
+        .replace('"url": null', '"url": {}'.format(json.dumps(media_url(path))), 1)
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def title_from_mediainfo(mediainfo):
+    tags = (mediainfo or {}).get("format", {}).get("tags", {})
+    return tags.get("title")
+
+
+def streams_from_mediainfo(mediainfo):
+    """\
+    returns the column values of the media_stream rows for the streams in mediainfo
+    """
+    streams = []
+    for stream in (mediainfo or {}).get("streams", []):
+        streams.append({
+            "stream_index": _int_or_none(stream.get("index")),
+            "codec_name": stream.get("codec_name"),
+            "codec_type": stream.get("codec_type"),
+            "width": _int_or_none(stream.get("width")),
+            "height": _int_or_none(stream.get("height")),
+            "duration": _float_or_none(stream.get("duration"))
+        })
+    return streams
 
 
 class Category(db.Model):
@@ -138,6 +222,14 @@ class Media(db.Model):
     mimetype = db.Column(db.Text, nullable=False)
     timeLastIndexed = db.Column(db.Integer, nullable=False)
     sha = db.Column(db.Binary(length=32), nullable=False)
+    # file size and inode from the filesystem, together with lastModified
+    # they fingerprint the file so unchanged bytes are never hashed twice
+    size = db.Column(db.BigInteger, nullable=True)
+    inode = db.Column(db.BigInteger, nullable=True)
+    # title tag of the container (mediainfo.format.tags.title) if there is one
+    title = db.Column(db.Text, nullable=True)
+    # api_fields() as JSON with media_id set to null, see build_api_document
+    api_document = db.Column(db.Text, nullable=True)
 
     # media requires a category
     category_id = Column(db.Integer,
@@ -150,73 +242,282 @@ class Media(db.Model):
                         back_populates="media",
                         cascade="all")
 
+    streams = relationship("MediaStream",
+                           back_populates="media",
+                           cascade="all, delete-orphan",
+                           passive_deletes=True,
+                           order_by="MediaStream.stream_index")
+
+    # (path, media_id) and (timeLastIndexed, media_id) are the sort keys
+    # of the cursor pagination, see keyset_after
+    # the free text search runs ILIKE on path and title, trigram indexes
+    # let postgres answer '%word%' patterns without a sequential scan
+    __table_args__ = (
+        db.Index("ix_media_path_id", "path", "media_id"),
+        db.Index("ix_media_indexed", "timeLastIndexed", "media_id"),
+        # the scraper and /v1/duplicates look media up by content
+        db.Index("ix_media_sha", "sha"),
+        db.Index("ix_media_path_trgm", "path",
+                 postgresql_using="gin",
+                 postgresql_ops={"path": "gin_trgm_ops"}),
+        db.Index("ix_media_title_trgm", "title",
+                 postgresql_using="gin",
+                 postgresql_ops={"title": "gin_trgm_ops"}),
+    )
+
+    @validates("mediainfo")
+    def validate_mediainfo(self, key, mediainfo):
+        # keep media_stream and title in sync with the mediainfo JSON
+        self.streams = [MediaStream(**stream)
+                        for stream in streams_from_mediainfo(mediainfo)]
+        self.title = title_from_mediainfo(mediainfo)
+        return mediainfo
+
     def api_fields(self, include_raw_mediainfo=False):
-        hex_sha = binascii.hexlify(self.sha).decode("ascii")
-        tags = [tag.name for tag in self.tags]
-
-        mediainfo_for_api = {
-            "title": None,
-            "media_id": self.media_id,
-            "path": self.path,
-            "url": urllib.parse.urljoin(URL_TO_MOUNT,
-                                        urllib.parse.quote(self.path)),
-            "duration": None,
-            "streams": [],
-            "category": self.category.name,
-            "tags": tags,
-            "mimetype": self.mimetype,
-            "last_modified": self.lastModified,
-            "last_indexed": self.timeLastIndexed,
-            "sha": hex_sha,
-            "raw_mediainfo": None,
-            "thumbnail": "",
-            "size": None
-        }
-
-        mediainfo_for_api["thumbnail"] = \
-            urllib.parse.urljoin(THUMBNAIL_ROOT_URL, hex_sha+".jpg")
-
-        if "format" in self.mediainfo and "duration" in \
-           self.mediainfo["format"]:
-            mediainfo_for_api["duration"] = \
-              float(self.mediainfo["format"]["duration"])
-
-        if "format" in self.mediainfo and "size" in \
-           self.mediainfo["format"]:
-            mediainfo_for_api["size"] = \
-              float(self.mediainfo["format"]["size"])
-
-        if "format" in self.mediainfo and "tags" in \
-           self.mediainfo["format"] and "title" in \
-           self.mediainfo["format"]["tags"]:
-            mediainfo_for_api["title"] = \
-              self.mediainfo["format"]["tags"]["title"]
-        else:
-            mediainfo_for_api["title"] = \
-              os.path.splitext(os.path.basename(os.path.normpath(self.path)))[0]
-
-        if "streams" in self.mediainfo:
-            for stream in self.mediainfo["streams"]:
-                # TODO: add audio stream language
-                s = {
-                    "index": stream.get("index"),
-                    "codec": stream.get("codec_name"),
-                    "width": stream.get("width"),
-                    "height": stream.get("height"),
-                    "duration": stream.get("duration"),
-                    "type": stream.get("codec_type")
-                }
-
-                if not s["duration"] and "duration" in mediainfo_for_api:
-                    s["duration"] = mediainfo_for_api["duration"]
-
-                mediainfo_for_api["streams"].append(s)
+        mediainfo_for_api = build_api_fields(
+            self.path, self.mediainfo, self.category.name,
+            [tag.name for tag in self.tags], self.mimetype,
+            self.lastModified, self.timeLastIndexed, self.sha)
+        mediainfo_for_api["media_id"] = self.media_id
 
         if include_raw_mediainfo:
             mediainfo_for_api["raw_mediainfo"] = self.mediainfo
 
         return mediainfo_for_api
 
+    def build_api_document(self):
+        return build_api_document(
+            self.path, self.mediainfo, self.category.name,
+            [tag.name for tag in self.tags], self.mimetype,
+            self.lastModified, self.timeLastIndexed, self.sha)
+
+    def api_json(self):
+        """\
+        returns api_fields() serialized to JSON, spliced from the stored
+        api_document if there is one so mediainfo isn't even loaded
+        """
+        if self.api_document:
+            return splice_document(self.api_document, self.media_id, self.path, self.sha)
+        return json.dumps(self.api_fields(), sort_keys=True)
+
+
+# the api document is stored with every row and is kept up to date by the
+# ORM events below, the scraper's MediaWriter builds it itself
+@event.listens_for(Media, "before_insert")
+@event.listens_for(Media, "before_update")
+def update_api_document(mapper, connection, target):
+    target.api_document = build_api_document(*document_args(connection, target))
+
+
+def document_args(connection, target):
+    """\
+    returns the arguments of build_api_document for the Media target while it is flushed
+    what isn't loaded is selected on connection, lazy loading it would start another flush
+    """
+    unloaded = inspect(target).unloaded
+    media = Media.__table__
+
+    columns = ["path", "mediainfo", "mimetype", "lastModified", "timeLastIndexed", "sha"]
+    values = dict((column, getattr(target, column)) for column in columns if column not in unloaded)
+    missing = [column for column in columns if column in unloaded]
+    if missing:
+        row = connection.execute(select([media.c[column] for column in missing])
+                                 .where(media.c.media_id == target.media_id)).first()
+        values.update(zip(missing, row))
+
+    if "category" not in unloaded:
+        category = target.category.name if target.category is not None else None
+    else:
+        categories = Category.__table__
+        category = connection.execute(select([categories.c.name])
+                                      .where(categories.c.category_id == target.category_id)).scalar()
+
+    if "tags" not in unloaded:
+        tags = [tag.name for tag in target.tags]
+    else:
+        tags = [name for (name,) in connection.execute(
+            select([Tag.__table__.c.name])
+            .select_from(tag_media_association_table.join(Tag.__table__))
+            .where(tag_media_association_table.c.media_id == target.media_id))]
+
+    return (values["path"], values["mediainfo"], category, tags, values["mimetype"],
+            values["lastModified"], values["timeLastIndexed"], values["sha"])
+
+
+def load_missing_documents(media):
+    """\
+    media indexed before api_document existed and not backfilled yet need their mediainfo,
+    category and tags for api_json, loads them for all such media at once instead of one by one
+    """
+    ids = [medium.media_id for medium in media if medium is not None and not medium.api_document]
+    if ids:
+        Media.query.filter(Media.media_id.in_(ids)) \
+            .options(undefer(Media.mediainfo), joinedload(Media.category), selectinload(Media.tags)) \
+            .all()
+
+
+def get_tag_names(media_ids):
+    """\
+    returns {media_id: [tag name]} for those of media_ids that are tagged, in one query
+    """
+    ids = bindparam("ids", value=list(media_ids), type_=postgresql.ARRAY(db.Integer))
+    result = db.session.execute(
+        select([tag_media_association_table.c.media_id, Tag.__table__.c.name])
+        .select_from(tag_media_association_table.join(Tag.__table__))
+        .where(tag_media_association_table.c.media_id == any_(ids)))
+
+    tag_names = {}
+    for (media_id, name) in result:
+        tag_names.setdefault(media_id, []).append(name)
+    return tag_names
+
+
+# the trigram indexes on media need the pg_trgm extension
+create_pg_trgm = DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+event.listen(Media.__table__, "before_create", create_pg_trgm)
+
+
+def create_extensions():
+    """\
+    creates the extensions the indexes need, create_all does it before it creates media
+    but a migration adds the indexes to the existing table, so db_upgrade.py calls this first
+    """
+    with db.engine.begin() as connection:
+        connection.execute(create_pg_trgm)
+
+
+class MediaStream(db.Model):
+    """\
+    One stream of the mediainfo JSON of a medium, with the fields
+    searched for in typed and indexed columns
+    """
+    __tablename__ = "media_stream"
+
+    media_stream_id = db.Column(db.Integer, primary_key=True)
+    media_id = Column(db.Integer,
+                      ForeignKey("media.media_id", ondelete="cascade"),
+                      nullable=False,
+                      index=True)
+    stream_index = db.Column(db.Integer)
+    codec_name = db.Column(db.Text)
+    codec_type = db.Column(db.Text)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    duration = db.Column(db.Float)
+
+    media = relationship("Media", back_populates="streams")
+
+    # the filters look up media_ids by value, having media_id in the
+    # index lets postgres answer them from the index alone
+    __table_args__ = (
+        db.Index("ix_media_stream_codec_name", "codec_name", "media_id"),
+        db.Index("ix_media_stream_width", "width", "media_id"),
+        db.Index("ix_media_stream_height", "height", "media_id"),
+    )
+
+
+def relevance(query):
+    """\
+    returns an order_by clause ranking media by how well path or title match query
+    word_similarity is the similarity of query to the best matching part of the text,
+    so long paths aren't penalized for everything around the match
+    """
+    return (func.greatest(func.word_similarity(query, Media.path),
+                          func.coalesce(func.word_similarity(query, Media.title), 0)).desc(),
+            Media.path.asc())
+
+
+class IndexState(db.Model):
+    """\
+    Single row table with a generation counter that is bumped on every
+    write to the index, the api caches responses per generation
+    """
+    __tablename__ = "index_state"
+
+    index_state_id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+def get_generation():
+    generation = db.session.query(func.max(IndexState.generation)).scalar()
+    return generation or 0
+
+
+def bump_generation():
+    """\
+    marks the index as changed, this is part of the caller's transaction
+    """
+    table = IndexState.__table__
+    result = db.session.execute(table.update().values(generation=table.c.generation + 1))
+    if result.rowcount == 0:
+        db.session.execute(table.insert().values(index_state_id=1, generation=1))
+
+
+class MediaChange(db.Model):
+    """\
+    Log of changed and deleted media, served by /v1/changes
+    seq only grows, clients keep the last one they saw and ask for everything after it
+    """
+    __tablename__ = "media_change"
+
+    seq = db.Column(db.BigInteger, primary_key=True)
+    # no foreign key, the tombstones of deleted media outlive their rows
+    media_id = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    time = db.Column(db.Integer, nullable=False)
+
+
+def record_changes(changes):
+    """\
+    bumps the generation and appends changes, a list of (media_id, path, deleted), to the change log
+    this is part of the caller's transaction and has to be the last write before the commit:
+    the update of index_state locks its row until then, so concurrent writers
+    get their sequence numbers in the order they commit and no client skips a change
+    """
+    bump_generation()
+
+    if changes:
+        now = int(time.time())
+        db.session.execute(MediaChange.__table__.insert().values([
+            {"media_id": media_id, "path": path, "deleted": deleted, "time": now}
+            for (media_id, path, deleted) in changes]))
+
+
+def get_changes(since, limit):
+    """\
+    returns up to limit changes after seq since, oldest first,
+    as (MediaChange, Media) with Media None for media that don't exist anymore
+    """
+    changes = db.session.query(MediaChange, Media) \
+        .outerjoin(Media, Media.media_id == MediaChange.media_id) \
+        .options(defer(Media.mediainfo)) \
+        .filter(MediaChange.seq > since) \
+        .order_by(MediaChange.seq) \
+        .limit(limit) \
+        .all()
+    load_missing_documents([medium for (_, medium) in changes])
+    return changes
+
+
+def get_last_change():
+    return db.session.query(func.max(MediaChange.seq)).scalar() or 0
+
+
+def find_duplicates(offset=0, limit=20):
+    """\
+    returns (sha, size, paths) for contents indexed under more than one path,
+    the ones wasting the most space first
+    """
+    wasted = func.max(Media.size) * (func.count(Media.media_id) - 1)
+    return db.session.query(Media.sha, func.max(Media.size), func.array_agg(Media.path)) \
+        .group_by(Media.sha) \
+        .having(func.count(Media.media_id) > 1) \
+        .order_by(wasted.desc().nullslast(), Media.sha) \
+        .limit(limit) \
+        .offset(offset) \
+        .all()
+
 
 def get_or_create_category(name):
     r = Category.query.filter_by(name=name).first()
@@ -236,27 +537,67 @@ def get_or_create_tag(name):
     return r
 
 
+def keyset_after(column, descending, value, media_id):
+    """\
+    matches the media that come after the medium with the sort key
+    (value, media_id) when ordering by (column, media_id)
+    """
+    key = tuple_(column, Media.media_id)
+    if descending:
+        return key < tuple_(value, media_id)
+    return key > tuple_(value, media_id)
+
+
+class Explain(Executable, ClauseElement):
+    """\
+    EXPLAIN (FORMAT JSON) of a select, it is compiled and executed like the select itself,
+    so its bound parameters are passed the usual way whatever their type
+    """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def estimate_count(query):
+    """\
+    returns the planner's estimate of the number of rows query returns,
+    much cheaper than count() which runs the whole query again
+    """
+    plan = db.session.execute(Explain(query.statement)).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 # both codecs and mime are lists of lists
 # the outer list means OR and the inner list means AND
+# count is "exact", "estimate" (see estimate_count) or None to not count at all
+# after is a filter from keyset_after, it is applied after counting so the
+# total is the same on every page
 def search_media(query=None, codecs=[],
                  width=None, height=None, category=None, mime=[],
                  tags=None, order_by=Media.path.asc(), sha=None,
-                 offset=0, limit=20):
+                 offset=0, limit=20, after=None, count="exact",
+                 load_mediainfo=True):
     media = Media.query
 
     if query:
         for word in query.split():
-            media = media.filter(Media.path.ilike("%{}%".format(word)))
+            pattern = "%{}%".format(word)
+            media = media.filter(Media.path.ilike(pattern) |
+                                 Media.title.ilike(pattern))
 
-    media = media.filter(filter_multiple_codecs_or(codecs))
+    if codecs:
+        media = media.filter(filter_multiple_codecs_or(codecs))
 
     if width:
-        media = media.filter(text(filter_width_greater_equals,
-                                  bindparams=[bindparam("width", width)]))
+        media = media.filter(filter_width_greater_equals(width))
 
     if height:
-        media = media.filter(text(filter_height_greater_equals,
-                                  bindparams=[bindparam("height", height)]))
+        media = media.filter(filter_height_greater_equals(height))
 
     if category:
         media = media.filter(Media.category_id == category)
@@ -277,8 +618,31 @@ def search_media(query=None, codecs=[],
 
         media = media.filter(f)
 
-    media = media.order_by(order_by)
+    if isinstance(order_by, tuple):
+        media = media.order_by(*order_by)
+    else:
+        media = media.order_by(order_by)
+
+    total = None
+    if count == "exact":
+        total = media.count()
+    elif count == "estimate":
+        total = estimate_count(media)
+
+    if after is not None:
+        media = media.filter(after)
+
+    # api_fields needs category and tags of every medium, load them for the
+    # whole page at once instead of lazily with two queries per medium
+    media = media.options(joinedload(Media.category),
+                          selectinload(Media.tags))
+
+    # callers that only need api_json() can skip the biggest column
+    if not load_mediainfo:
+        media = media.options(defer(Media.mediainfo))
 
-    count = media.count()
+    media = media.limit(limit).offset(offset).all()
+    if not load_mediainfo:
+        load_missing_documents(media)
 
-    return (count, media.limit(limit).offset(offset).all())
+    return (total, media)
@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+from api import db
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine=None):
+    """\
+    counts the SQL statements sent to the database inside the with block
+
+    with count_queries() as counter:
+        ...
+    counter.count, counter.statements
+    """
+    engine = engine or db.engine
+    counter = QueryCounter()
+
+    event.listen(engine, "before_cursor_execute", counter.before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter.before_cursor_execute)
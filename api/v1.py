@@ -1,14 +1,24 @@
-from flask import Blueprint, jsonify, render_template, Response, request
+from flask import Blueprint, jsonify, render_template, Response, request, stream_with_context
 from flask_restful import reqparse
-from .models import Media, Category, search_media, Tag, get_or_create_tag
+from .models import Media, Category, search_media, Tag, get_or_create_tag, relevance, keyset_after, \
+    get_generation, record_changes, splice_document, get_changes, get_last_change, \
+    find_duplicates
+from .cache import ResponseCache, LRUBackend
 from api import app
-from config import basedir
+from config import basedir, RESPONSE_CACHE_SIZE, EXPORT_BATCH_SIZE, CHANGES_MAX_WAIT, CHANGES_POLL_INTERVAL
 from api import db
 import os
+import json
+import base64
 import binascii
+import zlib
+import time
 
 v1 = Blueprint('v1', __name__)
 
+# replace response_cache.backend to share the cache between processes
+response_cache = ResponseCache(LRUBackend(RESPONSE_CACHE_SIZE), get_generation)
+
 
 category_parser = reqparse.RequestParser()
 # The codecs and mime argument can appear multiple times in a query
@@ -23,15 +33,72 @@ category_parser.add_argument("sha")
 category_parser.add_argument("mime", action="append", default=[])
 category_parser.add_argument("offset", default=0, type=int)
 category_parser.add_argument("limit", default=20, type=int)
+# the next token of the previous page, pages by sort key instead of offset
+category_parser.add_argument("after")
+# "exact" runs a count, "estimate" asks the query planner, "none" skips the total
+category_parser.add_argument("count", default="estimate", choices=("exact", "estimate", "none"))
+
+export_parser = reqparse.RequestParser()
+# only media (re)indexed at or after this unix timestamp, for incremental syncs
+export_parser.add_argument("updated_since", type=int)
+
+changes_parser = reqparse.RequestParser()
+changes_parser.add_argument("since", default=0, type=int)
+changes_parser.add_argument("limit", default=1000, type=int)
+# seconds to hold the request open if there are no changes yet, capped at CHANGES_MAX_WAIT
+changes_parser.add_argument("wait", default=0, type=int)
+
+duplicates_parser = reqparse.RequestParser()
+duplicates_parser.add_argument("offset", default=0, type=int)
+duplicates_parser.add_argument("limit", default=20, type=int)
 
 search_parser = category_parser.copy()
 search_parser.add_argument("q")
 search_parser.add_argument("category")
 
 
+# order_by argument -> sort column and whether it is descending
+# media_id is always the second sort column, so the order is total
+sort_orders = {
+    "name_asc": (Media.path, False),
+    "name_desc": (Media.path, True),
+    "indexed_asc": (Media.timeLastIndexed, False),
+    "indexed_desc": (Media.timeLastIndexed, True),
+}
+
+
+def encode_cursor(order, medium):
+    """\
+    returns an opaque token pointing right behind medium in the given order
+    """
+    (column, _) = sort_orders[order]
+    cursor = [order, getattr(medium, column.key), medium.media_id]
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    """\
+    returns the order, sort value and media_id of a token from encode_cursor or None if it is invalid
+    """
+    try:
+        (order, value, media_id) = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        return None
+
+    if order not in sort_orders or type(media_id) is not int:
+        return None
+
+    (column, _) = sort_orders[order]
+    if type(value) is not column.type.python_type:
+        return None
+
+    return (order, value, media_id)
+
+
 def do_search(args):
     """\
-    Takes the output of search_parser as an argument and returns the output of the search_media function (an array)
+    Takes the output of search_parser as an argument and returns the total, the found media (an array)
+    and the token for the next page (None if this is the last page or the order doesn't support cursors)
     Returns a string with the error message for bad input
     Works with the output of category_parser as well
     """
@@ -43,17 +110,31 @@ def do_search(args):
             if tag:
                 tags.append(tag.tag_id)
             else:
-                return jsonify(media=[])
+                return (0, [], None)
 
     order_by = None
-    if args["order_by"] == "name_asc":
-        order_by = Media.path.asc()
-    elif args["order_by"] == "name_desc":
-        order_by = Media.path.desc()
-    elif args["order_by"] == "indexed_asc":
-        order_by = Media.timeLastIndexed.asc()
-    elif args["order_by"] == "indexed_desc":
-        order_by = Media.timeLastIndexed.desc()
+    after = None
+    if args["order_by"] in sort_orders:
+        (column, descending) = sort_orders[args["order_by"]]
+        if descending:
+            order_by = (column.desc(), Media.media_id.desc())
+        else:
+            order_by = (column.asc(), Media.media_id.asc())
+
+        if args["after"]:
+            cursor = decode_cursor(args["after"])
+            if not cursor or cursor[0] != args["order_by"]:
+                return "invalid after token"
+            after = keyset_after(column, descending, cursor[1], cursor[2])
+
+    elif args["order_by"] == "relevance":
+        if args["after"]:
+            return "after is not supported with order_by=relevance, use offset"
+
+        if args["q"]:
+            order_by = relevance(args["q"])
+        else:
+            order_by = Media.path.asc()
 
     sha = None
     if args["sha"]:
@@ -81,11 +162,67 @@ def do_search(args):
     for codec in args["codecs"]:
         codecs.append(codec.split(","))
 
-    return search_media(query=args["q"], codecs=codecs, mime=args["mime"],
+    count = args["count"] if args["count"] != "none" else None
+
+    (total, media) = search_media(query=args["q"], codecs=codecs, mime=args["mime"],
         width=args["width"], height=args["height"], category=args["category"],
-        tags=tags, order_by=order_by, sha=sha, limit=limit, offset=args["offset"])
+        tags=tags, order_by=order_by, sha=sha, limit=limit, offset=args["offset"],
+        after=after, count=count, load_mediainfo=False)
+
+    next_token = None
+    if args["order_by"] in sort_orders and limit > 0 and len(media) == limit:
+        next_token = encode_cursor(args["order_by"], media[-1])
+
+    return (total, media, next_token)
+
+
+def media_list_response(total, total_is_estimate, next_token, media):
+    """\
+    builds the response of the list endpoints from the stored api documents of the media
+    the documents are already JSON and are only joined, not parsed again
+    """
+    body = '{{"media": [{}], "next": {}, "total": {}, "total_is_estimate": {}}}'.format(
+        ", ".join(medium.api_json() for medium in media),
+        json.dumps(next_token), json.dumps(total), json.dumps(total_is_estimate))
+
+    return Response(body, mimetype="application/json")
+
+
+def export_lines(updated_since=None):
+    """\
+    yields the api document of every medium as one line of JSON, ordered by media_id
+    the rows come from a server side cursor, memory use doesn't grow with the index
+    """
+    query = db.session.query(Media.media_id, Media.path, Media.sha, Media.api_document).order_by(Media.media_id)
+    if updated_since is not None:
+        query = query.filter(Media.timeLastIndexed >= updated_since)
+
+    query = query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+    for (media_id, path, sha, api_document) in query:
+        if api_document is None:
+            # indexed before api_document existed and not backfilled yet
+            yield Media.query.get(media_id).api_json() + "\n"
+        else:
+            yield splice_document(api_document, media_id, path, sha) + "\n"
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
 
 
+def change_json(change, medium):
+    """\
+    one entry of /v1/changes, medium is None for tombstones and media deleted since
+    """
+    return '{{"deleted": {}, "media_id": {}, "medium": {}, "path": {}, "seq": {}}}'.format(
+        json.dumps(change.deleted), change.media_id, medium.api_json() if medium else "null",
+        json.dumps(change.path), change.seq)
+
 
 @v1.route('/', methods=["GET"])
 def doc():
@@ -94,6 +231,7 @@ def doc():
 
 
 @v1.route('/search', methods=["GET"])
+@response_cache.cached(search_parser)
 def search():
     args = search_parser.parse_args()
 
@@ -105,9 +243,9 @@ def search():
     if type(result) is str:
         return "Bad Request: " + result, 400
 
-    (count, media) = result
+    (total, media, next_token) = result
 
-    return jsonify(total=count, media=[medium.api_fields() for medium in media])
+    return media_list_response(total, args["count"] == "estimate", next_token, media)
 
 
 @v1.route('/media/<int:media_id>', methods=["GET"])
@@ -129,12 +267,14 @@ def mediaTag(media_id, tag_name):
             medium.tags.remove(tag)
 
     db.session.add(medium)
+    record_changes([(medium.media_id, medium.path, False)])
     db.session.commit()
 
     return jsonify(**medium.api_fields())
 
 
 @v1.route('/category', methods=["GET"])
+@response_cache.cached()
 def category():
     categories = Category.query.all()
 
@@ -145,6 +285,7 @@ def category():
 
 
 @v1.route('/category/<category>', methods=["GET"])
+@response_cache.cached(category_parser)
 def categoryById(category):
     args = category_parser.parse_args()
     args["q"] = None
@@ -156,12 +297,82 @@ def categoryById(category):
     if type(result) is str:
         return "Bad Request: " + result, 400
 
-    (count, media) = result
+    (total, media, next_token) = result
 
-    json = jsonify(total=count, media=[medium.api_fields() for medium in media])
-    return json
+    return media_list_response(total, args["count"] == "estimate", next_token, media)
 
 
 @v1.route("/tag", methods=["GET"])
+@response_cache.cached()
 def tags():
     return jsonify(tags=[tag.name for tag in Tag.query.all()])
+
+
+@v1.route("/export", methods=["GET"])
+def export():
+    args = export_parser.parse_args()
+    # read before the export starts, following /v1/changes from here misses nothing
+    last_seq = get_last_change()
+    chunks = export_lines(args["updated_since"])
+
+    gzipped = "gzip" in request.accept_encodings
+    if gzipped:
+        chunks = gzip_chunks(chunks)
+
+    # the generator uses the db session, keep the request context alive while it runs
+    response = Response(stream_with_context(chunks), mimetype="application/x-ndjson")
+    if gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["X-Last-Seq"] = str(last_seq)
+    return response
+
+
+@v1.route("/changes", methods=["GET"])
+def changes():
+    args = changes_parser.parse_args()
+
+    if args["since"] < 0:
+        return "Bad Request: negative since", 400
+    if args["limit"] <= 0:
+        return "Bad Request: limit has to be positive", 400
+
+    limit = min(args["limit"], 1000)
+    deadline = time.time() + min(max(args["wait"], 0), CHANGES_MAX_WAIT)
+
+    while True:
+        changes = get_changes(args["since"], limit)
+        if changes or time.time() >= deadline:
+            break
+
+        # end the transaction, the next poll has to see what was committed meanwhile
+        db.session.rollback()
+        time.sleep(CHANGES_POLL_INTERVAL)
+
+    last_seq = changes[-1][0].seq if changes else args["since"]
+    body = '{{"changes": [{}], "last_seq": {}}}'.format(
+        ", ".join(change_json(change, medium) for (change, medium) in changes), last_seq)
+
+    return Response(body, mimetype="application/json")
+
+
+@v1.route("/duplicates", methods=["GET"])
+@response_cache.cached(duplicates_parser)
+def duplicates():
+    args = duplicates_parser.parse_args()
+
+    if args["offset"] < 0:
+        return "Bad Request: negative offset", 400
+    if args["limit"] < 0:
+        return "Bad Request: negative limit", 400
+
+    return jsonify(duplicates=[{"sha": binascii.hexlify(sha).decode("ascii"),
+                                "size": size,
+                                "paths": sorted(paths)}
+                               for (sha, size, paths) in find_duplicates(args["offset"], min(args["limit"], 100))])
+
+
+@v1.route("/cache", methods=["GET"])
+def cacheStats():
+    return jsonify(**response_cache.stats())
@@ -1,10 +1,47 @@
 #!venv/bin/python
 import unittest
 from flask.ext.testing import TestCase
-from api.models import Tag, Category, Media, get_or_create_category, get_or_create_tag, search_media
+from api.models import Tag, Category, Media, get_or_create_category, get_or_create_tag, search_media, relevance, \
+    keyset_after, title_from_mediainfo, get_generation, get_changes, find_duplicates
 from api import app, db
+from api.querycount import count_queries
+from api.cache import LRUBackend
+from api.v1 import response_cache
+import api.v1
 import time
+import os
+import json
+import zlib
+import tempfile
+import shutil
 import scraper
+import manifest
+import snapshot
+import watcher
+import journal
+import runreport
+import dbwriter
+import pipeline
+import videoinfo
+import subprocess
+import threading
+from sqlalchemy.orm import defer
+
+
+def square_stage(x):
+    # a pipeline stage for test_pipeline, it has to be picklable
+    return (x + 1 if x % 2 else None, ("square", x, x * x))
+
+
+def slow_stage(x):
+    # hands x on to the next stage after a while, for test_pipeline_flush
+    # the items are large, so they take a while to go through the pipe as well
+    time.sleep(0.001 * (x % 5))
+    return ((x, bytes(1 << 20)), None)
+
+
+def last_stage(item):
+    return (None, item[0])
 
 
 class ModelTestCase(TestCase):
@@ -84,7 +121,7 @@ class ModelTestCase(TestCase):
 
         medias = [
             Media(path="/foo/Breaking",
-                mediainfo={"streams": [
+                mediainfo={"format": {"tags": {"title": "Walter White"}}, "streams": [
                     {"width": 300, "height": 300, "codec_type": "video", "codec_name": "h.264", "index":0, "duration": "30.0"},
                     {"width": None, "height": None, "codec_type": "audio", "codec_name": "aac", "index":1, "duration": "30.0"},
                 ]},
@@ -136,6 +173,12 @@ class ModelTestCase(TestCase):
         assert search_media(query="Breaking Bad")[1] == [medias[3], medias[1], medias[2]]
         assert search_media(query="Breaking Bad", order_by=Media.path.desc())[1] == [medias[2], medias[1], medias[3]]
 
+        # Check that the title tag is searched as well
+        assert search_media(query="walter")[1] == [medias[0]]
+
+        # Check that ordering by relevance puts the closest match first
+        assert search_media(query="Breaking Bad", order_by=relevance("Breaking Bad"))[1][0] == medias[3]
+
         # Check that searching by category works
         assert search_media(query="Breaking Bad", category=category1.category_id)[1] == [medias[1], medias[2]]
 
@@ -146,18 +189,372 @@ class ModelTestCase(TestCase):
         # Check that searching by category and tag works
         assert search_media(query="Breaking Bad", tags=[tag2.tag_id, tag3.tag_id], category=category1.category_id)[1] == []
 
+        # the estimated total is planned with the same bound parameters as the query
+        (total, media) = search_media(query="Breaking: Bad", tags=[tag2.tag_id], category=category1.category_id,
+                                      mime=["video/mp4", "audio/mp4"], count="estimate")
+        assert isinstance(total, int) and total >= 0
+
+        # Check that the streams of the mediainfo are mirrored in media_stream
+        assert [(s.codec_name, s.width) for s in medias[1].streams] == [("h.265", 300), ("aac", None)]
+
         # Check that searching by size works
         assert search_media(query="Breaking Bad", height=300, width=300)[1] == [medias[1]]
+        # sizes are compared as numbers, not as strings ("300" < "99")
+        assert search_media(query="Breaking Bad", width=99)[1] == [medias[1], medias[2]]
 
         # Check that searching by codec works
         assert search_media(query="Breaking Bad", codecs=[["h.264"]])[1] == [medias[3]]
         assert search_media(query="Breaking Bad", codecs=[["h.264"], ["h.265", "mp3"]])[1] == [medias[3], medias[2]]
 
+        # Check that cursor pagination continues right after the last medium of the previous page
+        order_by = (Media.path.asc(), Media.media_id.asc())
+        (total, page) = search_media(query="Breaking Bad", order_by=order_by, limit=2)
+        assert total == 3 and page == [medias[3], medias[1]]
+        after = keyset_after(Media.path, False, page[-1].path, page[-1].media_id)
+        (total, page) = search_media(query="Breaking Bad", order_by=order_by, limit=2, after=after)
+        assert total == 3 and page == [medias[2]]
+
+        # Check that the total can be estimated or skipped
+        assert type(search_media(query="Breaking Bad", count="estimate")[0]) is int
+        assert search_media(query="Breaking Bad", count=None)[0] is None
+
         # Check that searchy by mime works
         assert search_media(query="Breaking Bad", mime=["audio/mp4"])[1] == [medias[3]]
         assert search_media(query="Breaking Bad", mime=["audio/mp4", "video/mp4"])[1] == [medias[3], medias[1], medias[2]]
 
 
+    def test_search_query_count(self):
+        category = get_or_create_category("category1")
+        tag = get_or_create_tag("tag1")
+
+        for i in range(5):
+            db.session.add(Media(path="/foo/{}".format(i),
+                                 mediainfo={},
+                                 category=category,
+                                 mimetype="video/mp4",
+                                 lastModified=1,
+                                 timeLastIndexed=1,
+                                 sha=b'\x00'*32,
+                                 tags=[tag]))
+        db.session.commit()
+
+        # serializing a page must not cost extra queries per medium
+        counts = []
+        for limit in [1, 5]:
+            db.session.expire_all()
+            with count_queries() as counter:
+                (count, media) = search_media(limit=limit)
+                [medium.api_fields() for medium in media]
+            counts.append(counter.count)
+
+        assert counts[0] == counts[1]
+
+    def test_response_cache(self):
+        category = get_or_create_category("category1")
+        medium = Media(path="/foo/bar",
+                       mediainfo={},
+                       category=category,
+                       mimetype="video/mp4",
+                       lastModified=1,
+                       timeLastIndexed=1,
+                       sha=b'\x00'*32)
+        db.session.add(medium)
+        db.session.commit()
+
+        response_cache.backend = LRUBackend()
+        hits = response_cache.hits
+
+        first = self.client.get("/api/v1/tag")
+        second = self.client.get("/api/v1/tag")
+        assert response_cache.hits == hits + 1
+        assert first.data == second.data
+        etag = first.headers["ETag"]
+
+        # clients that already have the response get a 304
+        response = self.client.get("/api/v1/tag", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        # writing to the index invalidates the cached responses
+        self.client.post("/api/v1/media/{}/tag/tag1".format(medium.media_id))
+        response = self.client.get("/api/v1/tag", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json["tags"] == ["tag1"]
+
+    def test_export(self):
+        category = get_or_create_category("category1")
+        for i in range(3):
+            db.session.add(Media(path="/foo/{}".format(i),
+                                 mediainfo={},
+                                 category=category,
+                                 mimetype="video/mp4",
+                                 lastModified=1,
+                                 timeLastIndexed=i,
+                                 sha=b'\x00'*32))
+        db.session.commit()
+
+        response = self.client.get("/api/v1/export")
+        lines = [json.loads(line) for line in response.data.decode("utf-8").splitlines()]
+        assert [medium["path"] for medium in lines] == ["/foo/0", "/foo/1", "/foo/2"]
+        assert lines[0] == Media.query.filter_by(path="/foo/0").first().api_fields()
+
+        response = self.client.get("/api/v1/export?updated_since=1", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        lines = zlib.decompress(response.data, 16 + zlib.MAX_WBITS).decode("utf-8").splitlines()
+        assert [json.loads(line)["path"] for line in lines] == ["/foo/1", "/foo/2"]
+
+    def test_changes(self):
+        writer = dbwriter.MediaWriter()
+        for i in range(2):
+            writer.add(Media(path="/foo/{}".format(i),
+                             mediainfo={},
+                             mimetype="video/mp4",
+                             lastModified=1,
+                             timeLastIndexed=1,
+                             sha=b'\x00'*32), "category1")
+        writer.flush()
+
+        response = self.client.get("/api/v1/changes")
+        changes = response.json["changes"]
+        assert [change["path"] for change in changes] == ["/foo/0", "/foo/1"]
+        assert changes[0]["medium"]["path"] == "/foo/0"
+        last_seq = response.json["last_seq"]
+
+        assert scraper.delete_media([("/foo/0",)])[0] == 1
+
+        response = self.client.get("/api/v1/changes?since={}".format(last_seq))
+        changes = response.json["changes"]
+        assert len(changes) == 1
+        assert changes[0]["deleted"]
+        assert changes[0]["medium"] is None
+
+        response = self.client.get("/api/v1/changes?since={}".format(response.json["last_seq"]))
+        assert response.json["changes"] == []
+
+    def test_search_cursor(self):
+        category = get_or_create_category("category1")
+        for i in range(5):
+            db.session.add(Media(path="/foo/{}".format(i),
+                                 mediainfo={},
+                                 category=category,
+                                 mimetype="video/mp4",
+                                 lastModified=1,
+                                 timeLastIndexed=1,
+                                 sha=b'\x00'*32))
+        db.session.commit()
+
+        # following next visits every medium once, the last page has no next
+        for (order, expected) in [("name_asc", [0, 1, 2, 3, 4]), ("name_desc", [4, 3, 2, 1, 0])]:
+            paths = []
+            url = "/api/v1/search?limit=2&order_by={}".format(order)
+            token = None
+            while True:
+                response = self.client.get(url + ("&after=" + token if token else ""))
+                assert response.status_code == 200
+                paths += [medium["path"] for medium in response.json["media"]]
+                token = response.json["next"]
+                if token is None:
+                    break
+            assert paths == ["/foo/{}".format(i) for i in expected]
+
+        token = self.client.get("/api/v1/search?limit=2&order_by=name_asc").json["next"]
+        for url in ["/api/v1/search?after=garbage",
+                    "/api/v1/search?order_by=name_desc&after=" + token,
+                    "/api/v1/search?order_by=relevance&q=foo&after=" + token]:
+            assert self.client.get(url).status_code == 400, url
+
+    def test_duplicates(self):
+        category = get_or_create_category("category1")
+        # two copies of a big file, three of a small one and a file without copies
+        for (path, sha, size) in [("/big/a", b'\x01'*32, 1000), ("/big/b", b'\x01'*32, 1000),
+                                  ("/small/a", b'\x02'*32, 10), ("/small/b", b'\x02'*32, 10),
+                                  ("/small/c", b'\x02'*32, 10), ("/unique", b'\x03'*32, 5000)]:
+            db.session.add(Media(path=path,
+                                 mediainfo={},
+                                 category=category,
+                                 mimetype="video/mp4",
+                                 lastModified=1,
+                                 timeLastIndexed=1,
+                                 sha=sha,
+                                 size=size))
+        db.session.commit()
+
+        assert [(sha, size, sorted(paths)) for (sha, size, paths) in find_duplicates()] == [
+            (b'\x01'*32, 1000, ["/big/a", "/big/b"]),
+            (b'\x02'*32, 10, ["/small/a", "/small/b", "/small/c"])]
+
+        response = self.client.get("/api/v1/duplicates")
+        assert response.json["duplicates"] == [
+            {"sha": "01"*32, "size": 1000, "paths": ["/big/a", "/big/b"]},
+            {"sha": "02"*32, "size": 10, "paths": ["/small/a", "/small/b", "/small/c"]}]
+        response = self.client.get("/api/v1/duplicates?offset=1&limit=1")
+        assert [d["sha"] for d in response.json["duplicates"]] == ["02"*32]
+
+        limits = []
+
+        def recording_find_duplicates(offset=0, limit=20):
+            limits.append(limit)
+            return find_duplicates(offset, limit)
+
+        old_find_duplicates = api.v1.find_duplicates
+        api.v1.find_duplicates = recording_find_duplicates
+        try:
+            assert len(self.client.get("/api/v1/duplicates?limit=1000").json["duplicates"]) == 2
+        finally:
+            api.v1.find_duplicates = old_find_duplicates
+        assert limits == [100]
+
+        assert self.client.get("/api/v1/duplicates?offset=-1").status_code == 400
+        assert self.client.get("/api/v1/duplicates?limit=-1").status_code == 400
+
+    def test_delete_media(self):
+        category = get_or_create_category("category1")
+        for (i, sha) in enumerate([b'\x00'*32, b'\x00'*32, b'\x01'*32]):
+            db.session.add(Media(path="/foo/{}".format(i),
+                                 mediainfo={},
+                                 category=category,
+                                 mimetype="video/mp4",
+                                 lastModified=1,
+                                 timeLastIndexed=1,
+                                 sha=sha))
+        db.session.commit()
+
+        thumb_dir = tempfile.mkdtemp()
+        old_path = scraper.thumbs.PATH_TO_THUMBNAILS
+        scraper.thumbs.PATH_TO_THUMBNAILS = thumb_dir
+        try:
+            for sha in ["00"*32, "01"*32]:
+                open(os.path.join(thumb_dir, sha + ".jpg"), "w").close()
+
+            (deleted, shas) = scraper.delete_media([("/foo/0",), ("/foo/2",), ("/foo/missing",)], batch_size=2)
+            assert deleted == 2
+            assert [m.path for m in Media.query.all()] == ["/foo/1"]
+
+            # /foo/1 still uses the thumbnail of sha 00..
+            assert scraper.remove_orphaned_thumbs(shas) == 1
+            assert os.listdir(thumb_dir) == ["00"*32 + ".jpg"]
+        finally:
+            scraper.thumbs.PATH_TO_THUMBNAILS = old_path
+            shutil.rmtree(thumb_dir)
+
+    def test_move_media(self):
+        category = get_or_create_category("uncategorized")
+        for i in range(3):
+            db.session.add(Media(path="old/{}.mp3".format(i),
+                                 mediainfo={"format": {"duration": "10.0"}},
+                                 category=category,
+                                 mimetype="audio/mpeg",
+                                 lastModified=1,
+                                 timeLastIndexed=1,
+                                 sha=bytes([i])*32,
+                                 size=100,
+                                 inode=i))
+        medium = Media.query.filter_by(path="old/0.mp3").one()
+        medium.tags.append(get_or_create_tag("tag1"))
+        db.session.commit()
+
+        moves = [(("old/{}.mp3".format(i), "audio/mpeg", 1, 100, i, bytes([i])*32),
+                  ("new/{}.mp3".format(i), "music/mpeg", 1, 100, i)) for i in range(2)]
+        # gone from the db in the meantime
+        moves.append((("old/missing.mp3", "audio/mpeg", 1, 100, 9, b'\x09'*32),
+                      ("new/missing.mp3", "audio/mpeg", 1, 100, 9)))
+        generation = get_generation()
+
+        # one select of the rows, one of their tags, one update and the change log per batch
+        with count_queries() as counter:
+            assert scraper.move_media(moves, batch_size=2) == 2
+        assert counter.count <= 2 * 6
+        db.session.expire_all()
+
+        assert sorted(m.path for m in Media.query.all()) == ["new/0.mp3", "new/1.mp3", "old/2.mp3"]
+        medium = Media.query.filter_by(path="new/0.mp3").one()
+        assert medium.sha == b'\x00'*32 and medium.category.name == "music" and medium.mimetype == "music/mpeg"
+        document = json.loads(medium.api_json())
+        assert document == json.loads(json.dumps(medium.api_fields(), sort_keys=True))
+        assert document["path"] == "new/0.mp3" and document["tags"] == ["tag1"]
+
+        # the moves are logged with the batch they were written in, the batch of the missing row writes nothing
+        assert get_generation() == generation + 1
+        assert [(c.path, c.deleted) for (c, _) in get_changes(0, 10)] == [("new/0.mp3", False), ("new/1.mp3", False)]
+
+    def test_media_writer(self):
+        writer = dbwriter.MediaWriter(batch_size=2, flush_interval=60)
+
+        for i in range(3):
+            writer.add(Media(path="/foo/{}".format(i),
+                             mediainfo={},
+                             mimetype="video/mp4",
+                             lastModified=1,
+                             timeLastIndexed=1,
+                             sha=b'\x00'*32), "category1")
+
+        # the first two rows are written as a batch, the third one is still buffered
+        assert Media.query.count() == 2
+        writer.flush()
+        assert Media.query.count() == 3
+
+        tag = get_or_create_tag("tag1")
+        medium = Media.query.filter_by(path="/foo/1").first()
+        medium.tags.append(tag)
+        db.session.commit()
+
+        # updates keep the row and its tags, the scraper sends plain records instead of Media instances
+        writer.add(dbwriter.MediaRecord(path="/foo/1",
+                                        mediainfo={"format": {"tags": {"title": "Foo"}}},
+                                        mimetype="video/mp4",
+                                        lastModified=2,
+                                        timeLastIndexed=2,
+                                        sha=b'\x01'*32,
+                                        size=None,
+                                        inode=None), "category2", update=True)
+        writer.flush()
+        db.session.expire_all()
+
+        medium = Media.query.filter_by(path="/foo/1").first()
+        assert Media.query.count() == 3
+        assert medium.lastModified == 2
+        assert medium.title == "Foo"
+        assert medium.category.name == "category2"
+        assert medium.tags == [tag]
+        assert writer.rows_written == 4
+
+        # a row written as an insert for a path that is indexed already overwrites it
+        writer.add(Media(path="/foo/2",
+                         mediainfo={},
+                         mimetype="video/mp4",
+                         lastModified=3,
+                         timeLastIndexed=3,
+                         sha=b'\x02'*32), "category1")
+        writer.flush()
+        db.session.expire_all()
+        assert Media.query.count() == 3
+        assert Media.query.filter_by(path="/foo/2").first().lastModified == 3
+
+        # the stored api documents match what api_fields builds, tags included
+        for medium in Media.query.all():
+            assert json.loads(medium.api_json()) == medium.api_fields()
+            # urls are filled in when the document is served, they follow the config
+            assert json.loads(medium.api_document)["url"] is None
+
+        # a medium loaded without mediainfo, category and tags gets its document rebuilt from the db
+        db.session.expire_all()
+        medium = Media.query.options(defer(Media.mediainfo)).filter_by(path="/foo/0").first()
+        medium.lastModified = 4
+        db.session.commit()
+        medium = Media.query.filter_by(path="/foo/0").first()
+        assert json.loads(medium.api_json()) == medium.api_fields()
+        assert json.loads(medium.api_json())["last_modified"] == 4
+
+        # media without a document are served with one query for the whole page
+        db.session.execute(Media.__table__.update().values(api_document=None))
+        db.session.commit()
+        counts = []
+        for limit in (1, 3):
+            db.session.expire_all()
+            with count_queries() as counter:
+                (_, media) = search_media(limit=limit, load_mediainfo=False)
+                [medium.api_json() for medium in media]
+            counts.append(counter.count)
+        assert counts[0] == counts[1]
 
 
 class ScraperTestCase(TestCase):
@@ -175,23 +572,573 @@ class ScraperTestCase(TestCase):
         # handles new files correctly
         database_files = []
         filesystem_files = [("test_file.mp4", "video", 1)]
-        (to_upsert, to_delete) = scraper.get_deltas(database_files, filesystem_files)
-        assert to_upsert == filesystem_files
+        (to_insert, to_update, to_delete) = scraper.get_deltas(database_files, filesystem_files)
+        assert to_insert == filesystem_files
+        assert to_update == []
         assert to_delete ==  []
 
         # handles deleted files correctly
         database_files = [("test_file.mp4", "video", 1), ("test_file2.mp4", "video", 3)]
         filesystem_files = [("test_file2.mp4", "video", 3)]
-        (to_upsert, to_delete) = scraper.get_deltas(database_files, filesystem_files)
-        assert to_upsert == []
+        (to_insert, to_update, to_delete) = scraper.get_deltas(database_files, filesystem_files)
+        assert to_insert == []
+        assert to_update == []
         assert to_delete ==  [("test_file.mp4", "video", 1)]
 
         # handles updates files correctly
         database_files = [("test_file.mp4", "video", 1), ("test_file2.mp4", "video", 3)]
-        filesystem_files = [("test_file2.mp4", "video", 4)]
-        (to_upsert, to_delete) = scraper.get_deltas(database_files, filesystem_files)
-        assert to_upsert == [("test_file2.mp4", "video", 4)]
-        assert to_delete ==  [("test_file.mp4", "video", 1), ("test_file2.mp4", "video", 3)]
+        filesystem_files = [("test_file2.mp4", "video", 4), ("test_file3.mp4", "video", 4)]
+        (to_insert, to_update, to_delete) = scraper.get_deltas(database_files, filesystem_files)
+        assert to_insert == [("test_file3.mp4", "video", 4)]
+        assert to_update == [("test_file2.mp4", "video", 4)]
+        assert to_delete ==  [("test_file.mp4", "video", 1)]
+
+    def test_index_snapshot(self):
+        files = snapshot.IndexSnapshot()
+        files.append(("a.mp4", "video/mp4", 1, 100, 7, b'\x01'*32))
+        files.append(("b.mp4", "video/mp4", 2, None, None, b'\x02'*32))
+        files.append(("c.mp3", "audio/mpeg", 3, 300, 9, b'\x03'*32))
+
+        assert len(files) == 3
+        assert files[1] == ("b.mp4", "video/mp4", 2, None, None, b'\x02'*32)
+        assert list(files)[2] == ("c.mp3", "audio/mpeg", 3, 300, 9, b'\x03'*32)
+        assert files.mimes == ["video/mp4", "audio/mpeg"]
+
+        # get_deltas takes it like a list
+        filesystem_files = [("a.mp4", "video/mp4", 1, 100, 7), ("b.mp4", "video/mp4", 5, 200, 8)]
+        (to_insert, to_update, to_delete) = scraper.get_deltas(files, filesystem_files)
+        assert to_insert == []
+        assert to_update == [("b.mp4", "video/mp4", 5, 200, 8)]
+        assert to_delete == [files[2]]
+
+    def test_get_moves(self):
+        to_insert = [("new/a.mp4", "video/mp4", 1, 100, 7), ("new/b.mp4", "video/mp4", 1, 100, 8)]
+        to_delete = [("old/a.mp4", "video/mp4", 1, 100, 7, b'\x01'*32),
+                     ("old/c.mp4", "video/mp4", 1, 100, 9, b'\x02'*32),
+                     ("old/d.mp4", "video/mp4", 1, None, None, b'\x03'*32)]
+        (moves, to_insert, to_delete) = scraper.get_moves(to_insert, to_delete)
+
+        # same inode, size and mtime means the file was only moved
+        assert moves == [(("old/a.mp4", "video/mp4", 1, 100, 7, b'\x01'*32), ("new/a.mp4", "video/mp4", 1, 100, 7))]
+        assert to_insert == [("new/b.mp4", "video/mp4", 1, 100, 8)]
+        assert [f[0] for f in to_delete] == ["old/c.mp4", "old/d.mp4"]
+
+        # rows without a fingerprint never end up in the sha cache, nor do those no file to index has
+        link = ("new/c.mp4", "video/mp4", 1, 100, 9)
+        assert scraper.get_sha_cache(to_delete, [link, ("new/e.mp4", "video/mp4", 1, None, None)]) == \
+            {(9, 100, 1): b'\x02'*32}
+        assert scraper.get_sha_cache(to_delete, to_insert) == {}
+
+    def test_manifest(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, "a", "b"))
+            open(os.path.join(root, "a", "movie.mp4"), "w").close()
+            open(os.path.join(root, "a", "b", "clip.mp4"), "w").close()
+            open(os.path.join(root, "a", "b", "notes.unknownext"), "w").close()
+
+            manifest_path = os.path.join(root, "manifest.pickle")
+            m = manifest.Manifest.load(manifest_path, os.path.join(root, "a"))
+            files = sorted(f for (_, f, _) in m.walk(scraper.classify_file))
+            m.save()
+            assert files == ["clip.mp4", "movie.mp4"]
+            assert m.scanned == 2 and m.pruned == 0
+
+            # nothing changed, every folder is served from the manifest
+            m = manifest.Manifest.load(manifest_path, os.path.join(root, "a"))
+            files = sorted(f for (_, f, _) in m.walk(scraper.classify_file))
+            m.save()
+            assert files == ["clip.mp4", "movie.mp4"]
+            assert m.scanned == 0 and m.pruned == 2
+
+            # a new file only causes its own folder to be rescanned
+            time.sleep(0.01)
+            open(os.path.join(root, "a", "b", "new.mp4"), "w").close()
+            m = manifest.Manifest.load(manifest_path, os.path.join(root, "a"))
+            files = sorted(f for (_, f, _) in m.walk(scraper.classify_file))
+            assert files == ["clip.mp4", "movie.mp4", "new.mp4"]
+            assert m.scanned == 1 and m.pruned == 1 and m.changed == 1
+
+            m.save()
+
+            # a file overwritten in place doesn't touch its folder, its stats are still fresh
+            folder_mtime = os.stat(os.path.join(root, "a")).st_mtime_ns
+            with open(os.path.join(root, "a", "movie.mp4"), "w") as f:
+                f.write("longer than before")
+            assert os.stat(os.path.join(root, "a")).st_mtime_ns == folder_mtime
+            m = manifest.Manifest.load(manifest_path, os.path.join(root, "a"))
+            sizes = dict((f, info[1]) for (_, f, info) in m.walk(scraper.classify_file))
+            assert sizes["movie.mp4"] == len("longer than before")
+            assert m.scanned == 0 and m.pruned == 2 and m.changed == 1
+
+            # full walks ignore the manifest
+            files = sorted(f for (_, f, _) in m.walk(scraper.classify_file, full=True))
+            assert m.scanned == 2 and m.pruned == 0
+            m.save()
+
+            # folders that are not accepted are skipped, but their subfolders are still walked
+            b = os.path.join(root, "a", "b")
+            m = manifest.Manifest.load(manifest_path, os.path.join(root, "a"))
+            files = sorted(f for (_, f, _) in m.walk(scraper.classify_file, accept_dir=lambda d: d == b))
+            assert files == ["clip.mp4", "new.mp4"]
+            assert m.skipped == 1 and m.pruned == 1
+            m.save()
+
+            # and collected once they are accepted
+            m = manifest.Manifest.load(manifest_path, os.path.join(root, "a"))
+            files = sorted(f for (_, f, _) in m.walk(scraper.classify_file))
+            assert files == ["clip.mp4", "movie.mp4", "new.mp4"]
+            assert m.scanned == 1 and m.pruned == 1
+        finally:
+            shutil.rmtree(root)
+
+    def test_journal(self):
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, "journal.sqlite")
+            a = ("a.mp4", "video/mp4", 1, 100, 7)
+            b = ("b.mp3", "audio/mpeg", 2, 200, 8)
+            c = ("c.mp4", "video/mp4", 3, 300, 9)
+
+            j = journal.Journal(path)
+            j.hashed(a, b'\x01'*32)
+            j.probed(a, b'\x01'*32, {"format": {"duration": "10.0"}}, True)
+            j.hashed(b, b'\x02'*32)
+            j.probed(c, b'\x03'*32, {}, True)
+            j.written(["c.mp4"])
+            # overtaken by its probe result, a late hash result changes nothing
+            j.hashed(a, b'\x01'*32)
+            # nor does it bring back the row of a file that was written already
+            d = ("d.mp4", "video/mp4", 4, 400, 10)
+            j.probed(d, b'\x04'*32, {}, False)
+            j.written(["d.mp4"])
+            j.hashed(d, b'\x04'*32)
+            assert j.resumable([d]) == {}
+            j.close()
+
+            # the next run resumes what was not written, as long as the file didn't change
+            j = journal.Journal(path)
+            resumed = j.resumable([a, ("b.mp3", "audio/mpeg", 5, 200, 8)])
+            assert resumed == {"a.mp4": (b'\x01'*32, {"format": {"duration": "10.0"}})}
+            assert j.pending_thumbs() == [(b'\x03'*32, "c.mp4", {})]
+
+            j.thumbed("c.mp4")
+            j.written(["a.mp4"])
+            assert j.pending_thumbs() == [(b'\x01'*32, "a.mp4", {"format": {"duration": "10.0"}})]
+
+            # b.mp3 is gone
+            j.retain([a], [])
+            assert j.resumable([b]) == {}
+            j.thumbed("a.mp4")
+            assert j.pending() == 0
+
+            # work for a file that is indexed as it is on disk is forgotten, unless the file changed since
+            j.hashed(a, b'\x01'*32)
+            j.hashed(b, b'\x02'*32)
+            j.retain([a, b], [a + (b'\x01'*32,), ("b.mp3", "audio/mpeg", 1, 200, 8, b'\x05'*32)])
+            assert j.resumable([a, b]) == {"b.mp3": (b'\x02'*32, None)}
+            j.close()
+        finally:
+            shutil.rmtree(root)
+
+    def test_shard(self):
+        assert scraper.parse_shard("2/3") == (2, 3)
+        for value in ("0/3", "4/3", "3", "a/b"):
+            with self.assertRaises(Exception):
+                scraper.parse_shard(value)
+
+        assert scraper.positive_int("4") == 4
+        for value in ("0", "-1", "a"):
+            with self.assertRaises(Exception):
+                scraper.positive_int(value)
+
+        paths = ["folder{}/movie{}.mp4".format(i, j) for i in range(50) for j in range(3)]
+        shards = [[p for p in paths if scraper.in_shard(p, (i, 3))] for i in (1, 2, 3)]
+
+        # every file is in exactly one shard, together with the rest of its folder
+        assert sorted(sum(shards, [])) == sorted(paths)
+        assert all(shards)
+        for shard in shards:
+            folders = set(os.path.dirname(p) for p in shard)
+            assert len(shard) == 3 * len(folders)
+        assert all(scraper.in_shard(p, None) for p in paths)
+        assert scraper.in_shard("movie.mp4", (2, 3)) == scraper.dir_in_shard("", (2, 3))
+
+    def test_pipeline(self):
+        results = []
+
+        def on_result(result):
+            # a slow consumer, the workers have to wait for it
+            time.sleep(0.001)
+            results.append(result)
+
+        p = pipeline.Pipeline([
+            pipeline.Stage("first", square_stage, 2, queue_size=10),
+            pipeline.Stage("second", square_stage, 2, queue_size=10),
+        ], results_size=4)
+        p.run(range(100), on_result)
+
+        # odd numbers go on to the second stage as the next even number
+        assert sorted(results) == sorted([("square", x, x * x) for x in range(100)] +
+                                         [("square", x + 1, (x + 1) ** 2) for x in range(1, 100, 2)])
+
+        ipc = p.ipc_stats()
+        assert ipc["results"] == 150 and ipc["result_bytes"] > 0
+        assert ipc["max_depth"] <= 4
+
+    def test_run_report(self):
+        report = runreport.RunReport(slowest=2)
+        with report.phase("index"):
+            time.sleep(0.01)
+        for (i, seconds) in enumerate([0.5, 3.0, 1.0]):
+            report.file("probe", "{}.mp4".format(i), seconds, 1000)
+        report.stage("write", files=3, seconds=0.2, failed=1)
+        # one file whose bytes couldn't be counted makes the stage's bytes unknown
+        report.file("thumb", "0.mp4", 1.0, 1000)
+        report.file("thumb", "1.mp4", 1.0, None)
+        report.count("inserted", 3)
+        report.gauge("peak_rss_bytes", 1 << 20)
+        report.finish()
+
+        summary = report.summary()
+        assert summary["phases"]["index"] >= 0.01
+        assert summary["stages"]["probe"]["files"] == 3 and summary["stages"]["probe"]["bytes"] == 3000
+        assert summary["stages"]["probe"]["seconds"] == 4.5
+        assert summary["stages"]["write"]["failed"] == 1
+        assert summary["stages"]["thumb"]["bytes"] is None and summary["stages"]["thumb"]["bytes_per_second"] is None
+        assert summary["slowest"]["probe"] == [{"path": "1.mp4", "seconds": 3.0}, {"path": "2.mp4", "seconds": 1.0}]
+
+        root = tempfile.mkdtemp()
+        try:
+            report.write_json(os.path.join(root, "report.json"))
+            with open(os.path.join(root, "report.json")) as f:
+                assert json.load(f)["counts"] == {"inserted": 3}
+
+            report.write_prometheus(os.path.join(root, "report.prom"))
+            with open(os.path.join(root, "report.prom")) as f:
+                lines = f.read().splitlines()
+            assert 'mastodon_scraper_stage_files{stage="probe"} 3' in lines
+            assert not [line for line in lines if line.startswith('mastodon_scraper_stage_bytes{stage="thumb"}')]
+            assert 'mastodon_scraper_count{kind="inserted"} 3' in lines
+            assert "mastodon_scraper_peak_rss_bytes 1048576" in lines
+            assert sorted(os.listdir(root)) == ["report.json", "report.prom"]
+        finally:
+            shutil.rmtree(root)
+
+    def test_pipeline_flush(self):
+        # the items a worker hands on right before it is done must not be lost
+        for _ in range(3):
+            results = []
+            p = pipeline.Pipeline([
+                pipeline.Stage("slow", slow_stage, 4, queue_size=100),
+                pipeline.Stage("last", last_stage, 1, queue_size=100),
+            ])
+            p.run(range(40), results.append)
+            assert sorted(results) == list(range(40))
+
+    def test_probe_memo(self):
+        probed = []
+
+        def probe(filename, mime=None):
+            probed.append(filename)
+            return ({"format": {"filename": filename, "duration": "10.0"}}, {"seconds": 0.1})
+
+        old_probe = scraper.videoinfo.probe
+        scraper.videoinfo.probe = probe
+        manager = scraper.Manager()
+        try:
+            memo = scraper.ProbeMemo(manager, size=1)
+
+            (mediainfo, stats) = memo.probe(b'\x00'*32, "/a.mp4")
+            assert stats and mediainfo["format"]["filename"] == "/a.mp4"
+
+            # a copy reuses the result, with its own filename
+            (mediainfo, stats) = memo.probe(b'\x00'*32, "/b.mp4")
+            assert stats is None and mediainfo["format"]["filename"] == "/b.mp4"
+            assert probed == ["/a.mp4"]
+
+            # the memo is full, other contents are still probed
+            memo.probe(b'\x01'*32, "/c.mp4")
+            memo.probe(b'\x01'*32, "/d.mp4")
+            assert probed == ["/a.mp4", "/c.mp4", "/d.mp4"]
+
+            # results resumed from the journal are not probed again, but count as a first probe
+            memo.preload({b'\x02'*32: {"format": {"duration": "5.0"}}})
+            (mediainfo, stats) = memo.probe(b'\x02'*32, "/e.mp4")
+            assert mediainfo == {"format": {"duration": "5.0"}} and stats["attempts"] == 0
+            assert probed == ["/a.mp4", "/c.mp4", "/d.mp4"]
+        finally:
+            scraper.videoinfo.probe = old_probe
+            manager.shutdown()
+
+    def test_probe_memo_claims(self):
+        probed = []
+
+        def probe(filename, mime=None):
+            probed.append(filename)
+            if "slow" in filename:
+                time.sleep(0.5)
+            if "broken" in filename:
+                return ({}, {"seconds": 0.1})
+            return ({"format": {"filename": filename}}, {"seconds": 0.1})
+
+        indexed = {b'\x05'*32: {"format": {"filename": "/indexed.mp4"}}}
+
+        old_probe = scraper.videoinfo.probe
+        scraper.videoinfo.probe = probe
+        manager = scraper.Manager()
+        try:
+            memo = scraper.ProbeMemo(manager, lookup=indexed.get)
+
+            # a slow probe only holds up the copies of its own sha, not the shas sharing its lock
+            results = {}
+            slow = threading.Thread(target=lambda: results.update(slow=memo.probe(b'\x00'*32, "/slow.mp4")))
+            slow.start()
+            time.sleep(0.1)
+            copy = threading.Thread(target=lambda: results.update(copy=memo.probe(b'\x00'*32, "/copy.mp4")))
+            copy.start()
+            start = time.time()
+            memo.probe(b'\x00' + b'\x01'*31, "/other.mp4")
+            assert time.time() - start < 0.3
+            slow.join()
+            copy.join()
+            assert results["copy"] == ({"format": {"filename": "/copy.mp4"}}, None)
+            assert "/copy.mp4" not in probed
+
+            # a failed probe is not reused, every copy is probed itself
+            memo.probe(b'\x02'*32, "/broken1.mp4")
+            memo.probe(b'\x02'*32, "/broken2.mp4")
+            assert probed[-2:] == ["/broken1.mp4", "/broken2.mp4"]
+
+            # a content that is indexed already is taken from the db
+            (mediainfo, stats) = memo.probe(b'\x05'*32, "/new_copy.mp4")
+            assert mediainfo == {"format": {"filename": "/new_copy.mp4"}} and stats is None
+            assert "/new_copy.mp4" not in probed
+        finally:
+            scraper.videoinfo.probe = old_probe
+            manager.shutdown()
+
+    def test_use_pyav_warns_once(self):
+        (old_backend, old_av) = (videoinfo.PROBE_BACKEND, videoinfo.av)
+        videoinfo.PROBE_BACKEND = "pyav"
+        videoinfo.av = None
+        videoinfo._warned_no_pyav = False
+        try:
+            with self.assertLogs(level="WARNING") as logs:
+                assert not videoinfo.use_pyav()
+                assert not videoinfo.use_pyav()
+            assert len(logs.output) == 1
+        finally:
+            (videoinfo.PROBE_BACKEND, videoinfo.av) = (old_backend, old_av)
+            videoinfo._warned_no_pyav = False
+
+    def test_probe_kill(self):
+        old_timeout = videoinfo.PROBE_TIMEOUT
+        videoinfo.PROBE_TIMEOUT = 0.2
+        root = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(root, "data")
+            with open(filename, "wb") as f:
+                f.write(os.urandom(100000))
+
+            process = subprocess.Popen(["cat", filename], stdout=subprocess.PIPE, start_new_session=True)
+            (output, status, rchar, timed_out) = videoinfo._reap(process.pid, process.stdout)
+            process.returncode = 0
+            assert len(output) == 100000 and not timed_out
+            assert rchar is None or rchar >= 100000
+
+            process = subprocess.Popen(["sleep", "10"], stdout=subprocess.PIPE, start_new_session=True)
+            (_, status, _, timed_out) = videoinfo._reap(process.pid, process.stdout)
+            process.returncode = -9
+            assert timed_out
+
+            # killed by someone else, like the oom killer, is no timeout
+            process = subprocess.Popen(["sh", "-c", "kill -9 $$"], stdout=subprocess.PIPE, start_new_session=True)
+            (_, status, _, timed_out) = videoinfo._reap(process.pid, process.stdout)
+            process.returncode = -9
+            assert os.WIFSIGNALED(status) and not timed_out
+
+            # PyAV runs in a forked child, which is killed like ffprobe
+            old_pyav_probe = videoinfo.pyav_probe
+
+            def pyav_probe(filename, probesize=None, analyzeduration=None, stats=None):
+                if "slow" in filename:
+                    time.sleep(10)
+                if "exit" in filename:
+                    raise SystemExit()
+                stats["bytes_read"] += 10
+                return {"format": {"filename": filename}}
+
+            videoinfo.pyav_probe = pyav_probe
+            try:
+                stats = {"bytes_read": 0}
+                assert videoinfo.pyav_forked("/a.mp4", stats=stats) == {"format": {"filename": "/a.mp4"}}
+                assert stats["bytes_read"] == 10
+                start = time.time()
+                self.assertRaises(videoinfo.ProbeTimeout, videoinfo.pyav_forked, "/slow.mp4")
+                assert time.time() - start < 5
+                # not even a BaseException gets the child out of pyav_forked, it exits and the probe fails
+                pid = os.getpid()
+                self.assertRaises(RuntimeError, videoinfo.pyav_forked, "/exit.mp4")
+                assert os.getpid() == pid
+            finally:
+                videoinfo.pyav_probe = old_pyav_probe
+        finally:
+            videoinfo.PROBE_TIMEOUT = old_timeout
+            shutil.rmtree(root)
+
+    @unittest.skipUnless(videoinfo.av and shutil.which("ffprobe") and shutil.which("ffmpeg"),
+                         "needs PyAV, ffprobe and ffmpeg")
+    def test_probe_backends(self):
+        root = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(root, "sample.mkv")
+            subprocess.check_output(["ffmpeg", "-v", "quiet",
+                                     "-f", "lavfi", "-i", "testsrc=duration=3:size=320x240:rate=25",
+                                     "-f", "lavfi", "-i", "sine=duration=3:sample_rate=48000",
+                                     "-metadata", "title=Sample", "-c:v", "mpeg4", "-c:a", "mp2",
+                                     filename])
+
+            expected = videoinfo.ffprobe_subprocess(filename)
+            actual = videoinfo.pyav_probe(filename)
+            assert videoinfo.pyav_forked(filename) == actual
+
+            # PyAV fills in a subset of ffprobe's keys, the ones the index uses have to match
+            assert set(actual["format"]) <= set(expected["format"])
+            for key in ["filename", "nb_streams", "format_name", "size", "tags"]:
+                assert actual["format"][key] == expected["format"][key], key
+            assert abs(float(actual["format"]["duration"]) - float(expected["format"]["duration"])) < 0.1
+
+            assert len(actual["streams"]) == len(expected["streams"])
+            for (a, e) in zip(actual["streams"], expected["streams"]):
+                assert set(a) <= set(e)
+                for key in ["index", "codec_name", "codec_type", "width", "height", "sample_rate", "channels"]:
+                    assert a.get(key) == e.get(key), key
+
+            assert title_from_mediainfo(actual) == title_from_mediainfo(expected) == "Sample"
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_probe_escalation(self):
+        limits = []
+
+        def probe_once(filename, probesize, analyzeduration, stats):
+            limits.append(probesize)
+            stats["bytes_read"] += probesize
+            # the parameters of the audio stream are only found with wider limits
+            return {"streams": [{"codec_type": "video", "codec_name": "h264", "width": 1920},
+                                {"codec_type": "audio", "codec_name": "aac", "channels": 2 if len(limits) > 1 else 0}]}
+
+        old_probe_once = videoinfo.probe_once
+        videoinfo.probe_once = probe_once
+        try:
+            (mediainfo, stats) = videoinfo.probe("/a.ts", "video/mp2t")
+        finally:
+            videoinfo.probe_once = old_probe_once
+
+        profile = videoinfo.PROBE_PROFILES["video/mp2t"]
+        assert limits == [profile["probesize"], profile["probesize"] * videoinfo.PROBE_ESCALATION]
+        assert mediainfo["streams"][1]["channels"] == 2
+        assert stats["attempts"] == 2 and stats["bytes_read"] == sum(limits)
+
+        # no media at all is not retried
+        assert not videoinfo.incomplete({})
+        assert videoinfo.incomplete({"streams": [{"codec_type": "video", "codec_name": "h264", "width": 0}]})
+        assert not videoinfo.incomplete({"streams": [{"codec_type": "subtitle"}]})
+
+
+    def test_daemon_survives_errors(self):
+        class Stop(BaseException):
+            pass
+
+        class FakeWatcher:
+            def __init__(self, *args, **kwargs):
+                self.overflowed = False
+                self.batches = [None, (["index/a.mp4"], [])]
+
+            def poll(self, timeout):
+                return self.batches.pop(0) if self.batches else None
+
+        calls = []
+
+        def sync(paths, dirs, workers=None, shard=None):
+            calls.append("sync")
+            raise RuntimeError("db went away")
+
+        def reconcile(workers=None, shard=None):
+            calls.append("reconcile")
+            if calls.count("reconcile") > 1:
+                raise Stop()
+            raise RuntimeError("db went away")
+
+        old = (scraper.watcher.Watcher, scraper.sync, scraper.reconcile)
+        (scraper.watcher.Watcher, scraper.sync, scraper.reconcile) = (FakeWatcher, sync, reconcile)
+        try:
+            with self.assertLogs(level="ERROR"):
+                with self.assertRaises(Stop):
+                    scraper.daemon()
+        finally:
+            (scraper.watcher.Watcher, scraper.sync, scraper.reconcile) = old
+
+        # the failed first walk doesn't stop the daemon, the failed sync makes it walk again right away
+        assert calls == ["reconcile", "sync", "reconcile"]
+
+    def test_coalescer(self):
+        coalescer = watcher.Coalescer(settle=0.05, max_delay=10)
+        assert not coalescer.due()
+
+        coalescer.add_file("a/clip.mp4")
+        coalescer.add_file("a/clip.mp4")
+        coalescer.add_file("b/c/movie.mp4")
+        coalescer.add_dir("b")
+        assert not coalescer.due()
+
+        time.sleep(0.1)
+        assert coalescer.due()
+        # b is walked as a whole anyway
+        assert coalescer.take() == (["a/clip.mp4"], ["b"])
+        assert not coalescer.due()
+
+    @unittest.skipUnless(watcher.available(), "needs inotify")
+    def test_watcher(self):
+        mount = tempfile.mkdtemp()
+        root = os.path.join(mount, "index")
+        os.makedirs(os.path.join(root, "a"))
+        fs_watcher = watcher.Watcher(root, mount, scraper.classify_file, settle=0.1, max_delay=10)
+
+        def wait_for_batch():
+            for _ in range(50):
+                batch = fs_watcher.poll(timeout=0.1)
+                if batch:
+                    return batch
+            return None
+
+        try:
+            with open(os.path.join(root, "a", "clip.mp4"), "w") as f:
+                f.write("clip")
+            open(os.path.join(root, "a", "notes.unknownext"), "w").close()
+            os.rename(os.path.join(root, "a", "clip.mp4"), os.path.join(root, "a", "moved.mp4"))
+            os.makedirs(os.path.join(root, "b", "c"))
+            assert wait_for_batch() == (["index/a/clip.mp4", "index/a/moved.mp4"], ["index/b"])
+
+            # the new folders are watched as well
+            with open(os.path.join(root, "b", "c", "movie.mp4"), "w") as f:
+                f.write("movie")
+            os.remove(os.path.join(root, "a", "moved.mp4"))
+            assert wait_for_batch() == (["index/a/moved.mp4", "index/b/c/movie.mp4"], [])
+
+            assert scraper.get_files_below(["index/a/moved.mp4", "index/a/notes.unknownext"], []) == []
+            scraper.PATH_TO_MOUNT, old_mount = mount, scraper.PATH_TO_MOUNT
+            try:
+                files = scraper.get_files_below(["index/a/moved.mp4"], ["index/b"])
+            finally:
+                scraper.PATH_TO_MOUNT = old_mount
+            assert [f[0] for f in files] == ["index/b/c/movie.mp4"]
+            assert not fs_watcher.overflowed
+        finally:
+            fs_watcher.close()
+            shutil.rmtree(mount)
 
 
 if __name__ == '__main__':
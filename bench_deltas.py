@@ -0,0 +1,61 @@
+#!venv/bin/python
+"""\
+benchmarks scraper.get_deltas with synthetic db and filesystem listings
+
+usage: ./bench_deltas.py [number of entries]
+"""
+
+import sys
+import time
+import random
+import scraper
+
+
+def synthetic_listings(n):
+    """\
+    returns a db and a filesystem listing with n entries each
+    1% of the files are new, 1% are gone and 1% have changed since the last run
+    """
+    database_files = []
+    filesystem_files = []
+
+    for i in range(n):
+        path = "movies/{:04d}/file-{:08d}.mkv".format(i % 1000, i)
+        r = random.random()
+
+        if r < 0.01:
+            # only in db
+            database_files.append((path, "video/x-matroska", 1000))
+        elif r < 0.02:
+            # only in fs
+            filesystem_files.append((path, "video/x-matroska", 1000))
+        elif r < 0.03:
+            database_files.append((path, "video/x-matroska", 1000))
+            filesystem_files.append((path, "video/x-matroska", 2000))
+        else:
+            database_files.append((path, "video/x-matroska", 1000))
+            filesystem_files.append((path, "video/x-matroska", 1000))
+
+    random.shuffle(database_files)
+    random.shuffle(filesystem_files)
+
+    return (database_files, filesystem_files)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    random.seed(0)
+    (database_files, filesystem_files) = synthetic_listings(n)
+
+    start = time.perf_counter()
+    (to_insert, to_update, to_delete) = scraper.get_deltas(database_files, filesystem_files)
+    elapsed = time.perf_counter() - start
+
+    print("entries: {} db, {} fs".format(len(database_files), len(filesystem_files)))
+    print("deltas: {} insert, {} update, {} delete".format(len(to_insert), len(to_update), len(to_delete)))
+    print("get_deltas: {:.3f}s ({:.0f} entries/s)".format(elapsed, (len(database_files) + len(filesystem_files)) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
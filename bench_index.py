@@ -0,0 +1,117 @@
+#!venv/bin/python
+"""\
+measures the scraper's hash and probe stages end to end with a mocked ffprobe, on generated files
+
+first compares sending a Media instance to the main process with sending a dbwriter.MediaRecord,
+then runs the pipeline with a main process that takes results slower than the workers produce them,
+like a db writer that fell behind, once with the bounded results queue and once with an unbounded one
+and prints the peak RSS of the main process after each, which only ever grows, so the bounded queue runs first
+and the growth of the second run is what the unbounded queue costs
+
+usage: ./bench_index.py [number of files] [seconds per result in the main process]
+"""
+
+import os
+import sys
+import time
+import pickle
+import shutil
+import tempfile
+import functools
+from multiprocessing import Manager, cpu_count
+from api.models import Media
+from config import SCRAPER_RESULTS_QUEUE_SIZE
+import dbwriter
+import pipeline
+import scraper
+import videoinfo
+
+MEDIAINFO = {
+    "format": {"filename": "", "format_name": "mp3", "duration": "215.170000", "size": "4096",
+               "bit_rate": "320000", "tags": {"title": "Title", "artist": "Artist", "album": "Album"}},
+    "streams": [{"index": 0, "codec_type": "audio", "codec_name": "mp3", "sample_rate": "44100",
+                 "channels": 2, "channel_layout": "stereo", "bit_rate": "320000", "time_base": "1/14112000",
+                 "duration": "215.170000"}],
+}
+
+
+def mocked_probe(filename, mime=None):
+    return (MEDIAINFO, {"seconds": 0.0, "bytes_read": 0, "attempts": 1, "timed_out": False})
+
+
+def fields(i):
+    return dict(path="bench/{:08d}.mp3".format(i), mediainfo=MEDIAINFO, lastModified=1, mimetype="audio/mpeg",
+                timeLastIndexed=1, sha=i.to_bytes(32, "big"), size=4096, inode=i)
+
+
+def serialization(n):
+    for (name, make) in [("Media instance", lambda i: Media(**fields(i))),
+                         ("MediaRecord", lambda i: dbwriter.MediaRecord(**fields(i)))]:
+        objects = [make(i) for i in range(n)]
+
+        start = time.perf_counter()
+        data = [pickle.dumps(o, pickle.HIGHEST_PROTOCOL) for o in objects]
+        dumped = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for d in data:
+            pickle.loads(d)
+        loaded = time.perf_counter() - start
+
+        print("{}: {:.0f} bytes, {:.1f}us to pickle, {:.1f}us to unpickle".format(
+            name, sum(len(d) for d in data) / n, 1e6 * dumped / n, 1e6 * loaded / n))
+
+
+def end_to_end(files, delay, results_size):
+    manager = Manager()
+    indexer = pipeline.Pipeline([
+        pipeline.Stage("hash", functools.partial(scraper.hash_medium, {}), 2),
+        pipeline.Stage("probe", functools.partial(scraper.probe_medium, scraper.ProbeMemo(manager, size=0)),
+                       cpu_count()),
+    ], results_size=results_size)
+
+    def on_result(result):
+        if result[0] == "probed":
+            time.sleep(delay)
+
+    start = time.perf_counter()
+    indexer.run(files, on_result)
+    elapsed = time.perf_counter() - start
+    manager.shutdown()
+
+    ipc = indexer.ipc_stats()
+    print("results queue of {}: {:.0f} files/s, at most {} results queued, {:.1f}us to pickle, "
+          "{:.1f}us to unpickle, peak RSS {} MB".format(
+              results_size or "unbounded size", len(files) / elapsed, ipc["max_depth"],
+              1e6 * ipc["serialize_seconds"] / ipc["results"], 1e6 * ipc["deserialize_seconds"] / ipc["results"],
+              scraper.peak_rss() >> 20))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+
+    serialization(n)
+
+    # the workers are forked, they inherit the mock
+    videoinfo.probe = mocked_probe
+
+    root = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(n):
+            path = os.path.join(root, "{:08d}.mp3".format(i))
+            with open(path, "wb") as f:
+                f.write(os.urandom(4096))
+            # absolute paths stay as they are when joined to PATH_TO_MOUNT
+            files.append((path, "audio/mpeg", 1, 4096, i))
+
+        # peak RSS is monotonic, the bounded run has to come first
+        end_to_end(files, delay, SCRAPER_RESULTS_QUEUE_SIZE)
+        end_to_end(files, delay, 0)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!venv/bin/python
+"""\
+compares the probes per second of the ffprobe binary, of PyAV in process and of PyAV in a forked child,
+the way the scraper runs it
+
+usage: ./bench_probe.py file [file ...]
+"""
+
+import sys
+import time
+import videoinfo
+
+ROUNDS = 5
+
+
+def timed(name, probe, filenames):
+    probe(filenames[0])
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for filename in filenames:
+            probe(filename)
+    elapsed = time.perf_counter() - start
+    print("{}: {:.1f} probes/s".format(name, ROUNDS * len(filenames) / elapsed))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    filenames = sys.argv[1:]
+
+    timed("ffprobe subprocess", videoinfo.ffprobe_subprocess, filenames)
+    if videoinfo.av:
+        timed("pyav in process", videoinfo.pyav_probe, filenames)
+        timed("pyav forked", videoinfo.pyav_forked, filenames)
+    else:
+        print("pyav: PyAV is not installed")
+
+
+if __name__ == "__main__":
+    main()
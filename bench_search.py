@@ -0,0 +1,104 @@
+#!venv/bin/python
+"""\
+times the codec, width, height and free text search filters on a synthetic library
+
+runs against the database configured in config_test, the tables are created and dropped by this script
+usage: ./bench_search.py [number of media]
+"""
+
+import sys
+import time
+from sqlalchemy import text
+from api import app, db
+from api.models import search_media, get_or_create_category, relevance
+import db_backfill
+
+# roughly the mix of a real library: mostly h264/aac, some hevc, a few old codecs
+generate_media = """\
+    INSERT INTO media (path, mediainfo, "lastModified", mimetype, "timeLastIndexed", sha, category_id)
+    SELECT 'bench/' || words[1 + i % 17] || '.' || words[1 + (i / 17) % 19] || '.' ||
+           words[1 + (i / 323) % 23] || '/' || i || '.mkv',
+           jsonb_build_object('format', jsonb_build_object('duration', '5400.0'),
+                              'streams', jsonb_build_array(
+                                  jsonb_build_object('index', 0, 'codec_type', 'video',
+                                                     'codec_name', (ARRAY['h264', 'h264', 'h264', 'hevc', 'mpeg4'])[1 + i % 5],
+                                                     'width', (ARRAY[640, 1280, 1920, 3840])[1 + i % 4],
+                                                     'height', (ARRAY[360, 720, 1080, 2160])[1 + i % 4]),
+                                  jsonb_build_object('index', 1, 'codec_type', 'audio',
+                                                     'codec_name', (ARRAY['aac', 'aac', 'ac3', 'mp3'])[1 + i % 4]))),
+           0, 'video/x-matroska', 0, decode(lpad(to_hex(i), 64, '0'), 'hex'), :category_id
+    FROM generate_series(1, :n) AS i,
+         (SELECT ARRAY['star', 'wars', 'return', 'of', 'the', 'jedi', 'breaking', 'bad', 'lost', 'dark',
+                       'knight', 'rises', 'empire', 'strikes', 'back', 'new', 'hope', 'last', 'crusade',
+                       'temple', 'doom', 'lord', 'rings'] AS words) AS w
+"""
+
+# free text queries with 1, 2 and 4 words
+text_queries = ["star", "star wars", "star wars empire strikes"]
+
+# the filters as they were before media_stream existed
+legacy_codec = """\
+    SELECT count(1) FROM media WHERE
+    (SELECT COUNT(1) FROM jsonb_array_elements(mediainfo -> 'streams') AS stream
+     WHERE stream ->> 'codec_name' = 'hevc') > 0
+    AND (SELECT COUNT(1) FROM jsonb_array_elements(mediainfo -> 'streams') AS stream
+     WHERE stream ->> 'codec_name' = 'ac3') > 0
+"""
+
+legacy_width = """\
+    SELECT count(1) FROM media WHERE
+    (SELECT COUNT(1) FROM jsonb_array_elements(mediainfo -> 'streams') AS stream
+     WHERE (stream ->> 'width') >= '1920') > 0
+"""
+
+
+def timed(name, f, repeat=5):
+    f()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = f()
+    elapsed = (time.perf_counter() - start) / repeat
+    print("{}: {:.1f}ms ({} matches)".format(name, elapsed * 1000, result))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+
+    app.config.from_object("config_test")
+    db.create_all()
+
+    try:
+        category = get_or_create_category("bench")
+        db.session.execute(text(generate_media), {"n": n, "category_id": category.category_id})
+        db.session.commit()
+
+        db_backfill.backfill()
+        db.session.execute("ANALYZE media")
+        db.session.execute("ANALYZE media_stream")
+
+        timed("legacy codecs hevc AND ac3", lambda: db.session.execute(legacy_codec).scalar())
+        timed("media_stream codecs hevc AND ac3",
+              lambda: search_media(codecs=[["hevc", "ac3"]], limit=100)[0])
+
+        timed("legacy width >= 1920 (string comparison)", lambda: db.session.execute(legacy_width).scalar())
+        timed("media_stream width >= 1920", lambda: search_media(width=1920, limit=100)[0])
+        timed("media_stream width >= 1920 AND height >= 2160",
+              lambda: search_media(width=1920, height=2160, limit=100)[0])
+
+        for q in text_queries:
+            timed("q={!r} trigram index".format(q), lambda: search_media(query=q, limit=100)[0])
+            timed("q={!r} trigram index, by relevance".format(q),
+                  lambda: search_media(query=q, order_by=relevance(q), limit=100)[0])
+
+        db.session.execute("DROP INDEX ix_media_path_trgm")
+        db.session.execute("DROP INDEX ix_media_title_trgm")
+        for q in text_queries:
+            timed("q={!r} without trigram index".format(q), lambda: search_media(query=q, limit=100)[0])
+        db.session.rollback()
+    finally:
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
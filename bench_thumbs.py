@@ -0,0 +1,73 @@
+#!venv/bin/python
+"""\
+compares the wall time per video of the single pass thumbnail strip with the old approach
+(ffprobe for the length, one ffmpeg per frame into a temp folder, ImageMagick convert to append them)
+
+usage: ./bench_thumbs.py video [video ...]
+"""
+
+import os
+import sys
+import time
+import glob
+import shutil
+import tempfile
+import subprocess
+import thumbs
+
+
+def legacy_thumb(out_dir, filename, frames):
+    length = thumbs.getLength(filename)
+    if not length:
+        return
+
+    times = thumbs.getFrameTimes(length, frames)
+    frame_dir = os.path.join(out_dir, "frames")
+    os.makedirs(frame_dir)
+
+    for t in times:
+        subprocess.check_output(["ffmpeg", "-v", "quiet", "-ss", str(int(t)),
+                                 "-i", filename, "-vf", "scale=320:-1",
+                                 "-vframes", "1", "-f", "image2",
+                                 os.path.join(frame_dir, "out-%08d.jpg" % t)],
+                                timeout=60)
+
+    subprocess.check_output(["convert", "+append"] + sorted(glob.glob(os.path.join(frame_dir, "out-*.jpg"))) +
+                            [os.path.join(out_dir, "legacy.jpg")])
+    shutil.rmtree(frame_dir)
+
+
+def single_pass_thumb(out_dir, filename, frames):
+    # like the scraper, the length is already known from videoinfo.ffprobe
+    length = thumbs.getLength(filename)
+    start = time.perf_counter()
+
+    thumbs.PATH_TO_THUMBNAILS = out_dir
+    thumbs.generateThumb("single", filename, length=length, frames=frames)
+
+    return time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    frames = thumbs.THUMBNAIL_FRAMES
+
+    for filename in sys.argv[1:]:
+        out_dir = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            legacy_thumb(out_dir, filename, frames)
+            legacy = time.perf_counter() - start
+
+            single = single_pass_thumb(out_dir, filename, frames)
+
+            print("{}: before {:.2f}s, after {:.2f}s ({:.1f}x)".format(filename, legacy, single, legacy / single))
+        finally:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    main()
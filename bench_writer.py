@@ -0,0 +1,64 @@
+#!venv/bin/python
+"""\
+compares rows per second of the batched MediaWriter with committing every medium on its own
+
+runs against the database configured in config_test, the tables are created and dropped by this script
+usage: ./bench_writer.py [number of rows]
+"""
+
+import sys
+import time
+from api import app, db
+from api.models import Media, get_or_create_category
+import dbwriter
+
+
+def synthetic_media(n, prefix):
+    for i in range(n):
+        yield (Media(path="{}/{:08d}.mkv".format(prefix, i),
+                     mediainfo={"format": {"duration": "5400.0"},
+                                "streams": [{"index": 0, "codec_type": "video", "codec_name": "h264",
+                                             "width": 1920, "height": 1080},
+                                            {"index": 1, "codec_type": "audio", "codec_name": "aac"}]},
+                     lastModified=int(time.time()),
+                     mimetype="video/x-matroska",
+                     timeLastIndexed=int(time.time()),
+                     sha=i.to_bytes(32, "big"),
+                     size=i,
+                     inode=i),
+               ["movie", "series", "uncategorized"][i % 3])
+
+
+def commit_per_row(n):
+    for (medium, category) in synthetic_media(n, "single"):
+        medium.category = get_or_create_category(category)
+        db.session.add(medium)
+        db.session.commit()
+
+
+def batched(n):
+    writer = dbwriter.MediaWriter()
+    for (medium, category) in synthetic_media(n, "batched"):
+        writer.add(medium, category)
+    writer.flush()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    app.config.from_object("config_test")
+    db.create_all()
+
+    try:
+        for (name, f) in [("commit per row", commit_per_row), ("MediaWriter", batched)]:
+            start = time.perf_counter()
+            f(n)
+            elapsed = time.perf_counter() - start
+            print("{}: {} rows in {:.2f}s, {:.0f} rows/s".format(name, n, elapsed, n / elapsed))
+    finally:
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,14 +18,101 @@ SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, "db_repository")
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# number of api responses kept in the in-process response cache
+RESPONSE_CACHE_SIZE = 1024
+
+# rows fetched per round trip by the server side cursor of /v1/export
+EXPORT_BATCH_SIZE = 1000
+
+# longest a client may wait on /v1/changes for new changes, in seconds
+CHANGES_MAX_WAIT = 30
+# how often a waiting request looks for new changes, in seconds
+CHANGES_POLL_INTERVAL = 1
+
 URL_TO_MOUNT = ""
 # PATH_TO_MOUNT should be public mammut's root folder
 PATH_TO_MOUNT = ""
 INDEX_FOLDER = ""
 
 THUMBNAIL_ROOT_URL = ""
+# "ffprobe" runs the ffprobe binary for every file, "pyav" probes files in process with PyAV
+# and "auto" uses PyAV if it is installed. files PyAV can't open are always handed to ffprobe.
+# PyAV only fills in the subset of ffprobe's keys the index uses (the format's name, duration, size,
+# bit rate and tags, the streams' codec, time base, duration, size, pixel format, frame rate,
+# sample rate, channels, bit rate and tags), so the stored mediainfo of a PyAV probe is smaller
+PROBE_BACKEND = "ffprobe"
+# how much of a file is read (probesize, bytes) and analyzed (analyzeduration, microseconds)
+# to find its streams, by mimetype, by the part before the slash of it or "default"
+PROBE_PROFILES = {
+    "default": {"probesize": 5000000, "analyzeduration": 5000000},
+    # transport stream dumps often start with a while of only some of their streams
+    "video/mp2t": {"probesize": 10000000, "analyzeduration": 10000000},
+    "audio": {"probesize": 1000000, "analyzeduration": 2000000},
+    "image": {"probesize": 1000000, "analyzeduration": 1000000},
+}
+# a file whose audio or video streams are missing or incomplete is probed again with limits
+# PROBE_ESCALATION times as wide, up to PROBE_ATTEMPTS times. a probe is killed after PROBE_TIMEOUT seconds
+PROBE_ESCALATION = 8
+PROBE_ATTEMPTS = 3
+PROBE_TIMEOUT = 60
 PATH_TO_THUMBNAILS = ""
+# a thumbnail is a strip of THUMBNAIL_FRAMES frames, each scaled to THUMBNAIL_WIDTH pixels
+THUMBNAIL_FRAMES = 10
+THUMBNAIL_WIDTH = 320
+# "strip" grabs all frames in one ffmpeg run and falls back to "frames" if that fails,
+# "frames" grabs the frames one by one and keeps a partial strip if some of them fail
+THUMBNAIL_MODE = "strip"
+# ffmpeg is killed after THUMBNAIL_TIMEOUT seconds for a whole strip
+# and after THUMBNAIL_FRAME_TIMEOUT seconds for a single frame
+THUMBNAIL_TIMEOUT = 300
+THUMBNAIL_FRAME_TIMEOUT = 60
+# decoder threads per ffmpeg input, keeps parallel thumbnail jobs from oversubscribing the cpus
+THUMBNAIL_THREADS = 2
 
 # dict with category name as key and an array of regex rules video paths belonging to this category have to match
 VIDEO_CATEGORY_RULES = {}
 
+
+# the scraper remembers folder and file stats here to skip unchanged folders on the next run
+# set to None to always walk the whole INDEX_FOLDER
+SCRAPER_MANIFEST_PATH = os.path.join(basedir, "scraper_manifest.pickle")
+
+# the scraper journals the files it hashed and probed but didn't finish here, a run that was killed
+# is resumed from it instead of hashing and probing them again. set to None to not keep a journal
+SCRAPER_JOURNAL_PATH = os.path.join(basedir, "scraper_journal.sqlite")
+
+# after every walk of the whole INDEX_FOLDER the scraper writes a report of where the run spent its time
+# (per phase and stage, files/s, bytes/s and the slowest files) as JSON here, set to None to not write it
+SCRAPER_REPORT_PATH = os.path.join(basedir, "scraper_report.json")
+# the same numbers for the textfile collector of the prometheus node_exporter,
+# e.g. "/var/lib/node_exporter/textfile_collector/mastodon_scraper.prom"
+SCRAPER_PROMETHEUS_PATH = None
+
+# the scraper writes indexed media in batches of this many rows,
+# a smaller batch is written when no full batch was written for SCRAPER_WRITE_FLUSH_INTERVAL seconds
+SCRAPER_WRITE_BATCH_SIZE = 500
+SCRAPER_WRITE_FLUSH_INTERVAL = 5
+
+# the scraper hashes, probes and thumbnails files in separate pools of processes
+# hashing is bound by disk bandwidth (keep it low for spinning disks), probing by cpu (None means one per cpu)
+# and thumbnailing by ffmpeg. every pool takes files from a queue holding at most SCRAPER_STAGE_QUEUE_SIZE files
+SCRAPER_HASH_WORKERS = 2
+SCRAPER_PROBE_WORKERS = None
+SCRAPER_THUMB_WORKERS = 4
+SCRAPER_STAGE_QUEUE_SIZE = 100
+# the workers send their results to the main process through a queue holding at most this many,
+# if writing to the db falls behind they wait instead of piling up results in memory
+SCRAPER_RESULTS_QUEUE_SIZE = 1000
+# ./scraper.py --daemon indexes changes as they happen: a change is indexed once no further change came in
+# for SCRAPER_WATCH_SETTLE seconds, but at most SCRAPER_WATCH_MAX_DELAY seconds after it happened.
+# every SCRAPER_RECONCILE_INTERVAL seconds the whole INDEX_FOLDER is walked for changes that were missed
+SCRAPER_WATCH_SETTLE = 2
+SCRAPER_WATCH_MAX_DELAY = 30
+SCRAPER_RECONCILE_INTERVAL = 6 * 3600
+# files with the same content are probed once per run, the probe results of
+# at most this many distinct contents are kept to be reused for their copies
+SCRAPER_PROBE_MEMO_SIZE = 100000
+# a file that fails to index is retried this many times, waiting SCRAPER_RETRY_BACKOFF seconds
+# before the first retry and doubling the wait for every further one
+SCRAPER_MAX_RETRIES = 2
+SCRAPER_RETRY_BACKOFF = 1
@@ -0,0 +1,74 @@
+#!venv/bin/python
+"""\
+fills columns and tables derived from the mediainfo JSON for media indexed before they existed
+run this once after db_upgrade.py, it only touches rows that are missing the derived data
+"""
+from api import db
+from api.models import Media
+
+# one media_stream row per element of mediainfo -> 'streams' for media without any stream rows yet
+# values that are not numeric (ffprobe sometimes reports "N/A") become NULL
+backfill_streams = """\
+    INSERT INTO media_stream (media_id, stream_index, codec_name, codec_type, width, height, duration)
+    SELECT media.media_id,
+           CASE WHEN stream ->> 'index' ~ '^[0-9]+$' THEN (stream ->> 'index')::integer END,
+           stream ->> 'codec_name',
+           stream ->> 'codec_type',
+           CASE WHEN stream ->> 'width' ~ '^[0-9]+$' THEN (stream ->> 'width')::integer END,
+           CASE WHEN stream ->> 'height' ~ '^[0-9]+$' THEN (stream ->> 'height')::integer END,
+           CASE WHEN stream ->> 'duration' ~ '^[0-9]+(\\.[0-9]*)?$' THEN (stream ->> 'duration')::float END
+    FROM media, jsonb_array_elements(media.mediainfo -> 'streams') AS stream
+    WHERE jsonb_typeof(media.mediainfo -> 'streams') = 'array'
+      AND NOT EXISTS (SELECT 1 FROM media_stream WHERE media_stream.media_id = media.media_id)
+"""
+
+
+# the title tag of the container, see title_from_mediainfo in api/models.py
+backfill_titles = """\
+    UPDATE media SET title = mediainfo #>> '{format,tags,title}'
+    WHERE title IS NULL AND mediainfo #>> '{format,tags,title}' IS NOT NULL
+"""
+
+
+# the precomputed api documents are built in python, this many at a time
+DOCUMENT_BATCH_SIZE = 1000
+
+
+def backfill_api_documents():
+    """\
+    builds the documents that are missing, and rebuilds those that still have url and thumbnail
+    baked in (they are filled in when a document is served now)
+    """
+    count = 0
+    last_id = 0
+    while True:
+        media = Media.query \
+            .filter(Media.media_id > last_id) \
+            .filter(Media.api_document.is_(None) | ~Media.api_document.contains('"url": null', autoescape=True)) \
+            .order_by(Media.media_id) \
+            .limit(DOCUMENT_BATCH_SIZE).all()
+        if not media:
+            return count
+
+        last_id = media[-1].media_id
+
+        for medium in media:
+            medium.api_document = medium.build_api_document()
+        db.session.commit()
+        count += len(media)
+
+
+def backfill():
+    result = db.session.execute(backfill_streams)
+    print("media_stream rows backfilled: {}".format(result.rowcount))
+
+    result = db.session.execute(backfill_titles)
+    print("titles backfilled: {}".format(result.rowcount))
+
+    db.session.commit()
+
+    print("api documents backfilled: {}".format(backfill_api_documents()))
+
+
+if __name__ == "__main__":
+    backfill()
@@ -0,0 +1,183 @@
+import time
+import logging
+from collections import namedtuple
+from sqlalchemy import any_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.expression import bindparam
+from api import db
+from api.models import Media, MediaStream, get_or_create_category, get_tag_names, \
+    streams_from_mediainfo, title_from_mediainfo, record_changes, build_api_document
+from config import SCRAPER_WRITE_BATCH_SIZE, SCRAPER_WRITE_FLUSH_INTERVAL
+
+# what the indexing workers send for a medium instead of a Media instance, a plain tuple pickles
+# fast and small. these are the columns of media that are written by the scraper, except for
+# title which is taken from the mediainfo and category_id which is resolved by the writer
+MediaRecord = namedtuple("MediaRecord", ["path", "mediainfo", "lastModified", "mimetype", "timeLastIndexed",
+                                         "sha", "size", "inode"])
+
+# keys of a buffered row that are not media columns
+EXTRA_KEYS = ("streams", "category")
+
+
+class MediaWriter:
+    """\
+    Buffers indexed media and writes them to the db in batches
+
+    A batch is written with one multi-row INSERT ... ON CONFLICT (path) DO UPDATE,
+    its media_stream rows are replaced with one DELETE and one more INSERT.
+    A batch is written once batch_size rows are buffered or flush_interval
+    seconds passed since the last write.
+    on_written is called with the paths of every batch once it is committed.
+    """
+
+    def __init__(self, batch_size=SCRAPER_WRITE_BATCH_SIZE, flush_interval=SCRAPER_WRITE_FLUSH_INTERVAL,
+                 on_written=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_written = on_written
+
+        self.inserts = []
+        self.updates = []
+        self.last_flush = time.time()
+
+        # category name -> category_id, saves a SELECT per medium
+        self.category_ids = {}
+
+        self.rows_written = 0
+        self.rows_failed = 0
+        # time spent in flush, failed batches included
+        self.write_seconds = 0.0
+
+    def category_id(self, name):
+        if name not in self.category_ids:
+            self.category_ids[name] = get_or_create_category(name).category_id
+        return self.category_ids[name]
+
+    def add(self, medium, category, update=False):
+        """\
+        buffers a MediaRecord, or a Media instance that has not been added to the session
+        update means a row with the same path is already indexed and has to be overwritten
+        """
+        row = {column: getattr(medium, column) for column in MediaRecord._fields}
+        row["title"] = title_from_mediainfo(medium.mediainfo)
+        row["category_id"] = self.category_id(category)
+        # not media columns, _write splits them off
+        row["streams"] = streams_from_mediainfo(medium.mediainfo)
+        row["category"] = category
+
+        # an updated row keeps its tags, _write rebuilds the document of those that have any
+        row["api_document"] = build_api_document(
+            medium.path, medium.mediainfo, category, [], medium.mimetype,
+            medium.lastModified, medium.timeLastIndexed, medium.sha)
+
+        if update:
+            self.updates.append(row)
+        else:
+            self.inserts.append(row)
+
+        if self.pending() >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def pending(self):
+        return len(self.inserts) + len(self.updates)
+
+    def flush_if_due(self):
+        if self.pending() and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        inserts = self.inserts
+        updates = self.updates
+        self.inserts = []
+        self.updates = []
+        self.last_flush = time.time()
+
+        if not inserts and not updates:
+            return
+
+        start = time.time()
+        try:
+            self._write(inserts, updates)
+        except SQLAlchemyError:
+            # one bad row must not cost the whole batch, retry the rows one by one
+            db.session.rollback()
+            logging.warning("Writing batch of {} rows failed, retrying row by row".format(len(inserts) + len(updates)))
+
+            for row in inserts:
+                self._write_single([row], [])
+            for row in updates:
+                self._write_single([], [row])
+        finally:
+            self.write_seconds += time.time() - start
+
+    def _write_single(self, inserts, updates):
+        try:
+            self._write(inserts, updates)
+        except SQLAlchemyError:
+            db.session.rollback()
+            self.rows_failed += 1
+            logging.exception("Error writing medium {}".format((inserts + updates)[0]["path"]))
+
+    def _write(self, inserts, updates):
+        media = Media.__table__
+        media_stream = MediaStream.__table__
+
+        # a path may only be written once per statement, the last row for it wins
+        rows = dict((row["path"], row) for row in inserts + updates)
+        values = [{k: v for (k, v) in row.items() if k not in EXTRA_KEYS} for row in rows.values()]
+
+        # rows that are meant as inserts may exist already as well, e.g. after an interrupted run,
+        # so every row is an upsert keyed on path
+        upsert = postgresql.insert(media).values(values)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[media.c.path],
+            set_=dict((column, upsert.excluded[column]) for column in values[0] if column != "path"))
+        result = db.session.execute(upsert.returning(media.c.media_id, media.c.path))
+        media_ids = dict((path, media_id) for (media_id, path) in result)
+
+        ids = bindparam("ids", value=list(media_ids.values()), type_=postgresql.ARRAY(db.Integer))
+        db.session.execute(media_stream.delete().where(media_stream.c.media_id == any_(ids)))
+
+        stream_rows = []
+        for (path, media_id) in media_ids.items():
+            for stream in rows[path]["streams"]:
+                stream_rows.append(dict(stream, media_id=media_id))
+
+        if stream_rows:
+            db.session.execute(media_stream.insert().values(stream_rows))
+
+        self._retag_documents(rows, media_ids)
+
+        record_changes([(media_id, path, False) for (path, media_id) in media_ids.items()])
+        db.session.commit()
+        self.rows_written += len(rows)
+
+        if self.on_written:
+            self.on_written(list(rows))
+
+    def _retag_documents(self, rows, media_ids):
+        """\
+        the documents were built without tags, rebuilds them for the rows that are tagged
+        only rows that existed before can have tags
+        """
+        media = Media.__table__
+
+        paths = dict((media_id, path) for (path, media_id) in media_ids.items())
+        tag_names = get_tag_names(paths)
+        if not tag_names:
+            return
+
+        documents = []
+        for (media_id, names) in tag_names.items():
+            row = rows[paths[media_id]]
+            documents.append({
+                "b_media_id": media_id,
+                "api_document": build_api_document(
+                    row["path"], row["mediainfo"], row["category"], names, row["mimetype"],
+                    row["lastModified"], row["timeLastIndexed"], row["sha"])
+            })
+
+        db.session.execute(media.update().where(media.c.media_id == bindparam("b_media_id")), documents)
@@ -0,0 +1,127 @@
+import json
+import time
+import sqlite3
+
+
+class Journal:
+    """\
+    Durable record of the scraper's unfinished work, in a local SQLite file
+
+    A file is recorded once it is hashed and again once it is probed. Its row is removed
+    once it is written to the db and, for videos, its thumbnail exists. A run that was
+    killed leaves the rows of everything in flight behind, the next run takes the shas and
+    mediainfo from there instead of hashing and probing again and makes up for the
+    missing thumbnails. A row is only trusted while the file's mtime, size and inode still match.
+
+    Only the main process writes to the journal, the results of the workers arrive there anyway.
+    """
+
+    def __init__(self, path, commit_interval=1):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.last_commit = time.time()
+        # the paths written in this run, their rows are gone or only wait for a thumbnail
+        self.written_paths = set()
+
+        self.connection = sqlite3.connect(path)
+        # the journal only has to survive the scraper, not the machine
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""\
+            CREATE TABLE IF NOT EXISTS work (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER,
+                size INTEGER,
+                inode INTEGER,
+                sha BLOB NOT NULL,
+                mediainfo TEXT,
+                written INTEGER NOT NULL DEFAULT 0,
+                thumb INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.connection.commit()
+
+    def resumable(self, files):
+        """\
+        takes filesystem tuples (path, mime, mtime, size, inode) and returns the journaled work for them
+        as {path: (sha, mediainfo or None)}, leaving out files that changed since they were journaled
+        """
+        rows = dict((row[0], row[1:]) for row in self.connection.execute(
+            "SELECT path, mtime, size, inode, sha, mediainfo FROM work WHERE written = 0"))
+
+        work = {}
+        for f in files:
+            row = rows.get(f[0])
+            if row and tuple(row[:3]) == (f[2], f[3], f[4]):
+                work[f[0]] = (bytes(row[3]), json.loads(row[4]) if row[4] is not None else None)
+        return work
+
+    def pending_thumbs(self):
+        """\
+        returns (sha, path, mediainfo) of the written videos whose thumbnail was never made
+        """
+        return [(bytes(sha), path, json.loads(mediainfo) if mediainfo else {})
+                for (sha, path, mediainfo) in self.connection.execute(
+                    "SELECT sha, path, mediainfo FROM work WHERE written = 1 AND thumb = 1")]
+
+    def retain(self, files, indexed_files):
+        """\
+        forgets the unwritten work for files that are not in files (path, mime, mtime, size, inode) anymore
+        and for those indexed_files (rows like files) has with the same mtime, size and inode,
+        they were deleted or indexed since
+        """
+        rows = set(path for (path,) in self.connection.execute("SELECT path FROM work WHERE written = 0"))
+        on_disk = dict((f[0], tuple(f[2:5])) for f in files if f[0] in rows)
+        indexed = dict((f[0], tuple(f[2:5])) for f in indexed_files if f[0] in on_disk)
+
+        stale = [(path,) for path in rows if path not in on_disk or indexed.get(path) == on_disk[path]]
+        self.connection.executemany("DELETE FROM work WHERE path = ?", stale)
+        self.connection.commit()
+
+    def hashed(self, f, sha):
+        (path, _, mtime, size, inode) = f
+        # the results of the stages can overtake each other, this must not undo probed or written
+        # for the same version of the file, nor bring back the row of a file that was written already
+        if path in self.written_paths:
+            return
+        self.connection.execute("""\
+            INSERT INTO work (path, mtime, size, inode, sha) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                mtime = excluded.mtime, size = excluded.size, inode = excluded.inode, sha = excluded.sha,
+                mediainfo = NULL, written = 0, thumb = 0
+            WHERE (mtime, size, inode) IS NOT (excluded.mtime, excluded.size, excluded.inode)""",
+            (path, mtime, size, inode, sha))
+        self.commit_if_due()
+
+    def probed(self, f, sha, mediainfo, needs_thumb):
+        (path, _, mtime, size, inode) = f
+        self.connection.execute(
+            "INSERT OR REPLACE INTO work (path, mtime, size, inode, sha, mediainfo, thumb) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, mtime, size, inode, sha, json.dumps(mediainfo), int(needs_thumb)))
+        self.commit_if_due()
+
+    def written(self, paths):
+        paths = list(paths)
+        self.written_paths.update(paths)
+        self.connection.executemany("UPDATE work SET written = 1 WHERE path = ?", [(p,) for p in paths])
+        self.connection.execute("DELETE FROM work WHERE written = 1 AND thumb = 0")
+        self.commit()
+
+    def thumbed(self, path):
+        self.connection.execute("UPDATE work SET thumb = 0 WHERE path = ?", (path,))
+        self.connection.execute("DELETE FROM work WHERE path = ? AND written = 1", (path,))
+        self.commit_if_due()
+
+    def pending(self):
+        return self.connection.execute("SELECT count(1) FROM work").fetchone()[0]
+
+    def commit_if_due(self):
+        if time.time() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.last_commit = time.time()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,186 @@
+import os
+import pickle
+import logging
+import time
+
+# bump this whenever the layout of Manifest.dirs changes
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    """\
+    Persistent manifest of a directory tree
+
+    For every directory it remembers the directory's mtime, its subdirectories and
+    a (mime, size, mtime, inode) tuple for every relevant file in it.
+    Adding, removing or renaming an entry bumps the mtime of its parent directory,
+    so a directory with an unchanged mtime does not have to be listed again. Its files
+    are only stat'ed, which is far cheaper than listing it on a network share, that catches
+    files that were overwritten in place without touching their directory.
+    Its subdirectories are still visited, because their mtimes are independent of the parent.
+    Directories a walk doesn't accept are only listed for their subdirectories, their files
+    are stored as None and collected once a walk accepts them.
+    """
+
+    def __init__(self, path=None, root=None):
+        self.path = path
+        self.root = root
+        # dirpath -> (mtime_ns, [subdirpath], {filename: (mime, size, mtime, inode)} or None if not collected)
+        self.dirs = {}
+
+        self.scanned = 0
+        self.pruned = 0
+        self.skipped = 0
+        self.changed = 0
+
+    @classmethod
+    def load(cls, path, root):
+        """\
+        returns the manifest stored in path or an empty one if there is none (or it belongs to another root)
+        """
+        manifest = cls(path, root)
+
+        if not path or not os.path.exists(path):
+            return manifest
+
+        try:
+            with open(path, "rb") as f:
+                (version, stored_root, dirs) = pickle.load(f)
+        except Exception:
+            logging.warning("Could not read manifest '{}', doing a full walk".format(path))
+            return manifest
+
+        if version == MANIFEST_VERSION and stored_root == root:
+            manifest.dirs = dirs
+
+        return manifest
+
+    def save(self):
+        if not self.path:
+            return
+
+        # write to a temporary file first so a crash never leaves a truncated manifest behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((MANIFEST_VERSION, self.root, self.dirs), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def walk(self, classify, full=False, accept_dir=None):
+        """\
+        walks the tree below root and yields (dirpath, filename, (mime, size, mtime, inode)) for every file
+        classify is called with a filename and returns its mime type or None if the file is irrelevant
+        directories whose mtime didn't change since the last walk are served from the manifest unless full is set
+        accept_dir is called with a dirpath, the files of directories it returns False for are neither classified,
+        stat'ed nor yielded, but their subdirectories are still walked
+        """
+        old_dirs = self.dirs
+        self.dirs = {}
+        self.scanned = 0
+        self.pruned = 0
+        self.skipped = 0
+        self.changed = 0
+
+        last_update = 0
+        num_files = 0
+
+        stack = [self.root]
+        while stack:
+            dirpath = stack.pop()
+
+            # stat before listing, a change in between makes the next walk rescan this directory
+            try:
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                logging.error("Error when accessing folder '{}'".format(dirpath))
+                continue
+
+            cached = old_dirs.get(dirpath)
+            if accept_dir and not accept_dir(dirpath):
+                if cached and cached[0] == mtime_ns:
+                    subdirs = cached[1]
+                else:
+                    subdirs = self._subdirs(dirpath)
+                self.dirs[dirpath] = (mtime_ns, subdirs, None)
+                stack.extend(subdirs)
+                self.skipped += 1
+                continue
+
+            if not full and cached and cached[0] == mtime_ns and cached[2] is not None:
+                (_, subdirs, files) = cached
+                files = self._restat(dirpath, files)
+                self.pruned += 1
+            else:
+                (subdirs, files) = self._scan(dirpath, classify, cached)
+                self.scanned += 1
+
+            self.dirs[dirpath] = (mtime_ns, subdirs, files)
+            stack.extend(subdirs)
+
+            for (filename, info) in files.items():
+                yield (dirpath, filename, info)
+
+            num_files += len(files)
+            if time.time() - last_update > 5:
+                last_update = time.time()
+                logging.info("Getting files in FS: {}".format(num_files))
+
+    def _restat(self, dirpath, files):
+        """\
+        returns files of an unchanged directory with fresh stats, a file overwritten in place
+        has a new size or mtime (or inode, if it was replaced by a rename)
+        """
+        fresh = {}
+        for (filename, info) in files.items():
+            try:
+                st = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                # deleted since the directory was stat'ed, the next walk rescans the directory
+                continue
+
+            new_info = (info[0], st.st_size, int(st.st_mtime), st.st_ino)
+            if new_info != info:
+                self.changed += 1
+            fresh[filename] = new_info
+        return fresh
+
+    def _subdirs(self, dirpath):
+        try:
+            return [entry.path for entry in os.scandir(dirpath) if entry.is_dir() and not entry.is_symlink()]
+        except OSError:
+            logging.error("Error when listing folder '{}'".format(dirpath))
+            return []
+
+    def _scan(self, dirpath, classify, cached):
+        subdirs = []
+        files = {}
+        old_files = (cached[2] if cached else None) or {}
+
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            logging.error("Error when listing folder '{}'".format(dirpath))
+            return (subdirs, files)
+
+        for entry in entries:
+            try:
+                # like os.walk, symlinked directories are not followed
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+
+                mime = classify(entry.name)
+                if not mime:
+                    continue
+
+                st = entry.stat()
+                info = (mime, st.st_size, int(st.st_mtime), st.st_ino)
+            except OSError:
+                logging.error("Error when accessing file '{}' in folder '{}':".format(entry.name, dirpath))
+                continue
+
+            if old_files.get(entry.name) != info:
+                self.changed += 1
+            files[entry.name] = info
+
+        return (subdirs, files)
@@ -0,0 +1,270 @@
+import time
+import pickle
+import logging
+import traceback
+import threading
+from multiprocessing import Process, Queue, Value
+from queue import Empty
+
+
+class Stage:
+    """\
+    One step of a Pipeline, run by its own pool of worker processes
+
+    func is called with an item from the stage's queue and returns a tuple (next_item, result) or None.
+    next_item is handed to the next stage, result is sent back to the main process.
+    Either of them may be None. Results should be plain tuples, dicts and such, they are pickled.
+    """
+
+    def __init__(self, name, func, workers, queue_size=100):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+        # bounded, a slow stage makes the stages in front of it wait instead of piling up items
+        self.queue = Queue(maxsize=queue_size)
+
+        # shared counters so the main process can report on the workers
+        self.processed = Value("l", 0)
+        self.failed = Value("l", 0)
+        self.busy = Value("d", 0.0)
+        # results sent to the main process, their pickled size and the time spent pickling them
+        self.results_sent = Value("l", 0)
+        self.result_bytes = Value("l", 0)
+        self.serialize_seconds = Value("d", 0.0)
+
+        self.processes = []
+        self.finished = 0
+
+    def depth(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return -1
+
+
+def call_with_retries(stage, item, retries, backoff):
+    """\
+    calls stage.func on item, retrying with exponential backoff if that fails
+    returns the output of stage.func or None if it failed every time
+    """
+    for attempt in range(retries + 1):
+        try:
+            return stage.func(item)
+        except Exception:
+            if attempt == retries:
+                logging.error("{}: giving up on {!r}".format(stage.name, item))
+                traceback.print_exc()
+                with stage.failed.get_lock():
+                    stage.failed.value += 1
+                return None
+
+            wait = backoff * 2 ** attempt
+            logging.warning("{}: error processing {!r}, retrying in {}s".format(stage.name, item, wait))
+            time.sleep(wait)
+
+
+def send_result(stage, results, result):
+    """\
+    pickles result here rather than in the queue's feeder thread, to measure the time it takes
+    the queue still pickles the ("result", data) tuple again, but pickling a bytes object only copies it
+    blocks while the results queue is full
+    """
+    start = time.time()
+    data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    elapsed = time.time() - start
+
+    with stage.results_sent.get_lock():
+        stage.results_sent.value += 1
+    with stage.result_bytes.get_lock():
+        stage.result_bytes.value += len(data)
+    with stage.serialize_seconds.get_lock():
+        stage.serialize_seconds.value += elapsed
+
+    results.put(("result", data))
+
+
+# This runs in a seperate process
+# It takes items from its stage's queue until it gets a None
+# and then tells the main process that it is done
+def work(stage, next_stage, results, retries, backoff):
+    while True:
+        item = stage.queue.get()
+        if item is None:
+            break
+
+        start = time.time()
+        out = call_with_retries(stage, item, retries, backoff)
+
+        if out:
+            (next_item, result) = out
+            if result is not None:
+                send_result(stage, results, result)
+            if next_item is not None and next_stage:
+                next_stage.queue.put(next_item)
+
+        with stage.processed.get_lock():
+            stage.processed.value += 1
+        with stage.busy.get_lock():
+            stage.busy.value += time.time() - start
+
+    # put only hands items to a feeder thread, they have to be in the next stage's pipe
+    # before the main process learns that this worker is done and sends the next stage its Nones
+    if next_stage:
+        next_stage.queue.close()
+        next_stage.queue.join_thread()
+
+    results.put(("done", stage.name))
+
+
+def put_all(queue, items):
+    for item in items:
+        queue.put(item)
+
+
+class Pipeline:
+    """\
+    Streams items through a list of stages, every stage running its own number of processes
+
+    The results of all stages are collected in the main process which is the only one
+    allowed to use the db. The results queue holds at most results_size of them,
+    when the main process falls behind the workers wait.
+    """
+
+    def __init__(self, stages, retries=0, backoff=1, stats_interval=30, results_size=1000):
+        self.stages = stages
+        self.retries = retries
+        self.backoff = backoff
+        self.stats_interval = stats_interval
+        self.results = Queue(maxsize=results_size)
+        self.results_size = results_size
+
+        # sampled whenever a result is taken, and the time spent unpickling results
+        self.max_results_depth = 0
+        self.deserialize_seconds = 0.0
+
+    def run(self, items, on_result, on_idle=None, idle_interval=5):
+        """\
+        feeds items into the first stage and calls on_result for every result until all stages are done
+        on_idle is called whenever no result arrived for idle_interval seconds
+        """
+        self.start = time.time()
+
+        for (i, stage) in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                p = Process(target=work, args=(stage, next_stage, self.results, self.retries, self.backoff))
+                p.start()
+                stage.processes.append(p)
+
+        # feeding happens in a thread, the queues are bounded and putting may block
+        # while this process has to keep taking results
+        first = self.stages[0]
+        feeder = threading.Thread(target=put_all, args=(first.queue, list(items) + [None] * first.workers))
+        feeder.daemon = True
+        feeder.start()
+
+        last_stats = time.time()
+        while not all(stage.finished == stage.workers for stage in self.stages):
+            try:
+                (kind, payload) = self.results.get(timeout=idle_interval)
+            except Empty:
+                if on_idle:
+                    on_idle()
+                self.reap()
+                continue
+
+            if kind == "result":
+                self.max_results_depth = max(self.max_results_depth, self.results_depth())
+                start = time.time()
+                result = pickle.loads(payload)
+                self.deserialize_seconds += time.time() - start
+                on_result(result)
+            else:
+                self.stage_done(payload)
+
+            if time.time() - last_stats > self.stats_interval:
+                last_stats = time.time()
+                self.log_stats()
+
+        for stage in self.stages:
+            for p in stage.processes:
+                p.join()
+
+        self.log_stats()
+
+    def stage_done(self, name):
+        """\
+        called whenever a worker of stage name finished
+        once all workers of a stage finished the next stage gets its Nones
+        """
+        for (i, stage) in enumerate(self.stages):
+            if stage.name != name:
+                continue
+
+            stage.finished += 1
+            if stage.finished == stage.workers and i + 1 < len(self.stages):
+                next_stage = self.stages[i + 1]
+                t = threading.Thread(target=put_all, args=(next_stage.queue, [None] * next_stage.workers))
+                t.daemon = True
+                t.start()
+
+    def reap(self):
+        """\
+        a worker that was killed never reports back, count it as finished so the pipeline doesn't wait forever
+        """
+        for stage in self.stages:
+            if stage.finished == stage.workers or any(p.is_alive() for p in stage.processes):
+                continue
+
+            # dead workers may still have their last messages in the pipe
+            if not self.results.empty():
+                continue
+
+            missing = stage.workers - stage.finished
+            logging.error("{}: {} workers died".format(stage.name, missing))
+            for _ in range(missing):
+                self.stage_done(stage.name)
+
+    def results_depth(self):
+        try:
+            return self.results.qsize()
+        except NotImplementedError:
+            return -1
+
+    def ipc_stats(self):
+        """\
+        returns the counters of the results queue: results sent, their pickled bytes, seconds spent
+        pickling (in the workers) and unpickling (in the main process), the current and the highest depth
+        """
+        return {
+            "results": sum(stage.results_sent.value for stage in self.stages),
+            "result_bytes": sum(stage.result_bytes.value for stage in self.stages),
+            "serialize_seconds": sum(stage.serialize_seconds.value for stage in self.stages),
+            "deserialize_seconds": self.deserialize_seconds,
+            "depth": self.results_depth(),
+            "max_depth": self.max_results_depth,
+        }
+
+    def log_stats(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        for stage in self.stages:
+            logging.info("{}: {} done ({:.1f}/s, busy {:.0f}%), {} failed, {} queued".format(
+                stage.name,
+                stage.processed.value,
+                stage.processed.value / elapsed,
+                100 * stage.busy.value / (elapsed * stage.workers),
+                stage.failed.value,
+                stage.depth()))
+
+        ipc = self.ipc_stats()
+        results = max(ipc["results"], 1)
+        logging.info("results: {} sent, {:.0f} bytes each, {:.3f}ms to pickle, {:.3f}ms to unpickle, "
+                     "{} queued (at most {} of {})".format(
+                         ipc["results"],
+                         ipc["result_bytes"] / results,
+                         1000 * ipc["serialize_seconds"] / results,
+                         1000 * ipc["deserialize_seconds"] / results,
+                         ipc["depth"],
+                         ipc["max_depth"],
+                         self.results_size))
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import heapq
+import logging
+import contextlib
+from collections import OrderedDict
+
+
+class RunReport:
+    """\
+    Where a scraper run spends its time
+
+    Phases are the steps the main process runs one after another (walk, db_snapshot, delta, ...),
+    timed with phase(). Stages are the steps every file goes through (hash, probe, thumb, write),
+    their seconds are summed over all processes of the stage and may overlap each other.
+    Rates are files and bytes per second of the index phase, in which the stages run. A stage's bytes
+    are None where they can't be counted, like the bytes probes read without /proc/<pid>/io.
+    The slowest files of every stage are kept as well.
+    """
+
+    def __init__(self, slowest=5, progress_interval=30):
+        self.started = time.time()
+        self.finished = None
+        self.slowest_size = slowest
+        self.progress_interval = progress_interval
+        self.progress_started = None
+        self.last_progress = None
+
+        self.phases = OrderedDict()
+        self.stages = OrderedDict()
+        self.slowest = {}
+        self.counts = OrderedDict()
+        self.gauges = OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+    def stage(self, name, files=0, seconds=0.0, nbytes=0, failed=0):
+        """\
+        adds to the totals of stage name, nbytes None means they couldn't be counted
+        and the stage's bytes are unknown from then on
+        """
+        stage = self.stages.setdefault(name, {"files": 0, "failed": 0, "seconds": 0.0, "bytes": 0})
+        stage["files"] += files
+        stage["failed"] += failed
+        stage["seconds"] += seconds
+        if nbytes is None or stage["bytes"] is None:
+            stage["bytes"] = None
+        else:
+            stage["bytes"] += nbytes
+
+    def file(self, stage, path, seconds, nbytes=0):
+        """\
+        records one file going through stage, keeps it if it is one of the slowest
+        """
+        self.stage(stage, files=1, seconds=seconds, nbytes=nbytes)
+
+        slowest = self.slowest.setdefault(stage, [])
+        heapq.heappush(slowest, (seconds, path))
+        if len(slowest) > self.slowest_size:
+            heapq.heappop(slowest)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def progress(self, done, total):
+        """\
+        logs how far the run is, with the rate so far and an estimate of the time left,
+        at most every progress_interval seconds
+        """
+        now = time.time()
+        if self.progress_started is None:
+            self.progress_started = self.last_progress = now
+        if now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+
+        elapsed = now - self.progress_started
+        rate = done / elapsed if elapsed else 0.0
+        eta = (total - done) / rate if rate else float("inf")
+        logging.info("Progress: {} of {} files ({:.0f}%), {:.1f} files/s, {} left".format(
+            done, total, 100.0 * done / max(total, 1), rate, format_seconds(eta)))
+
+    def finish(self):
+        self.finished = time.time()
+
+    def summary(self):
+        finished = self.finished or time.time()
+        index_seconds = self.phases.get("index", 0.0)
+
+        stages = OrderedDict()
+        for (name, stage) in self.stages.items():
+            stages[name] = dict(stage,
+                                files_per_second=stage["files"] / index_seconds if index_seconds else 0.0,
+                                bytes_per_second=None if stage["bytes"] is None
+                                else stage["bytes"] / index_seconds if index_seconds else 0.0)
+
+        return OrderedDict([
+            ("started", self.started),
+            ("finished", finished),
+            ("seconds", finished - self.started),
+            ("phases", self.phases),
+            ("stages", stages),
+            ("counts", self.counts),
+            ("gauges", self.gauges),
+            ("slowest", dict((stage, [{"path": path, "seconds": seconds}
+                                      for (seconds, path) in sorted(slowest, reverse=True)])
+                             for (stage, slowest) in self.slowest.items())),
+        ])
+
+    def log(self):
+        summary = self.summary()
+        logging.info("Run took {}".format(format_seconds(summary["seconds"])))
+        for (name, seconds) in summary["phases"].items():
+            logging.info("Phase {}: {:.1f}s".format(name, seconds))
+        for (name, stage) in summary["stages"].items():
+            rate = "unknown" if stage["bytes_per_second"] is None else "{:.0f}".format(stage["bytes_per_second"])
+            logging.info("Stage {}: {files} files, {failed} failed, {seconds:.1f}s, {files_per_second:.1f} files/s, "
+                         "{} bytes/s".format(name, rate, **stage))
+        for (stage, slowest) in summary["slowest"].items():
+            for f in slowest:
+                logging.info("Slowest {}: {:.1f}s {}".format(stage, f["seconds"], f["path"]))
+        if summary["counts"]:
+            logging.info(", ".join("{} {}".format(value, name.replace("_", " "))
+                                   for (name, value) in summary["counts"].items()))
+
+    def write_json(self, path):
+        with atomic_write(path) as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path, prefix="mastodon_scraper"):
+        """\
+        writes the summary in the text format of the node_exporter textfile collector
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+            lines.append("# TYPE {}_{} gauge".format(prefix, name))
+            for (labels, value) in samples:
+                label_text = ",".join('{}="{}"'.format(k, v) for (k, v) in labels)
+                lines.append("{}_{}{} {}".format(prefix, name, "{" + label_text + "}" if label_text else "", value))
+
+        metric("last_run_timestamp_seconds", "When the last run finished", [((), summary["finished"])])
+        metric("run_seconds", "Duration of the last run", [((), summary["seconds"])])
+        metric("phase_seconds", "Seconds spent in each phase of the last run",
+               [((("phase", name),), seconds) for (name, seconds) in summary["phases"].items()])
+        for key in ("files", "failed", "seconds", "bytes", "files_per_second", "bytes_per_second"):
+            metric("stage_" + key, "{} of each stage in the last run".format(key.replace("_", " ")),
+                   [((("stage", name),), stage[key]) for (name, stage) in summary["stages"].items()
+                    if stage[key] is not None])
+        metric("count", "What the last run did, by kind",
+               [((("kind", name),), value) for (name, value) in summary["counts"].items()])
+        for (name, value) in summary["gauges"].items():
+            metric(name, name.replace("_", " "), [((), value)])
+
+        with atomic_write(path) as f:
+            f.write("\n".join(lines) + "\n")
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    # readers like the textfile collector never see a half written file
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            yield f
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return "unknown"
+    (minutes, seconds) = divmod(int(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
@@ -3,117 +3,297 @@
 
 import sys
 import os
+import stat
 from api import db
-from api.models import Media, get_or_create_category
+from api.models import Media, get_or_create_category, get_tag_names, record_changes, build_api_document
 import thumbs
 import binascii
-from config import PATH_TO_MOUNT, URL_TO_MOUNT, INDEX_FOLDER, VIDEO_CATEGORY_RULES, SQLALCHEMY_DATABASE_URI
+from config import PATH_TO_MOUNT, URL_TO_MOUNT, INDEX_FOLDER, VIDEO_CATEGORY_RULES, SQLALCHEMY_DATABASE_URI, \
+    SCRAPER_MANIFEST_PATH, SCRAPER_MAX_RETRIES, SCRAPER_RETRY_BACKOFF, SCRAPER_STAGE_QUEUE_SIZE, SCRAPER_RESULTS_QUEUE_SIZE, \
+    SCRAPER_HASH_WORKERS, SCRAPER_PROBE_WORKERS, SCRAPER_THUMB_WORKERS, SCRAPER_PROBE_MEMO_SIZE, \
+    SCRAPER_WATCH_SETTLE, SCRAPER_WATCH_MAX_DELAY, SCRAPER_RECONCILE_INTERVAL, SCRAPER_JOURNAL_PATH, \
+    SCRAPER_REPORT_PATH, SCRAPER_PROMETHEUS_PATH, PROBE_TIMEOUT, PROBE_ATTEMPTS
 import hashlib
 import mimetypes
 import time
 import re
 import videoinfo
 import logging
-import traceback
-from multiprocessing import Process, cpu_count, Queue
+import argparse
+import functools
+import manifest
+import snapshot
+import resource
+import watcher
+import journal
+import runreport
+import zlib
+import dbwriter
+import pipeline
+from sqlalchemy import any_, or_, func, create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import bindparam, select
+import copy
+from multiprocessing import cpu_count, Lock, Manager
+
+
+def classify_file(filename):
+    """\
+    returns the full mimetype of filename if it is relevant for the index, None otherwise
+    """
+    (full_mime, encoding) = mimetypes.guess_type(filename)
+    mime = None
+
+    if full_mime:
+        mime = full_mime.split("/")[0]
+
+    if mime in ["video", "audio", "image", "text"]:
+        return full_mime
+
+    return None
+
+
+def parse_shard(value):
+    """\
+    parses "i/n" (1 <= i <= n) into the tuple (i, n)
+    """
+    try:
+        (i, n) = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard has to look like i/n, e.g. 1/4")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard i/n needs 1 <= i <= n")
+    return (i, n)
+
+
+def positive_int(value):
+    """\
+    parses a number of processes, a stage can't run with less than one
+    """
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a number".format(value))
+    if n < 1:
+        raise argparse.ArgumentTypeError("needs at least 1, got {}".format(n))
+    return n
+
+
+def in_shard(path, shard):
+    """\
+    whether the file path belongs to shard (i, n), every file belongs to the shard None
+    files are assigned by their folder, so a rename within a folder is still seen as a move
+    """
+    return dir_in_shard(os.path.dirname(path), shard)
 
 
-def get_files():
+def dir_in_shard(relativeDir, shard):
     """\
-    returns a list of tuples of filename, mimetype and last modified date of all relevant files in root directory
+    whether the files directly in the folder relativeDir (relative to PATH_TO_MOUNT) belong to shard
     """
+    if shard is None:
+        return True
+    (i, n) = shard
+    return zlib.crc32(relativeDir.encode("utf-8", "surrogateescape")) % n == i - 1
 
-    last_update = 0
-    l = 0
+
+def get_files(full=False, shard=None):
+    """\
+    returns a list of tuples of filename, mimetype, last modified date, size and inode of all relevant files
+    in root directory, or only of those in shard
+
+    directories that didn't change since the last run are served from the manifest in SCRAPER_MANIFEST_PATH,
+    every shard has its own, full forces a complete walk
+    the files of folders of other shards are neither classified nor stat'ed
+    """
 
     lis = []
 
     search_path = os.path.join(PATH_TO_MOUNT, INDEX_FOLDER)
     logging.debug("search_path: {}".format(search_path))
-    for root, dirs, files in os.walk(search_path):
-        for filename in files:
-            (full_mime, encoding) = mimetypes.guess_type(filename)
-            mime = None
 
-            if full_mime:
-                mime = full_mime.split("/")[0]
+    manifest_path = SCRAPER_MANIFEST_PATH
+    accept_dir = None
+    if shard is not None:
+        if manifest_path:
+            manifest_path = "{}.{}-of-{}".format(manifest_path, *shard)
 
-            if mime in ["video", "audio", "image", "text"]:
-                filepath = os.path.join(root, filename)
-                try:
-                    lastModified = os.path.getmtime(filepath)
-                    lis.append((os.path.relpath(filepath, PATH_TO_MOUNT), full_mime, int(lastModified)))
-                    l = l + 1
+        def accept_dir(dirpath):
+            relativeDir = os.path.relpath(dirpath, PATH_TO_MOUNT)
+            # like os.path.dirname of a file directly in PATH_TO_MOUNT
+            return dir_in_shard("" if relativeDir == "." else relativeDir, shard)
 
-                    if time.time() - last_update > 5:
-                        last_update = time.time()
-                        logging.info("Getting files in FS: {}".format(l))
+    fs_manifest = manifest.Manifest.load(manifest_path, search_path)
 
-                except os.error as err:
-                    msg = "Error when accessing file '{}' in folder '{}':".format(filename, root)
-                    logging.error(msg)
+    for (root, filename, (full_mime, size, lastModified, inode)) in fs_manifest.walk(classify_file, full=full,
+                                                                                      accept_dir=accept_dir):
+        relativePath = os.path.relpath(os.path.join(root, filename), PATH_TO_MOUNT)
+        lis.append((relativePath, full_mime, lastModified, size, inode))
+
+    logging.info("Walked {} folders, pruned {} unchanged folders, skipped {} folders of other shards, "
+                 "{} changed files".format(fs_manifest.scanned, fs_manifest.pruned, fs_manifest.skipped,
+                                           fs_manifest.changed))
+
+    fs_manifest.save()
 
     return lis
 
 
-def get_files_in_db():
+def get_files_below(paths, dirs):
     """\
-    returns a list of tuples of filename, mimetype and last modified date of all files currently indexed in the db
+    like get_files, but only for the files paths and the trees below dirs (relative to PATH_TO_MOUNT)
+    paths that don't exist (anymore) or are irrelevant are left out, the manifest is not used
     """
+    files = {}
 
-    medias = Media.query.all()
-    lis = []
+    for relativePath in paths:
+        full_mime = classify_file(relativePath)
+        if not full_mime:
+            continue
+        try:
+            st = os.stat(os.path.join(PATH_TO_MOUNT, relativePath))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files[relativePath] = (relativePath, full_mime, int(st.st_mtime), st.st_size, st.st_ino)
 
-    for media in medias:
-        lis.append((media.path, media.mimetype, media.lastModified))
+    for relativeDir in dirs:
+        tree = manifest.Manifest(None, os.path.join(PATH_TO_MOUNT, relativeDir))
+        if not os.path.isdir(tree.root):
+            continue
+        for (root, filename, (full_mime, size, lastModified, inode)) in tree.walk(classify_file, full=True):
+            relativePath = os.path.relpath(os.path.join(root, filename), PATH_TO_MOUNT)
+            files[relativePath] = (relativePath, full_mime, lastModified, size, inode)
 
-    return lis
+    return list(files.values())
 
 
-def get_deltas(database_files, filesystem_files):
+def get_files_in_db(paths=None, dirs=None, shard=None):
     """\
-    takes a list of all files currently indexed and a list of all files available in the filesystem_filesystem
-    returns two lists one with files to create/update in the db and one with files to be deleted from the db
+    returns a snapshot.IndexSnapshot, a compact list of tuples of filename, mimetype, last modified date,
+    size, inode and sha of all files currently indexed in the db
+    or, if paths or dirs are given, of the files paths and the files below dirs
+    only the files in shard are kept, see in_shard
+
+    only these columns are selected and the rows are streamed from a server side cursor,
+    neither Media objects nor their mediainfo are loaded
     """
-    # extract all paths for easy matching in the for loops
-    database_paths = [relativePath for (relativePath, _, _) in database_files]
-    filesystem_paths = [relativePath for (relativePath, _, _) in filesystem_files]
 
-    to_upsert = []
-    to_delete = []
+    medias = db.session.query(Media.path, Media.mimetype, Media.lastModified, Media.size, Media.inode, Media.sha)
+    if paths is not None or dirs is not None:
+        conditions = [Media.path.startswith(os.path.join(d, ""), autoescape=True) for d in dirs or []]
+        if paths:
+            conditions.append(Media.path == any_(bindparam("paths", value=list(paths),
+                                                           type_=postgresql.ARRAY(db.Text))))
+        if not conditions:
+            return snapshot.IndexSnapshot()
+        medias = medias.filter(or_(*conditions))
 
-    for f in database_files:
-        (relativePath, _, _) = f
-        # relativePath is indexed in db but no longer available in FS
-        if relativePath not in filesystem_paths:
-            to_delete.append(f)
+    files = snapshot.IndexSnapshot()
+    for row in medias.execution_options(stream_results=True).yield_per(10000):
+        if in_shard(row[0], shard):
+            files.append(row)
+
+    return files
+
+
+def get_deltas(database_files, filesystem_files):
+    """\
+    takes a list of all files currently indexed and a list of all files available in the filesystem
+    returns three lists: files to insert into the db, files whose db row has to be updated and
+    files to be deleted from the db
+
+    the indexed files are keyed by path once, so this runs in linear time
+    database_files only has to support len, indexing and iteration, like an IndexSnapshot
+    """
+    # path -> position, the rows themselves are only looked at for files that exist in both
+    indexed = {f[0]: i for (i, f) in enumerate(database_files)}
+
+    to_insert = []
+    to_update = []
 
     for f in filesystem_files:
-        (relativePath, mime, currentLastModified) = f
+        (relativePath, _, currentLastModified) = f[:3]
+        i = indexed.pop(relativePath, None)
+
         # file in FS which is not indexed at all
-        if relativePath not in database_paths:
-            to_upsert.append(f)
-        # file is already in database, check if it needs to be updated
+        if i is None:
+            to_insert.append(f)
+        # file is already in database but has changed since
+        elif database_files[i][2] != currentLastModified:
+            to_update.append(f)
+
+    # everything left over is indexed in db but no longer available in FS
+    to_delete = [database_files[i] for i in sorted(indexed.values())]
+
+    return (to_insert, to_update, to_delete)
+
+
+def fingerprint(f):
+    """\
+    returns the (inode, size, last modified) fingerprint of a file or db entry
+    or None if it is not known (rows indexed before size and inode were stored)
+    """
+    (_, _, lastModified, size, inode) = f[:5]
+    if size is None or inode is None:
+        return None
+    return (inode, size, lastModified)
+
+
+def get_moves(to_insert, to_delete):
+    """\
+    takes the new and vanished files from get_deltas and pairs up those with the same fingerprint,
+    these files were only renamed or moved and their rows can be moved without indexing them again
+    returns a list of (vanished db entry, new filesystem entry) and the remaining to_insert and to_delete lists
+    """
+    vanished = {}
+    for f in to_delete:
+        fp = fingerprint(f)
+        if fp is not None:
+            vanished.setdefault(fp, f)
+
+    moves = []
+    remaining_insert = []
+    for f in to_insert:
+        dbF = vanished.pop(fingerprint(f), None)
+        if dbF is not None:
+            moves.append((dbF, f))
         else:
-            # get info about indexed file to check wether it has changed
-            dbF = [f for f in database_files if f[0] == relativePath][0]
-            indexedLastModifed = dbF[2]
+            remaining_insert.append(f)
 
-            if indexedLastModifed != currentLastModified:
-                # a indexed file that should be updated in the DB is first deleted then
-                # added as if it was never indexed. just adding it to "to_delete" here makes the logic in main
-                # very simple
-                to_delete.append(dbF)
-                to_upsert.append(f)
+    moved_paths = set(dbF[0] for (dbF, _) in moves)
+    remaining_delete = [f for f in to_delete if f[0] not in moved_paths]
 
-    return (to_upsert, to_delete)
+    return (moves, remaining_insert, remaining_delete)
 
 
-def hashfile(afile, hasher, blocksize=65536):
-    buf = afile.read(blocksize)
-    while len(buf) > 0:
-        hasher.update(buf)
-        buf = afile.read(blocksize)
+def get_sha_cache(database_files, files):
+    """\
+    returns a dict mapping fingerprints to shas, for the indexed files whose fingerprint is one of files'
+    (hard links of indexed files), the rest of database_files could never be looked up
+    """
+    wanted = set(fingerprint(f) for f in files)
+    wanted.discard(None)
+
+    sha_cache = {}
+    for f in database_files:
+        fp = fingerprint(f)
+        if fp in wanted:
+            sha_cache[fp] = f[5]
+    return sha_cache
+
+
+def hashfile(afile, hasher, blocksize=1 << 20):
+    """\
+    feeds the whole file into hasher, afile should be opened unbuffered
+    reads go into one preallocated buffer instead of allocating a new bytes object per block
+    """
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    n = afile.readinto(buf)
+    while n:
+        hasher.update(view[:n])
+        n = afile.readinto(buf)
     return hasher.digest()
 
 def categorize(path, mime, duration):
@@ -145,123 +325,644 @@ def categorize(path, mime, duration):
 
     return category
 
-def index_medium(queue, relativePath, mime, lastModified):
+class ShaLocks:
+    """\
+    Locks shared by the worker processes so only one of them works on a given sha at a time
+    shas are spread over a fixed number of locks, unrelated shas rarely wait for each other
+    """
+
+    def __init__(self, stripes=64):
+        self.locks = [Lock() for _ in range(stripes)]
+
+    def lock(self, sha):
+        return self.locks[sha[0] % len(self.locks)]
+
+
+class ProbeMemo:
     """\
-    Takes three arguments path, mime, lsatModified(directly from get_deltas)
-    And does all operations to index the medium:
+    Probe results by sha, shared by the probe workers through a Manager
+    so copies of a file are probed once, holds at most size entries
+
+    the lock of a sha is only held to look it up and to claim it, the worker that claimed it
+    probes without holding any lock and the copies wait for its result
+    lookup is called with a sha the memo doesn't know yet and returns the mediainfo of a copy
+    that is indexed already or None, see indexed_mediainfo
+    """
+
+    # seconds between looks at a sha another worker is probing
+    WAIT_INTERVAL = 0.05
+
+    def __init__(self, manager, size=SCRAPER_PROBE_MEMO_SIZE, lookup=None):
+        self.mediainfo = manager.dict()
+        # probe results of an interrupted run, see Journal
+        self.resumed = manager.dict()
+        # sha -> time a worker claimed it for probing
+        self.claims = manager.dict()
+        self.locks = ShaLocks()
+        self.size = size
+        self.lookup = lookup
+        # a worker that was killed never gives up its claims
+        self.claim_timeout = PROBE_TIMEOUT * PROBE_ATTEMPTS + 60
+
+    def preload(self, mediainfo):
+        """\
+        takes {sha: mediainfo} from the journal, these shas are not probed again
+        """
+        self.resumed.update(mediainfo)
+
+    def probe(self, sha, filename, mime=None):
+        """\
+        returns the mediainfo of filename and the stats of videoinfo.probe,
+        the stats are None if the mediainfo was reused from a copy
+        """
+        while True:
+            with self.locks.lock(sha):
+                mediainfo = self.resumed.pop(sha, None)
+                if mediainfo is not None:
+                    # like a fresh probe, this file goes on to the thumbnail stage
+                    self.remember(sha, mediainfo)
+                    return (mediainfo, {"seconds": 0.0, "bytes_read": 0, "attempts": 0, "timed_out": False})
+
+                mediainfo = self.mediainfo.get(sha)
+                if mediainfo is not None:
+                    return (self.for_copy(mediainfo, filename), None)
+
+                claimed = self.claims.get(sha)
+                if claimed is None or time.time() - claimed > self.claim_timeout:
+                    self.claims[sha] = time.time()
+                    break
 
-    - calculate sha
-    - insert into db
-    - create thumbnail
+            # another worker is probing this sha, if it fails this one tries itself
+            time.sleep(self.WAIT_INTERVAL)
+
+        try:
+            mediainfo = self.lookup(sha) if self.lookup else None
+            if mediainfo:
+                # the content is indexed already, and so is its thumbnail
+                self.remember(sha, mediainfo)
+                return (self.for_copy(mediainfo, filename), None)
+
+            (mediainfo, stats) = videoinfo.probe(filename, mime)
+            self.remember(sha, mediainfo)
+            return (mediainfo, stats)
+        finally:
+            with self.locks.lock(sha):
+                self.claims.pop(sha, None)
+
+    def remember(self, sha, mediainfo):
+        # a failed or timed out probe is not the final word for the copies, they are probed themselves
+        if mediainfo and len(self.mediainfo) < self.size:
+            self.mediainfo[sha] = mediainfo
+
+    @staticmethod
+    def for_copy(mediainfo, filename):
+        # the only part of it that depends on the path
+        mediainfo = copy.deepcopy(mediainfo)
+        if "format" in mediainfo and "filename" in mediainfo["format"]:
+            mediainfo["format"]["filename"] = filename
+        return mediainfo
+
+
+# every worker process opens its own connection, see indexed_mediainfo
+_lookup_engine = None
+_lookup_pid = None
+
+
+def indexed_mediainfo(sha):
+    """\
+    returns the mediainfo of an indexed medium with content sha, None if there is none or it couldn't be probed
+    runs in the probe workers, which don't use the session of the main process but a connection of their own
+    """
+    global _lookup_engine, _lookup_pid
+    if _lookup_pid != os.getpid():
+        _lookup_engine = create_engine(SQLALCHEMY_DATABASE_URI, pool_size=1)
+        _lookup_pid = os.getpid()
+
+    media = Media.__table__
+    return _lookup_engine.execute(
+        select([media.c.mediainfo])
+        .where(media.c.sha == bindparam("sha", value=sha, type_=db.Binary))
+        .where(media.c.mediainfo.has_key("format"))
+        .limit(1)).scalar()
+
+
+# The following three functions are the stages of the indexing pipeline
+# Each of them runs in its own pool of processes, see main
+def hash_medium(sha_cache, f):
+    """\
+    Takes a file tuple (directly from get_deltas) and calculates its sha,
+    unless the fingerprint of the file is in the sha cache from get_sha_cache
+    a new sha is sent to the main process for the journal, with the seconds hashing took
     """
+    (relativePath, mime, lastModified, size, inode) = f
 
-    logging.info("Indexing {}".format(relativePath))
+    sha = sha_cache.get(fingerprint(f))
+    hashed = sha is None
+    if hashed:
+        logging.info("Hashing {}".format(relativePath))
+        start = time.time()
+        with open(os.path.join(PATH_TO_MOUNT, relativePath), "rb", buffering=0) as afile:
+            sha = hashfile(afile, hashlib.sha256())
+        return ((f, sha, hashed), ("hashed", f, sha, time.time() - start))
 
-    # get a custom instance of db
-    #from api import db
+    return ((f, sha, hashed), None)
 
-    path = os.path.join(PATH_TO_MOUNT, relativePath)
 
-    sha = hashfile(open(path, "rb"), hashlib.sha256())
+def probe_medium(memo, item):
+    """\
+    Takes the output of hash_medium, probes the file and builds its dbwriter.MediaRecord
+    which is sent to the main process to be written to the db right away, along with the probe stats
+    copies of a file already probed in this run reuse its result from the ProbeMemo memo
+    videos are passed on to the thumbnail stage, but only the first one with a given sha
+    """
+    ((relativePath, mime, lastModified, size, inode), sha, hashed) = item
 
-    mediainfo = videoinfo.ffprobe(path)
+    logging.info("Probing {}".format(relativePath))
+
+    (mediainfo, probe_stats) = memo.probe(sha, os.path.join(PATH_TO_MOUNT, relativePath), mime)
     duration = 0
     if "format" in mediainfo and "duration" in mediainfo["format"]:
         duration = float(mediainfo["format"]["duration"])
 
-    m = Media(
+    m = dbwriter.MediaRecord(
         path=relativePath,
         mediainfo=mediainfo,
         lastModified=lastModified,
         mimetype=mime,
         timeLastIndexed=int(time.time()),
-        sha=sha)
+        sha=sha,
+        size=size,
+        inode=inode)
 
-    queue.put((m, categorize(relativePath, mime, duration)))
+    thumb = None
+    if probe_stats and mime.startswith("video"):
+        thumb = (binascii.hexlify(sha).decode(), relativePath, duration)
 
-    if mime.startswith("video"):
-        try :
-             thumbs.generateThumb(binascii.hexlify(m.sha).decode(), os.path.join(PATH_TO_MOUNT, m.path))
-        except:
-            logging.warning("Error generating thumb: {}".format(sys.exc_info()))
+    return (thumb, ("probed", m, categorize(relativePath, mime, duration), hashed, probe_stats, thumb is not None))
 
-    logging.info("Finished indexing {}".format(relativePath))
 
-# This runs in a seperate process
-# It should be very safe from crashing
-# The main process depends on this process sending a None to the queue
-# (Yeah, this is probably pretty bad)
-def index_media(queue, media):
-    for (relativePath, mime, lastModified) in media:
-        try:
-            index_medium(queue, relativePath, mime, lastModified)
-        except:
-            logging.warning("Error indexing medium: {}".format(sys.exc_info()))
-            traceback.print_exc()
-            break
+def thumb_medium(locks, item):
+    """\
+    locks is a ShaLocks, a copy of the video may be thumbnailed at the same time
+    if the memo of the probe stage was full
+    sends the seconds it took, how many ffmpeg runs it took and how many of them failed to the main process
+    """
+    (hex_sha, relativePath, duration) = item
+
+    start = time.time()
+    timings = []
+    try:
+        with locks.lock(binascii.unhexlify(hex_sha)):
+            timings = thumbs.generateThumb(hex_sha, os.path.join(PATH_TO_MOUNT, relativePath), length=duration)
+    except:
+        logging.warning("Error generating thumb: {}".format(sys.exc_info()))
+
+    # failed thumbnails are not retried by later runs either
+    return (None, ("thumbed", relativePath, time.time() - start,
+                   len(timings), sum(1 for (_, _, success) in timings if not success)))
+
+
+def move_media(moves, batch_size=1000):
+    """\
+    moves the rows of the vanished db entries to the paths of the filesystem entries they were paired with,
+    moves is a list of (db entry, filesystem entry) from get_moves
+    the content is unchanged, so sha, mediainfo, streams and tags are kept, category and document are rebuilt
+    every batch is one SELECT of the rows, one of their tags and one UPDATE ... FROM unnest(...)
+    in its own transaction, new categories are created before the batch is written
+    returns the number of moved rows
+    """
+    media = Media.__table__
+    category_ids = {}
+    moved = 0
+
+    for i in range(0, len(moves), batch_size):
+        targets = dict((dbF[0], f) for (dbF, f) in moves[i:i + batch_size])
+        paths = bindparam("paths", value=list(targets), type_=postgresql.ARRAY(db.Text))
+        rows = db.session.execute(select([media.c.media_id, media.c.path, media.c.mediainfo, media.c.sha])
+                                  .where(media.c.path == any_(paths))).fetchall()
+        if not rows:
+            continue
+        tag_names = get_tag_names(row[0] for row in rows)
+
+        now = int(time.time())
+        columns = dict((name, []) for name in ("media_id", "path", "mimetype", "lastModified", "size", "inode",
+                                               "category_id", "api_document"))
+        for (media_id, oldPath, mediainfo, sha) in rows:
+            (relativePath, mime, lastModified, size, inode) = targets[oldPath]
+
+            duration = 0
+            if "format" in mediainfo and "duration" in mediainfo["format"]:
+                duration = float(mediainfo["format"]["duration"])
+            category = categorize(relativePath, mime, duration)
+            if category not in category_ids:
+                category_ids[category] = get_or_create_category(category).category_id
+
+            for (name, value) in [("media_id", media_id), ("path", relativePath), ("mimetype", mime),
+                                  ("lastModified", lastModified), ("size", size), ("inode", inode),
+                                  ("category_id", category_ids[category]),
+                                  ("api_document", build_api_document(
+                                      relativePath, mediainfo, category, tag_names.get(media_id, []), mime,
+                                      lastModified, now, bytes(sha)))]:
+                columns[name].append(value)
+
+        # the columns side by side, multiple unnests in one select list are zipped
+        data = select([func.unnest(bindparam("b_" + name, value=values, type_=postgresql.ARRAY(media.c[name].type)))
+                       .label(name) for (name, values) in columns.items()]).alias("moved")
+        db.session.execute(media.update()
+                           .values(dict([(name, data.c[name]) for name in columns if name != "media_id"] +
+                                        [("timeLastIndexed", now)]))
+                           .where(media.c.media_id == data.c.media_id))
+
+        record_changes([(media_id, path, False) for (media_id, path) in zip(columns["media_id"], columns["path"])])
+        db.session.commit()
+        moved += len(rows)
+
+    return moved
+
+
+def delete_media(to_delete, batch_size=1000):
+    """\
+    deletes the rows of the vanished db entries to_delete and leaves a tombstone for each in the change log
+    every batch is one DELETE ... WHERE path = ANY(:paths) in its own transaction,
+    streams and tags go with the rows by their foreign keys
+    returns the number of deleted rows and the shas they had
+    """
+    media = Media.__table__
+    deleted = 0
+    shas = set()
+
+    for i in range(0, len(to_delete), batch_size):
+        paths = bindparam("paths", value=[f[0] for f in to_delete[i:i + batch_size]],
+                          type_=postgresql.ARRAY(db.Text))
+        result = db.session.execute(media.delete().where(media.c.path == any_(paths))
+                                    .returning(media.c.media_id, media.c.path, media.c.sha))
+
+        changes = []
+        for (media_id, path, sha) in result:
+            changes.append((media_id, path, True))
+            shas.add(bytes(sha))
+
+        record_changes(changes)
+        db.session.commit()
+        deleted += len(changes)
 
-    queue.put(None)
+    return (deleted, shas)
+
+
+def remove_orphaned_thumbs(shas):
+    """\
+    removes the thumbnails of the shas no medium has anymore, returns how many were removed
+    """
+    if not shas:
+        return 0
+
+    media = Media.__table__
+    candidates = bindparam("shas", value=list(shas), type_=postgresql.ARRAY(db.Binary))
+    result = db.session.execute(select([media.c.sha]).where(media.c.sha == any_(candidates)).distinct())
+    in_use = set(bytes(sha) for (sha,) in result)
+
+    removed = 0
+    for sha in shas - in_use:
+        if thumbs.removeThumb(binascii.hexlify(sha).decode("ascii")):
+            removed += 1
+    return removed
+
+
+def finish_thumbs(work_journal, num_workers, report):
+    """\
+    generates the thumbnails that were still missing for written videos when a run was interrupted
+    they are reported as the stage thumb_resumed, apart from the thumbnails of the run itself
+    """
+    items = []
+    for (sha, relativePath, mediainfo) in work_journal.pending_thumbs():
+        duration = 0
+        if "format" in mediainfo and "duration" in mediainfo["format"]:
+            duration = float(mediainfo["format"]["duration"])
+        items.append((binascii.hexlify(sha).decode(), relativePath, duration))
+
+    if not items:
+        return
+
+    logging.info("Generating {} thumbnails left over from an interrupted run".format(len(items)))
+    thumbnailer = pipeline.Pipeline([
+        pipeline.Stage("thumb", functools.partial(thumb_medium, ShaLocks()), num_workers, SCRAPER_STAGE_QUEUE_SIZE),
+    ], retries=SCRAPER_MAX_RETRIES, backoff=SCRAPER_RETRY_BACKOFF)
+
+    def on_result(result):
+        (_, relativePath, seconds, runs, failed) = result
+        work_journal.thumbed(relativePath)
+        report.file("thumb_resumed", relativePath, seconds)
+        report.count("ffmpeg_runs", runs)
+        report.count("ffmpeg_runs_failed", failed)
+
+    thumbnailer.run(items, on_result)
+    report.stage("thumb_resumed", failed=thumbnailer.stages[0].failed.value)
+    work_journal.commit()
+
+
+def open_journal(shard=None):
+    """\
+    returns the journal.Journal in SCRAPER_JOURNAL_PATH, every shard has its own, or None if there is none
+    """
+    if not SCRAPER_JOURNAL_PATH:
+        return None
 
+    path = SCRAPER_JOURNAL_PATH
+    if shard is not None:
+        path = "{}.{}-of-{}".format(path, *shard)
+    return journal.Journal(path)
 
-def main():
+
+def main(full=False, workers=None, shard=None):
+    """\
+    workers optionally maps the stage names "hash", "probe" and "thumb" to their number of processes
+    shard (i, n) only indexes the i-th of n parts of INDEX_FOLDER, see in_shard
+    """
     logging.basicConfig(level=logging.DEBUG)
 
     logging.info("Scraper started.")
+    reconcile(full=full, workers=workers, shard=shard)
+
+
+def daemon(workers=None, shard=None):
+    """\
+    indexes changes below INDEX_FOLDER as inotify reports them, see watcher.Watcher
+    the whole folder is walked at startup, every SCRAPER_RECONCILE_INTERVAL seconds
+    and whenever events were lost or a batch of them failed
+    errors are logged and don't stop the daemon
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    logging.info("Scraper daemon started.")
+
+    # watch before the first walk, so nothing changes unnoticed in between
+    fs_watcher = None
+    try:
+        fs_watcher = watcher.Watcher(os.path.join(PATH_TO_MOUNT, INDEX_FOLDER), PATH_TO_MOUNT, classify_file,
+                                     settle=SCRAPER_WATCH_SETTLE, max_delay=SCRAPER_WATCH_MAX_DELAY)
+    except OSError:
+        logging.exception("Can't watch for changes, only walking every {}s".format(SCRAPER_RECONCILE_INTERVAL))
+
+    last_reconcile = None
+    while True:
+        if fs_watcher is None:
+            time.sleep(max(0, SCRAPER_RECONCILE_INTERVAL - (time.time() - (last_reconcile or 0))))
+        else:
+            batch = fs_watcher.poll(timeout=1)
+            if batch:
+                (paths, dirs) = batch
+                try:
+                    sync(paths, dirs, workers, shard)
+                except Exception:
+                    # e.g. the db restarted, the walk that follows picks up the lost batch
+                    logging.exception("Syncing {} files and {} folders failed".format(len(paths), len(dirs)))
+                    db.session.rollback()
+                    last_reconcile = None
+
+        if fs_watcher is not None and fs_watcher.overflowed:
+            fs_watcher.overflowed = False
+            last_reconcile = None
+
+        if last_reconcile is None or time.time() - last_reconcile >= SCRAPER_RECONCILE_INTERVAL:
+            last_reconcile = time.time()
+            try:
+                reconcile(workers=workers, shard=shard)
+            except Exception:
+                # tried again after SCRAPER_RECONCILE_INTERVAL
+                logging.exception("Walking {} failed".format(INDEX_FOLDER or PATH_TO_MOUNT))
+                db.session.rollback()
+
+
+def peak_rss():
+    """\
+    returns the peak resident set size of this process in bytes
+    """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reconcile(full=False, workers=None, shard=None):
+    """\
+    walks the whole INDEX_FOLDER (or shard of it) and brings the db in line with it
+    a runreport.RunReport of the run is written to SCRAPER_REPORT_PATH and SCRAPER_PROMETHEUS_PATH
+    """
+    report = runreport.RunReport()
+
     logging.info("Getting files in DB.")
-    database_files = get_files_in_db()
-    logging.info("Files in DB: {}".format(len(database_files)))
+    with report.phase("db_snapshot"):
+        database_files = get_files_in_db(shard=shard)
+    logging.info("Files in DB: {} ({} MB without paths), peak RSS {} MB".format(
+        len(database_files), database_files.nbytes() >> 20, peak_rss() >> 20))
 
-    filesystem_files = get_files()
+    with report.phase("walk"):
+        filesystem_files = get_files(full=full, shard=shard)
     logging.info("Getting files in FS: {}".format(len(filesystem_files)))
 
-    (to_upsert, to_delete) = get_deltas(database_files, filesystem_files)
+    work_journal = open_journal(shard)
+    if work_journal:
+        # what is not on disk anymore or indexed as it is on disk won't be resumed
+        work_journal.retain(filesystem_files, database_files)
+    try:
+        index(database_files, filesystem_files, workers, work_journal, report)
+    finally:
+        if work_journal:
+            work_journal.close()
 
-    logging.info("{} to update/insert, {} to delete".format(len(to_upsert), len(to_delete)))
+    write_report(report, shard)
 
-    for (relativePath, _, _) in to_delete:
-        Media.query.filter_by(path=relativePath)
 
+def write_report(report, shard=None):
+    """\
+    writes report to SCRAPER_REPORT_PATH and SCRAPER_PROMETHEUS_PATH, every shard to its own files
+    """
+    suffix = ".{}-of-{}".format(*shard) if shard is not None else ""
+    for (path, write) in [(SCRAPER_REPORT_PATH, report.write_json),
+                          (SCRAPER_PROMETHEUS_PATH, report.write_prometheus)]:
+        if not path:
+            continue
+        (base, ext) = os.path.splitext(path)
+        try:
+            write(base + suffix + ext)
+        except OSError:
+            logging.exception("Can't write the report to {}".format(base + suffix + ext))
 
-    num_to_upsert = len(to_upsert)
-    partial_lists = []
-    num_cpus = cpu_count()
 
-    for cpu in range(num_cpus):
-        i = cpu
-        partial_list = []
-        while i < num_to_upsert:
-            partial_list.append(to_upsert[i])
-            i += num_cpus
-        partial_lists.append(partial_list)
+def sync(paths, dirs, workers=None, shard=None):
+    """\
+    brings the db in line with the filesystem for the files paths and everything below dirs,
+    all relative to PATH_TO_MOUNT
+    """
+    database_files = get_files_in_db(paths, dirs, shard)
+    filesystem_files = [f for f in get_files_below(paths, dirs) if in_shard(f[0], shard)]
+    logging.info("Syncing {} files and {} folders: {} in FS, {} in DB".format(
+        len(paths), len(dirs), len(filesystem_files), len(database_files)))
 
+    work_journal = open_journal(shard)
+    try:
+        index(database_files, filesystem_files, workers, work_journal)
+    finally:
+        if work_journal:
+            work_journal.close()
 
-    queue = Queue()
-    processes = []
-    for cpu in range(num_cpus):
-        p = Process(target=index_media, args=(queue, partial_lists[cpu],))
-        p.start()
-        processes.append(p)
 
-    # The db is only on the main process
-    # It receives stuff to insert via a queue
-    # It also counts the number of workers finished
-    workers_finished = 0
-    while True:
-        m = queue.get()
-        if m:
-            (medium, category) = m
+def index(database_files, filesystem_files, workers=None, work_journal=None, report=None):
+    """\
+    indexes, moves and deletes so the db matches filesystem_files
+    only the files in database_files are deleted if they are missing from filesystem_files
 
-            medium.category = get_or_create_category(category)
+    with a journal.Journal, new shas and probe results are journaled until their rows are written,
+    the files an interrupted run left in it are neither hashed nor probed again
 
-            db.session.add(medium)
-            db.session.commit()
-        else:
-            workers_finished = workers_finished + 1
-            if workers_finished == len(processes):
-                logging.info("Worker finished")
-                break
+    the time every phase and stage takes is recorded in report, a runreport.RunReport,
+    which is logged at the end
+    """
+    report = report or runreport.RunReport()
+
+    with report.phase("delta"):
+        (to_insert, to_update, to_delete) = get_deltas(database_files, filesystem_files)
+        (moves, to_insert, to_delete) = get_moves(to_insert, to_delete)
+
+    logging.info("{} to insert, {} to update, {} to move, {} to delete".format(
+        len(to_insert), len(to_update), len(moves), len(to_delete)))
+
+    # unchanged content that was not hashed again
+    bytes_skipped = 0
+
+    with report.phase("move"):
+        report.count("moved", move_media(moves))
+        bytes_skipped += sum(f[3] for (_, f) in moves)
+
+    with report.phase("delete"):
+        (num_deleted, orphaned_shas) = delete_media(to_delete)
+    report.count("deleted", num_deleted)
+
+    # the thumbnails of changed files are replaced unless another file has the same content
+    to_upsert = to_insert + to_update
+    updated_paths = set(f[0] for f in to_update)
+    orphaned_shas.update(bytes(f[5]) for f in database_files if f[0] in updated_paths)
+    sha_cache = get_sha_cache(database_files, to_upsert)
+
+    resumed = work_journal.resumable(to_upsert) if work_journal else {}
+    for f in to_upsert:
+        if f[0] in resumed:
+            sha_cache[fingerprint(f)] = resumed[f[0]][0]
+    if resumed:
+        logging.info("Resuming {} files from the journal".format(len(resumed)))
+        report.count("resumed", len(resumed))
+
+    # hashing is bound by disk bandwidth, probing by cpu and thumbnailing by ffmpeg
+    # so every stage gets its own number of processes
+    workers = workers or {}
+    manager = Manager()
+    probe_memo = ProbeMemo(manager, lookup=indexed_mediainfo)
+    probe_memo.preload(dict((sha, mediainfo) for (sha, mediainfo) in resumed.values() if mediainfo is not None))
+    indexer = pipeline.Pipeline([
+        pipeline.Stage("hash", functools.partial(hash_medium, sha_cache),
+                       workers.get("hash") or SCRAPER_HASH_WORKERS, SCRAPER_STAGE_QUEUE_SIZE),
+        pipeline.Stage("probe", functools.partial(probe_medium, probe_memo),
+                       workers.get("probe") or SCRAPER_PROBE_WORKERS or cpu_count(), SCRAPER_STAGE_QUEUE_SIZE),
+        pipeline.Stage("thumb", functools.partial(thumb_medium, ShaLocks()),
+                       workers.get("thumb") or SCRAPER_THUMB_WORKERS, SCRAPER_STAGE_QUEUE_SIZE),
+    ], retries=SCRAPER_MAX_RETRIES, backoff=SCRAPER_RETRY_BACKOFF, results_size=SCRAPER_RESULTS_QUEUE_SIZE)
 
-    db.session.commit()
+    # The db is only on the main process
+    # It receives the probed media from the pipeline and writes them in batches
+    writer = dbwriter.MediaWriter(on_written=work_journal.written if work_journal else None)
+    num_indexed = 0
+
+    def on_result(result):
+        nonlocal num_indexed, bytes_skipped
+        if result[0] == "hashed":
+            (_, f, sha, seconds) = result
+            report.file("hash", f[0], seconds, f[3])
+            if work_journal:
+                work_journal.hashed(f, sha)
+            # while the probes are slow, hashing is all that happens for a while
+            report.progress(num_indexed, len(to_upsert))
+            return
+        if result[0] == "thumbed":
+            (_, relativePath, seconds, runs, failed) = result
+            report.file("thumb", relativePath, seconds)
+            report.count("ffmpeg_runs", runs)
+            report.count("ffmpeg_runs_failed", failed)
+            if work_journal:
+                work_journal.thumbed(relativePath)
+            return
+
+        (_, medium, category, hashed, probe_stats, needs_thumb) = result
+        num_indexed += 1
+        if work_journal:
+            f = (medium.path, medium.mimetype, medium.lastModified, medium.size, medium.inode)
+            work_journal.probed(f, medium.sha, medium.mediainfo, needs_thumb)
+
+        # attempts is 0 for results resumed from the journal
+        if probe_stats and probe_stats["attempts"]:
+            report.file("probe", medium.path, probe_stats["seconds"], probe_stats["bytes_read"])
+            report.count("probes_retried", probe_stats["attempts"] > 1)
+            report.count("probes_timed_out", probe_stats["timed_out"])
+
+        if not hashed:
+            bytes_skipped += medium.size
+
+        writer.add(medium, category, update=medium.path in updated_paths)
+        report.progress(num_indexed, len(to_upsert))
+
+    def on_idle():
+        writer.flush_if_due()
+        if work_journal:
+            work_journal.commit()
+        # a run that is stuck still says so
+        report.progress(num_indexed, len(to_upsert))
+
+    with report.phase("index"):
+        indexer.run(to_upsert, on_result, on_idle=on_idle, idle_interval=writer.flush_interval)
+        logging.info("Probe memo holds {} distinct contents".format(len(probe_memo.mediainfo)))
+        manager.shutdown()
+
+        writer.flush()
+
+    for stage in indexer.stages:
+        report.stage(stage.name, failed=stage.failed.value)
+    report.stage("write", files=writer.rows_written, seconds=writer.write_seconds, failed=writer.rows_failed)
+    report.count("inserted", len(to_insert))
+    report.count("updated", len(to_update))
+    report.count("not_indexed", len(to_upsert) - num_indexed)
+    for (name, value) in indexer.ipc_stats().items():
+        report.gauge("ipc_" + name, value)
+    report.gauge("bytes_skip_hashing", bytes_skipped)
+
+    if work_journal:
+        with report.phase("thumbs_left"):
+            finish_thumbs(work_journal, workers.get("thumb") or SCRAPER_THUMB_WORKERS, report)
+
+    with report.phase("orphaned_thumbs"):
+        report.count("orphaned_thumbs_removed", remove_orphaned_thumbs(orphaned_shas))
+
+    report.gauge("peak_rss_bytes", peak_rss())
+    report.finish()
+    report.log()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Index media files into the database")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore the filesystem manifest and walk every folder")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and index changes as they happen")
+    parser.add_argument("--shard", type=parse_shard,
+                        help="only index the i-th of n parts of INDEX_FOLDER, given as i/n, "
+                             "run every part on its own host to split the work")
+    parser.add_argument("--hash-workers", type=positive_int,
+                        help="number of processes hashing files (default: SCRAPER_HASH_WORKERS)")
+    parser.add_argument("--probe-workers", type=positive_int,
+                        help="number of processes probing files (default: SCRAPER_PROBE_WORKERS or the number of cpus)")
+    parser.add_argument("--thumb-workers", type=positive_int,
+                        help="number of processes generating thumbnails (default: SCRAPER_THUMB_WORKERS)")
+    args = parser.parse_args()
+
+    workers = {"hash": args.hash_workers,
+               "probe": args.probe_workers,
+               "thumb": args.thumb_workers}
+
+    if args.daemon:
+        daemon(workers=workers, shard=args.shard)
+    else:
+        main(full=args.full, workers=workers, shard=args.shard)
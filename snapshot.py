@@ -0,0 +1,70 @@
+from array import array
+
+SHA_SIZE = 32
+
+
+def _null(value):
+    return None if value < 0 else value
+
+
+class IndexSnapshot:
+    """\
+    Compact, read-only listing of the indexed files for the scraper's delta computation
+
+    Behaves like a list of (path, mimetype, lastModified, size, inode, sha) tuples, but
+    keeps every column in its own array: the numbers in typed arrays, the shas back to back
+    in one bytearray and the mimetypes, of which there are only a few, as indexes into
+    a list of distinct ones. A row costs its path plus about 60 bytes instead of a tuple of
+    six objects. Tuples are built on access and can be dropped right away.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.mime_ids = array("H")
+        # -1 for NULL, size and inode are unknown for rows indexed before they were stored
+        self.mtimes = array("q")
+        self.sizes = array("q")
+        self.inodes = array("q")
+        self.shas = bytearray()
+
+        self.mimes = []
+        self.mime_index = {}
+
+    def append(self, row):
+        (path, mime, lastModified, size, inode, sha) = row
+
+        mime_id = self.mime_index.get(mime)
+        if mime_id is None:
+            mime_id = self.mime_index[mime] = len(self.mimes)
+            self.mimes.append(mime)
+
+        self.paths.append(path)
+        self.mime_ids.append(mime_id)
+        self.mtimes.append(-1 if lastModified is None else lastModified)
+        self.sizes.append(-1 if size is None else size)
+        self.inodes.append(-1 if inode is None else inode)
+        self.shas += bytes(sha).ljust(SHA_SIZE, b"\0")[:SHA_SIZE]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.paths)
+        return (self.paths[i],
+                self.mimes[self.mime_ids[i]],
+                _null(self.mtimes[i]),
+                _null(self.sizes[i]),
+                _null(self.inodes[i]),
+                bytes(self.shas[i * SHA_SIZE:(i + 1) * SHA_SIZE]))
+
+    def __iter__(self):
+        for i in range(len(self.paths)):
+            yield self[i]
+
+    def nbytes(self):
+        """\
+        approximate memory used by the columns, not counting the path strings themselves
+        """
+        return (8 * len(self.paths) + self.mime_ids.itemsize * len(self.mime_ids) +
+                8 * (len(self.mtimes) + len(self.sizes) + len(self.inodes)) + len(self.shas))
@@ -1,41 +1,28 @@
 #!flask/bin/python
 import os.path
 import os
-import re
 import subprocess
-import shutil
 from config import *
 import logging
 import sys
 import math
+import time
+import videoinfo
 
 def getLength(filename):
+    mediainfo = videoinfo.ffprobe(filename)
     try:
-        result = subprocess.check_output(["ffprobe", "-v", "quiet",
-                                          "-show_format", filename])
-        m = re.search('duration=([0-9]+\.[0-9]*)', result.decode('utf-8'))
-    except:
-        logging.warning("ffmpeg (getLength) failed {}".format(filename))
+        return math.floor(float(mediainfo["format"]["duration"]))
+    except (KeyError, ValueError):
+        logging.warning("ffprobe (getLength) failed {}".format(filename))
         return None
 
-    if m:
-        return math.floor(float(m.group(1)))
-
-    return None
-
-
-def generateThumb(title, filename):
-    dir_path = os.path.join(PATH_TO_THUMBNAILS, title)
-    if os.path.exists(dir_path + ".jpg"):
-        return
-
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-
-    length = getLength(filename)
-    if not length:
-        return
 
+def getFrameTimes(length, frames):
+    """\
+    returns the points in time (in seconds) the frames of the strip are taken from
+    or an empty list if the video is too short for a thumbnail
+    """
     # movies, tv shows
     if length > 600:
         # first thumbnail 5th minute
@@ -44,37 +31,168 @@ def generateThumb(title, filename):
     elif length > 30:
         start = 10
     else:
-        shutil.rmtree(dir_path)
-        return
+        return []
+
+    step = (length - start) / frames
+
+    return [start + i * step for i in range(frames)]
+
+
+def getInputArgs(filename, t, threads):
+    """\
+    returns the ffmpeg input options to grab one frame at t (in seconds)
+
+    -ss in front of -i makes ffmpeg seek to a keyframe instead of decoding everything up to t,
+    -noaccurate_seek takes that keyframe as is and -skip_frame nokey stops the decoder from
+    touching any other frame. -threads caps the decoder threads of every input
+    """
+    return ["-skip_frame", "nokey", "-threads", str(threads), "-noaccurate_seek",
+            "-ss", "{:.3f}".format(t), "-i", filename]
+
+
+def getStripCommand(filename, times, width, threads=THUMBNAIL_THREADS):
+    """\
+    returns an ffmpeg command line that writes the whole strip as one jpeg to stdout
+
+    every frame is its own input, the frames are scaled and appended horizontally in one filter graph
+    """
+    cmd = ["ffmpeg", "-v", "quiet"]
+    for t in times:
+        cmd += getInputArgs(filename, t, threads)
+
+    scaled = ["[{}:v:0]scale={}:-2,setsar=1[f{}]".format(i, width, i) for i in range(len(times))]
+    inputs = "".join("[f{}]".format(i) for i in range(len(times)))
+    if len(times) > 1:
+        graph = ";".join(scaled) + ";" + inputs + "hstack=inputs={}[strip]".format(len(times))
+    else:
+        graph = scaled[0].replace("[f0]", "[strip]")
+
+    cmd += ["-filter_complex", graph, "-map", "[strip]",
+            "-frames:v", "1", "-f", "image2pipe", "-c:v", "mjpeg", "-"]
 
-    step = int((length - start) / 10)
+    return cmd
 
-    for i in range(start, length, step):
+
+def getFrameCommand(filename, t, width, threads=THUMBNAIL_THREADS):
+    """\
+    returns an ffmpeg command line that writes the single frame at t as jpeg to stdout
+    """
+    return (["ffmpeg", "-v", "quiet"] + getInputArgs(filename, t, threads) +
+            ["-vf", "scale={}:-2,setsar=1".format(width),
+             "-frames:v", "1", "-f", "image2pipe", "-c:v", "mjpeg", "-"])
+
+
+def grabFrames(title, filename, times, width):
+    """\
+    grabs every frame on its own, a frame that fails or times out is left out instead of failing the strip
+    returns the jpegs of the frames that worked and a list of (time, seconds taken, success) for every frame
+    """
+    jpegs = []
+    timings = []
+
+    for t in times:
+        start = time.time()
+        frame = None
         try:
-            subprocess.check_output(["ffmpeg", "-v", "quiet", "-ss", str(i),
-                                     "-i", filename, "-vf", "scale=320:-1",
-                                     "-vframes", "1", "-f", "image2",
-                                     dir_path+"/out-%08d.jpg" % (i)],
-                                    timeout=60)
+            frame = subprocess.check_output(getFrameCommand(filename, t, width), timeout=THUMBNAIL_FRAME_TIMEOUT)
         except subprocess.TimeoutExpired:
-            logging.warning("ffmpeg timeout: {} frame: {}".format(title, i))
-            shutil.rmtree(dir_path)
-            return
+            logging.warning("ffmpeg timeout: {} frame: {:.0f}".format(title, t))
+        except Exception:
+            logging.warning("ffmpeg failed: {} {} frame: {:.0f}".format(title, filename, t))
 
+        elapsed = time.time() - start
+        timings.append((t, elapsed, bool(frame)))
+        logging.debug("thumb {} frame {:.0f}: {:.2f}s".format(title, t, elapsed))
+
+        if frame:
+            jpegs.append(frame)
+
+    return (jpegs, timings)
+
+
+def appendFrames(jpegs):
+    """\
+    appends the jpegs horizontally, they are piped through ffmpeg's tile filter so nothing hits the disk
+    """
+    return subprocess.check_output(["ffmpeg", "-v", "quiet", "-f", "image2pipe", "-c:v", "mjpeg", "-i", "-",
+                                    "-vf", "tile={}x1".format(len(jpegs)),
+                                    "-frames:v", "1", "-f", "image2pipe", "-c:v", "mjpeg", "-"],
+                                   input=b"".join(jpegs), timeout=THUMBNAIL_FRAME_TIMEOUT)
+
+
+def generateThumb(title, filename, length=None, frames=THUMBNAIL_FRAMES, width=THUMBNAIL_WIDTH,
+                  mode=THUMBNAIL_MODE):
+    """\
+    writes a strip of frames of the video filename to PATH_TO_THUMBNAILS/title.jpg
+    length is the duration of the video in seconds, it is probed if it is not known yet
+
+    mode "strip" grabs all frames in one ffmpeg run and only falls back to grabbing them one
+    by one if that fails, mode "frames" always grabs them one by one.
+    one by one, frames that fail are left out and the remaining ones still make a (shorter) strip
+    returns a list of (time, seconds taken, success) for every ffmpeg run, time is the frame it grabbed
+    or None for the run of mode "strip" that grabs all of them
+    """
+    out_path = os.path.join(PATH_TO_THUMBNAILS, title + ".jpg")
+    if os.path.exists(out_path):
+        return []
+
+    if not length:
+        length = getLength(filename)
+        if not length:
+            return []
+
+    times = getFrameTimes(length, frames)
+    if not times:
+        return []
+
+    strip = None
+    timings = []
+
+    if mode == "strip":
+        start = time.time()
+        try:
+            strip = subprocess.check_output(getStripCommand(filename, times, width), timeout=THUMBNAIL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.warning("ffmpeg timeout: {}, grabbing frames one by one".format(title))
+        except Exception:
+            logging.warning("ffmpeg failed: {} {}, grabbing frames one by one".format(title, filename))
+
+        timings.append((None, time.time() - start, bool(strip)))
+
+    if not strip:
+        (jpegs, frame_timings) = grabFrames(title, filename, times, width)
+        timings += frame_timings
+        if not jpegs:
+            return timings
+
+        if len(jpegs) < len(times):
+            logging.warning("Keeping partial thumbnail: {} ({} of {} frames)".format(title, len(jpegs), len(times)))
+
+        try:
+            strip = appendFrames(jpegs)
         except Exception:
-            logging.warning("ffmpeg failed: {} {} frame: {}".format(i, title, filename))
-            shutil.rmtree(dir_path)
-            return
+            logging.warning("ffmpeg failed to append frames: {}".format(title))
+            return timings
+
+    if not strip:
+        logging.warning("ffmpeg returned no thumbnail: {} {}".format(title, filename))
+        return timings
 
-    mergeThumbs(title)
+    # write next to the final file and rename, so a half written thumbnail is never served
+    tmp_path = out_path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(strip)
+    os.replace(tmp_path, out_path)
 
-    shutil.rmtree(dir_path)
+    return timings
 
 
-def mergeThumbs(title):
+def removeThumb(title):
+    """\
+    removes PATH_TO_THUMBNAILS/title.jpg, returns whether there was one
+    """
     try:
-        in_path = os.path.join(PATH_TO_THUMBNAILS ,title, "out-*.jpg")
-        out_path = os.path.join(PATH_TO_THUMBNAILS, title + ".jpg")
-        subprocess.check_output(["convert", "+append", in_path, out_path])
-    except:
-        logging.warning("convert failed: {}".format(title))
+        os.remove(os.path.join(PATH_TO_THUMBNAILS, title + ".jpg"))
+        return True
+    except FileNotFoundError:
+        return False
@@ -1,21 +1,394 @@
-from subprocess import check_output
+from subprocess import Popen, PIPE, DEVNULL
+from fractions import Fraction
 import json
+import os
 import sys
+import time
+import signal
 import logging
+import threading
+from config import PROBE_BACKEND, PROBE_PROFILES, PROBE_ESCALATION, PROBE_ATTEMPTS, PROBE_TIMEOUT
 
+# PyAV is optional, without it every probe runs the ffprobe binary
+try:
+    import av
+except ImportError:
+    av = None
+
+# a missing PyAV is only warned about once per process
+_warned_no_pyav = False
+
+
+class ProbeTimeout(Exception):
+    pass
+
+
+def ffprobe(filename, mime=None):
+    """\
+    returns what ffprobe -show_format -show_streams prints for filename as a dict,
+    an empty dict if the file can't be probed, see probe
+    """
+    return probe(filename, mime)[0]
+
+
+def probe(filename, mime=None):
+    """\
+    probes filename with the limits of the PROBE_PROFILES entry for mime
+    if streams are missing or incomplete, it is probed again with limits PROBE_ESCALATION times as wide,
+    at most PROBE_ATTEMPTS times in total
+
+    with PROBE_BACKEND "pyav" (or "auto" and PyAV installed) the file is probed with libav
+    in a forked child and the dict is built to look like ffprobe's, the ffprobe binary is still used
+    for the files PyAV fails on
+
+    returns (mediainfo, stats), stats is a dict with the seconds taken, the bytes read
+    (None if they can't be counted on this system), the number of attempts and
+    whether the last one was killed after PROBE_TIMEOUT seconds
+    """
+    stats = {"seconds": 0.0, "bytes_read": 0, "attempts": 0, "timed_out": False}
+    mediainfo = dict()
+    start = time.time()
+
+    for attempt in range(PROBE_ATTEMPTS):
+        (probesize, analyzeduration) = probe_limits(mime, attempt)
+        stats["attempts"] += 1
+
+        try:
+            mediainfo = probe_once(filename, probesize, analyzeduration, stats)
+        except ProbeTimeout:
+            # wider limits would only take longer
+            logging.warning("Probing {} timed out after {}s".format(filename, PROBE_TIMEOUT))
+            stats["timed_out"] = True
+            mediainfo = dict()
+            break
+
+        # an empty dict means the file is no media at all
+        if not incomplete(mediainfo):
+            break
+
+    stats["seconds"] = time.time() - start
+    return (mediainfo, stats)
+
+
+def probe_limits(mime, attempt):
+    """\
+    returns probesize (bytes) and analyzeduration (microseconds) for a file of type mime
+    """
+    mime = mime or ""
+    profile = PROBE_PROFILES.get(mime) or PROBE_PROFILES.get(mime.split("/")[0]) or PROBE_PROFILES["default"]
+    factor = PROBE_ESCALATION ** attempt
+    return (profile["probesize"] * factor, profile["analyzeduration"] * factor)
+
+
+def incomplete(mediainfo):
+    """\
+    whether ffprobe found a container but gave up on (some of) its streams before it knew their parameters
+    """
+    if not mediainfo:
+        return False
+
+    streams = mediainfo.get("streams")
+    if not streams:
+        return True
+
+    for stream in streams:
+        # subtitle and data streams have nothing the index needs
+        if stream.get("codec_type") not in ("video", "audio"):
+            continue
+        if not stream.get("codec_name"):
+            return True
+        if stream.get("codec_type") == "video" and not stream.get("width"):
+            return True
+        if stream.get("codec_type") == "audio" and not stream.get("channels"):
+            return True
+    return False
+
+
+def probe_once(filename, probesize, analyzeduration, stats):
+    if use_pyav():
+        try:
+            return pyav_forked(filename, probesize, analyzeduration, stats)
+        except ProbeTimeout:
+            raise
+        except Exception:
+            logging.debug("PyAV failed on {}, falling back to ffprobe".format(filename))
+
+    return ffprobe_subprocess(filename, probesize, analyzeduration, stats)
+
+
+def use_pyav():
+    global _warned_no_pyav
+    if PROBE_BACKEND == "ffprobe":
+        return False
+    if PROBE_BACKEND == "pyav" and av is None and not _warned_no_pyav:
+        logging.warning("PROBE_BACKEND is pyav but PyAV is not installed, using ffprobe")
+        _warned_no_pyav = True
+    return av is not None
+
+
+def ffprobe_subprocess(filename, probesize=None, analyzeduration=None, stats=None):
+    """\
+    runs the ffprobe binary, it is killed after PROBE_TIMEOUT seconds
+    the bytes read are the rchar of the process, everything it read whether from disk or the page cache
+    """
+    args = ["ffprobe", "-v", "quiet"]
+    if probesize:
+        args += ["-probesize", str(probesize)]
+    if analyzeduration:
+        args += ["-analyzeduration", str(analyzeduration)]
+    args += ["-show_format", "-show_streams", "-print_format", "json", filename]
+
+    try:
+        # in its own process group, so the timeout kills anything it started as well
+        process = Popen(args, stdout=PIPE, stderr=DEVNULL, start_new_session=True)
+    except OSError:
+        logging.warning("ffprobe could not be started: {}".format(sys.exc_info()))
+        return dict()
+
+    (result, status, rchar, timed_out) = _reap(process.pid, process.stdout)
+    # reaped already, Popen must not wait for it again
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    if stats is not None:
+        add_bytes_read(stats, rchar)
+
+    if timed_out:
+        raise ProbeTimeout(filename)
 
-def ffprobe(filename):
     try:
-        result = check_output(["ffprobe", "-v", "quiet",
-                               "-show_format", "-show_streams",
-                               "-print_format", "json",
-                               filename])
         # yes, decoding sometimes fails too :(
         return json.loads(result.decode('utf-8').strip())
-
     except:
         #logging.warning("ffprobe error: {}".format(sys.exc_info()))
         return dict()
 
+
+def _reap(pid, output):
+    """\
+    reads output to its end and reaps the child pid, whose process group is killed after PROBE_TIMEOUT seconds
+    returns (what was read, the wait status, the child's rchar or None, whether the timeout killed it)
+    """
+    fired = threading.Event()
+    timer = threading.Timer(PROBE_TIMEOUT, _kill_group, (pid, fired))
+    timer.start()
+    try:
+        result = output.read()
+        output.close()
+        rchar = _rchar(pid)
+        (_, status) = os.waitpid(pid, 0)
+    finally:
+        timer.cancel()
+
+    # the timer may fire just after the child exited by itself, and the oom killer sends SIGKILL too
+    timed_out = fired.is_set() and os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL
+    return (result, status, rchar, timed_out)
+
+
+def _rchar(pid):
+    """\
+    the bytes the exited but not yet reaped child pid read, None where /proc/<pid>/io or waitid are missing
+    """
+    try:
+        # /proc/<pid> is gone once the child is reaped, so only wait for it to exit
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        with open("/proc/{}/io".format(pid)) as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def _kill_group(pid, fired):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+        fired.set()
+    except ProcessLookupError:
+        # exited just in time
+        pass
+
+
+def add_bytes_read(stats, nbytes):
+    # once one attempt couldn't count them the total is unknown
+    if nbytes is None or stats["bytes_read"] is None:
+        stats["bytes_read"] = None
+    else:
+        stats["bytes_read"] += nbytes
+
+
+class CountingFile:
+    """\
+    wraps a file opened for reading and counts the bytes read from it
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+
+# ffprobe prints times and sizes as strings, times with 6 decimals
+def _seconds(value, time_base):
+    if value is None:
+        return None
+    return "{:f}".format(float(value * time_base))
+
+
+def _rate(rate):
+    if not rate:
+        return "0/0"
+    return "{}/{}".format(rate.numerator, rate.denominator)
+
+
+def _set(d, key, value):
+    # ffprobe leaves out what it doesn't know instead of printing null
+    if value is not None and value != "":
+        d[key] = value
+
+
+def pyav_stream(stream):
+    s = {"index": stream.index, "codec_type": stream.type}
+
+    codec_context = getattr(stream, "codec_context", None)
+    codec = getattr(codec_context, "codec", None)
+    if codec is not None:
+        # ffprobe prints the name of the codec descriptor, not the one of the decoder
+        _set(s, "codec_name", getattr(codec, "canonical_name", None) or codec.name)
+        _set(s, "codec_long_name", codec.long_name)
+
+    time_base = stream.time_base
+    if time_base:
+        s["time_base"] = _rate(time_base)
+        _set(s, "start_time", _seconds(stream.start_time, time_base))
+        _set(s, "duration", _seconds(stream.duration, time_base))
+
+    if codec_context is not None:
+        if stream.type == "video":
+            _set(s, "width", codec_context.width)
+            _set(s, "height", codec_context.height)
+            _set(s, "pix_fmt", codec_context.pix_fmt)
+            s["avg_frame_rate"] = _rate(stream.average_rate)
+        elif stream.type == "audio":
+            _set(s, "sample_rate", str(codec_context.sample_rate))
+            _set(s, "channels", codec_context.channels)
+            layout = getattr(codec_context, "layout", None)
+            _set(s, "channel_layout", getattr(layout, "name", None))
+
+        if codec_context.bit_rate:
+            s["bit_rate"] = str(codec_context.bit_rate)
+
+    if stream.metadata:
+        s["tags"] = dict(stream.metadata)
+
+    return s
+
+
+def pyav_probe(filename, probesize=None, analyzeduration=None, stats=None):
+    """\
+    probes filename with libav in this process, the output has a subset of the keys of ffprobe_subprocess,
+    those the index uses, with the same values (see test_probe_backends in api_tests.py)
+    libav reads through a CountingFile, so the bytes read are exact
+    there is no timeout, libav can't be interrupted while it reads, see pyav_forked
+    """
+    options = {}
+    if probesize:
+        options["probesize"] = str(probesize)
+    if analyzeduration:
+        options["analyzeduration"] = str(analyzeduration)
+
+    with open(filename, "rb") as raw:
+        f = CountingFile(raw)
+        try:
+            container = av.open(f, options=options)
+        finally:
+            if stats is not None:
+                add_bytes_read(stats, f.bytes_read)
+
+        try:
+            return pyav_container(filename, container)
+        finally:
+            container.close()
+
+
+def pyav_forked(filename, probesize=None, analyzeduration=None, stats=None):
+    """\
+    runs pyav_probe in a forked child, which is killed after PROBE_TIMEOUT seconds like ffprobe is
+    raises an exception if PyAV failed on filename
+    """
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child must never return into the worker's code, whatever happens it exits here,
+        # without running the parent's atexit handlers and finalizers
+        status = 1
+        try:
+            os.close(read_fd)
+            # its own process group, like ffprobe's
+            os.setpgid(0, 0)
+            try:
+                child_stats = {"bytes_read": 0}
+                result = {"mediainfo": pyav_probe(filename, probesize, analyzeduration, child_stats),
+                          "bytes_read": child_stats["bytes_read"]}
+            except Exception:
+                result = {"error": str(sys.exc_info()[1])}
+            with os.fdopen(write_fd, "w") as f:
+                json.dump(result, f)
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        # the child did it first or is gone already
+        pass
+
+    (result, status, _, timed_out) = _reap(pid, os.fdopen(read_fd, "r"))
+    if timed_out:
+        raise ProbeTimeout(filename)
+    try:
+        result = json.loads(result)
+    except ValueError:
+        raise RuntimeError("PyAV child exited with status {}".format(status))
+    if "error" in result:
+        raise RuntimeError(result["error"])
+
+    if stats is not None:
+        add_bytes_read(stats, result["bytes_read"])
+    return result["mediainfo"]
+
+
+def pyav_container(filename, container):
+    time_base = Fraction(1, av.time_base)
+
+    f = {
+        "filename": filename,
+        "nb_streams": len(container.streams),
+        "format_name": container.format.name,
+        "format_long_name": container.format.long_name,
+        "size": str(os.path.getsize(filename)),
+    }
+    _set(f, "start_time", _seconds(container.start_time, time_base))
+    _set(f, "duration", _seconds(container.duration, time_base))
+    if container.bit_rate:
+        f["bit_rate"] = str(container.bit_rate)
+    if container.metadata:
+        f["tags"] = dict(container.metadata)
+
+    return {"streams": [pyav_stream(stream) for stream in container.streams], "format": f}
+
+
 def guess_series_meta(filename):
     pass
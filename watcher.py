@@ -0,0 +1,255 @@
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# files are only picked up once they were closed after writing, a half uploaded file is not indexed
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+
+
+def available():
+    return hasattr(_libc, "inotify_init1")
+
+
+class Inotify:
+    """\
+    Minimal inotify binding, watches every directory of a tree
+
+    inotify watches single directories, so every directory gets its own watch and
+    new directories have to be added as they show up. Watches are limited by
+    /proc/sys/fs/inotify/max_user_watches, directories beyond that are only seen
+    by the reconciliation walk.
+    """
+
+    def __init__(self):
+        if not available():
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        # wd -> dirpath and back
+        self.paths = {}
+        self.wds = {}
+
+    def add_watch(self, dirpath):
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), dirpath)
+
+        self.paths[wd] = dirpath
+        self.wds[dirpath] = wd
+
+    def add_tree(self, root):
+        """\
+        watches root and every directory below it, returns how many directories could not be watched
+        """
+        failed = 0
+        for (dirpath, _, _) in os.walk(root):
+            try:
+                self.add_watch(dirpath)
+            except OSError as e:
+                # gone again already, the event in its parent covers that
+                if e.errno == errno.ENOENT:
+                    continue
+                failed += 1
+                if e.errno == errno.ENOSPC:
+                    logging.error("Out of inotify watches, raise fs.inotify.max_user_watches")
+                    return failed + 1
+        return failed
+
+    def remove_tree(self, root):
+        """\
+        forgets the watches of root and everything below it, e.g. after it was moved away
+        """
+        prefix = os.path.join(root, "")
+        for dirpath in [d for d in self.wds if d == root or d.startswith(prefix)]:
+            wd = self.wds.pop(dirpath)
+            self.paths.pop(wd, None)
+            _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """\
+        returns the pending events as (dirpath, name, mask) without blocking
+        dirpath is None for events that don't belong to a watch, like IN_Q_OVERFLOW
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+
+                if mask & IN_IGNORED:
+                    dirpath = self.paths.pop(wd, None)
+                    if dirpath is not None and self.wds.get(dirpath) == wd:
+                        del self.wds[dirpath]
+                    continue
+
+                events.append((self.paths.get(wd), name, mask))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Coalescer:
+    """\
+    Collects changed files and directories until no new change came in for settle seconds,
+    or the first pending change is max_delay seconds old. A file that changes many times
+    in a burst is handed on once.
+    """
+
+    def __init__(self, settle, max_delay):
+        self.settle = settle
+        self.max_delay = max_delay
+
+        self.files = set()
+        self.dirs = set()
+        self.first_change = None
+        self.last_change = None
+
+    def add_file(self, path):
+        self.files.add(path)
+        self._touch()
+
+    def add_dir(self, path):
+        self.dirs.add(path)
+        self._touch()
+
+    def _touch(self):
+        now = time.time()
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+
+    def due(self):
+        if self.first_change is None:
+            return False
+        now = time.time()
+        return now - self.last_change >= self.settle or now - self.first_change >= self.max_delay
+
+    def take(self):
+        """\
+        returns and forgets the pending (files, dirs), files below a pending directory are left out
+        """
+        dirs = sorted(self.dirs)
+        prefixes = tuple(os.path.join(d, "") for d in dirs)
+        files = sorted(f for f in self.files if not f.startswith(prefixes))
+
+        self.files = set()
+        self.dirs = set()
+        self.first_change = None
+        self.last_change = None
+
+        return (files, dirs)
+
+
+class Watcher:
+    """\
+    Watches the tree below root for changes to files that classify accepts
+
+    poll returns the changed (files, dirs) in batches, as paths relative to mount.
+    A directory in dirs has to be walked as a whole: it was created, moved in or
+    moved away, and the events for its contents are missing. overflowed is set when
+    the kernel dropped events, then only a walk of the whole tree is reliable.
+    """
+
+    def __init__(self, root, mount, classify, settle=2, max_delay=30):
+        self.root = root
+        self.mount = mount
+        self.classify = classify
+        self.coalescer = Coalescer(settle, max_delay)
+        self.overflowed = False
+
+        self.inotify = Inotify()
+        if self.inotify.add_tree(root):
+            self.overflowed = True
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.mount)
+
+    def handle(self, dirpath, name, mask):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("inotify queue overflowed, events were lost")
+            self.overflowed = True
+            return
+
+        if dirpath is None:
+            return
+
+        path = os.path.join(dirpath, name) if name else dirpath
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # the directory itself is gone, the event in its parent takes care of the index
+            if path == self.root:
+                logging.warning("{} itself was moved or deleted".format(self.root))
+                self.overflowed = True
+            return
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if self.inotify.add_tree(path):
+                    self.overflowed = True
+                self.coalescer.add_dir(self.relpath(path))
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self.inotify.remove_tree(path)
+                self.coalescer.add_dir(self.relpath(path))
+            return
+
+        # a new file is indexed once it is closed, IN_CREATE alone would catch it half written
+        if mask & IN_CREATE:
+            return
+
+        if self.classify(name):
+            self.coalescer.add_file(self.relpath(path))
+
+    def poll(self, timeout):
+        """\
+        waits up to timeout seconds for events, returns (files, dirs) once a batch is due or None
+        """
+        (readable, _, _) = select.select([self.inotify.fd], [], [], timeout)
+        if readable:
+            for (dirpath, name, mask) in self.inotify.read():
+                self.handle(dirpath, name, mask)
+
+        if self.coalescer.due():
+            return self.coalescer.take()
+        return None
+
+    def close(self):
+        self.inotify.close()